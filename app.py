@@ -1,11 +1,30 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory, Response, g
+from werkzeug.exceptions import RequestEntityTooLarge
 from datetime import datetime
 import socket
 import json
 import os
 import hashlib
 import base64
-import uuid
+import threading
+import time
+import cProfile
+
+import click
+
+import archive
+import compression
+import metrics
+import notifier
+import presence
+import private_cache
+import rate_limit
+import retention
+import search_index
+import uploads
+import thumbnails
+import write_behind
+from storage import create_storage
 
 app = Flask(__name__)
 app.secret_key = 'sua_chave_secreta_aqui_mude_isso_em_producao'  # Necessário para sessions
@@ -14,65 +33,48 @@ app.secret_key = 'sua_chave_secreta_aqui_mude_isso_em_producao'  # Necessário p
 os.makedirs('data', exist_ok=True)
 os.makedirs('data/uploads', exist_ok=True)
 
-# Configurações de upload
-UPLOAD_FOLDER = 'data/uploads'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
-
-# Arquivo de usuários e galeria
-USERS_FILE = 'data/users.json'
-GALLERY_FILE = 'data/gallery.json'
-
-def load_users():
-    """Carrega usuários do arquivo JSON.
-    Retorna dict com estrutura: {
-        'users': [
-            {'id': 1, 'username': 'user1', 'password': 'hash', 'created_at': '...'},
-            ...
-        ],
-        'next_id': 2
-    }
+# Cache HTTP: uploads nunca mudam (nome = hash do conteúdo)
+UPLOAD_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def version_etag(*parts):
+    """Monta um ETag a partir de contadores de versão (sem olhar o corpo).
+    
+    O prefixo identifica o armazenamento: com JSON os contadores recomeçam
+    do zero a cada reinício; com SQLite são os mesmos em todos os processos.
     """
-    try:
-        with open(USERS_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            # Garante que tem a estrutura correta
-            if 'users' not in data:
-                data = {'users': [], 'next_id': 1}
-            return data
-    except FileNotFoundError:
-        return {'users': [], 'next_id': 1}
-
-def save_users(users_data):
-    """Salva usuários no arquivo JSON."""
-    with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users_data, f, indent=4, ensure_ascii=False)
-
-def find_user_by_username(users_data, username):
-    """Busca um usuário pelo username."""
-    for user in users_data['users']:
-        if user['username'].lower() == username.lower():
-            return user
+    return '-'.join([storage.instance_id] + [str(part) for part in parts])
+
+def not_modified(etag):
+    """Retorna uma resposta 304 se o cliente já tem essa versão, senão None."""
+    # Comparação fraca: respostas comprimidas levam o ETag como W/"..."
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     return None
 
+def with_etag(response, etag):
+    """Anexa o ETag e obriga o navegador a revalidar a cada poll."""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def messages_response(messages):
+    """Lista de mensagens em JSON; com ?format=compact, em colunas (veja compression.py)."""
+    if request.args.get('format') == 'compact':
+        return jsonify(compression.compact_messages(messages))
+    return jsonify(messages)
+
+# Configurações de upload (definidas em uploads.py)
+UPLOAD_FOLDER = uploads.UPLOAD_FOLDER
+ALLOWED_EXTENSIONS = uploads.ALLOWED_EXTENSIONS
+MAX_FILE_SIZE = uploads.MAX_FILE_SIZE
+
 def hash_password(password):
     """Cria hash da senha usando SHA256."""
     return hashlib.sha256(password.encode()).hexdigest()
 
-def load_gallery():
-    """Carrega galeria de memes do arquivo JSON."""
-    try:
-        with open(GALLERY_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data.get('memes', [])
-    except FileNotFoundError:
-        return []
-
-def save_gallery(memes):
-    """Salva galeria de memes no arquivo JSON."""
-    with open(GALLERY_FILE, 'w', encoding='utf-8') as f:
-        json.dump({'memes': memes}, f, indent=4, ensure_ascii=False)
-
 def load_rooms():
     """Carrega configuração das salas do arquivo JSON."""
     try:
@@ -82,31 +84,207 @@ def load_rooms():
     except FileNotFoundError:
         return []
 
-def load_messages(filename):
-    """Carrega mensagens do arquivo JSON."""
-    try:
-        with open(f'data/{filename}', 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data.get('messages', [])
-    except FileNotFoundError:
-        return []
-
-def save_messages(messages, filename):
-    """Salva mensagens no arquivo JSON."""
-    with open(f'data/{filename}', 'w', encoding='utf-8') as f:
-        json.dump({'messages': messages}, f, indent=4, ensure_ascii=False)
-
 # Carrega as salas disponíveis
 rooms = load_rooms()
+room_ids = {room['id'] for room in rooms}
+
+# Usuários, mensagens e galeria (JSON por padrão; CHAT_STORAGE=sqlite
+# permite rodar vários processos servidores, veja storage.py). Nada é lido
+# do disco aqui: cada sala é carregada no primeiro acesso
+storage = create_storage([room['id'] for room in rooms])
+if storage.shared:
+    # Versões dos ETags e do push visíveis para todos os processos, e com
+    # elas quem está online e digitando (senão um 304 prenderia a lista
+    # de outro processo)
+    notifier.set_version_store(storage)
+    presence.set_store(storage)
+
+# Janela quente e prazo de cada sala ("retention" no rooms.json): o resto
+# vai para o arquivo morto em segundo plano
+retention.configure(rooms)
+
+# ========== TRABALHOS EM SEGUNDO PLANO ==========
+# Só o processo que atende requisições liga o journal e as threads. Importar
+# o app não basta: o processo pai do reloader do Werkzeug (app.run com
+# debug=True) e os comandos ``flask`` também importam este arquivo, e não
+# podem pegar o lock do journal nem arquivar as salas junto com o servidor
+_workers = {'started': False}
+_workers_lock = threading.Lock()
+
+def start_background_workers():
+    """Journal, arquivamento das salas e expiração da presença (uma única vez)."""
+    if _workers['started']:
+        return
+    with _workers_lock:
+        if not _workers['started']:
+            storage.start_workers()
+            retention.start_scheduler(storage)
+            presence.start_sweeper()
+            _workers['started'] = True
+
+@app.before_request
+def ensure_background_workers():
+    # Antes de qualquer rota ler as salas (o journal é reaplicado aqui)
+    start_background_workers()
+
+# ========== MÉTRICAS ==========
+# Requisições mais lentas que isso (em ms) têm o cProfile salvo em
+# PROFILE_DIR. 0 desliga (sem custo: o profiler só roda quando ligado)
+PROFILE_SLOW_MS = float(os.environ.get('CHAT_PROFILE_SLOW_MS', 0))
+PROFILE_DIR = 'data/profiles'
+
+def private_cache_ratio():
+    total = private_cache.stats['hits'] + private_cache.stats['misses']
+    return private_cache.stats['hits'] / total if total else 0
+
+metrics.register_gauge('chat_room_messages', 'Mensagens no histórico ativo de cada sala',
+                       lambda: [({'room': room_id}, count) for room_id, count in storage.room_sizes()])
+metrics.register_gauge('chat_room_archived_messages', 'Mensagens no arquivo morto de cada sala',
+                       lambda: [({'room': room_id}, archive.archived_count(room_id))
+                                for room_id in archive.archived_rooms()])
+metrics.register_gauge('chat_private_cache_events_total', 'Acessos ao cache de conversas privadas',
+                       lambda: [({'event': event}, count) for event, count in private_cache.stats.items()],
+                       kind='counter')
+metrics.register_gauge('chat_private_cache_hit_ratio', 'Fração dos acessos atendidos pelo cache',
+                       lambda: [({}, private_cache_ratio())])
+metrics.register_gauge('chat_private_cache_bytes', 'Memória estimada do cache de conversas privadas',
+                       lambda: [({}, private_cache.cache_usage()['bytes'])])
+metrics.register_gauge('chat_write_behind_pending', 'Mensagens aceitas ainda não gravadas nos históricos',
+                       lambda: [({}, write_behind.pending_count())])
+metrics.register_gauge('chat_search_index_pending', 'Mensagens na fila da indexação da busca',
+                       lambda: [({}, search_index.pending_count())])
+metrics.register_gauge('chat_push_subscribers', 'Conexões SSE inscritas em canais',
+                       lambda: [({}, notifier.subscriber_count())])
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    if PROFILE_SLOW_MS:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.profiler = profiler
+        except ValueError:
+            # Já há um profiler ativo (ex: outra requisição em paralelo)
+            pass
+
+@app.after_request
+def record_request_metrics(response):
+    """Conta a requisição, seu tempo e os bytes da resposta, por rota."""
+    elapsed = time.perf_counter() - g.request_start
+    route = request.endpoint or 'not_found'
+    metrics.inc('chat_requests_total', route=route, status=response.status_code)
+    metrics.observe('chat_request_duration_seconds', elapsed, route=route)
+    if response.content_length:
+        metrics.inc('chat_response_bytes_total', response.content_length, route=route)
+    
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        if elapsed * 1000 >= PROFILE_SLOW_MS:
+            dump_profile(profiler, route, elapsed)
+    return response
+
+# ========== LIMITE DE REQUISIÇÕES ==========
+# Balde de fichas por sessão e rota + orçamento global (veja rate_limit.py)
+
+def rate_limit_key():
+    """Usuário logado ou, antes do login, o IP do cliente (pelo ngrok, o do X-Forwarded-For)."""
+    if 'username' in session:
+        return session['username']
+    forwarded = request.headers.get('X-Forwarded-For', '')
+    return forwarded.split(',')[0].strip() or request.remote_addr
+
+@app.before_request
+def enforce_rate_limit():
+    wait = rate_limit.check(rate_limit_key(), request.endpoint)
+    if wait is None:
+        return None
+    # Espera pelo menos o intervalo sugerido a todos os clientes
+    wait = max(wait, rate_limit.poll_interval())
+    response = jsonify({
+        'status': 'error',
+        'message': 'Muitas requisições, tente novamente em instantes',
+        'retry_after': wait,
+        'poll_interval': rate_limit.poll_interval()
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = rate_limit.retry_after_header(wait)
+    return response
+
+@app.after_request
+def add_poll_interval_hint(response):
+    """Intervalo de polling sugerido (segundos), usado pelo index.html."""
+    response.headers['X-Poll-Interval'] = str(rate_limit.poll_interval())
+    return response
+
+# ========== COMPRESSÃO ==========
+# Registrada depois das métricas: roda antes delas, então
+# chat_response_bytes_total conta os bytes já comprimidos
+
+@app.after_request
+def compress_response(response):
+    """Comprime as respostas grandes com a melhor codificação aceita (br ou gzip)."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    if not compression.should_compress(response.mimetype, response.content_length or 0):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = compression.choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    
+    data = response.get_data()
+    compressed = compression.compress(data, encoding)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # O corpo comprimido não é byte a byte o da versão: ETag fraco
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    metrics.inc('chat_compression_saved_bytes_total', len(data) - len(compressed), encoding=encoding)
+    return response
+
+def dump_profile(profiler, route, elapsed):
+    """Salva o perfil de uma requisição lenta (abra com snakeviz ou pstats)."""
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f'{route}-{int(time.time() * 1000)}-{int(elapsed * 1000)}ms.prof')
+        profiler.dump_stats(path)
+        print(f"Requisição lenta ({elapsed * 1000:.0f}ms em {route}): perfil salvo em {path}")
+    except Exception as e:
+        print(f"Erro ao salvar perfil: {e}")
 
-# Dicionário para armazenar mensagens de cada sala em memória
-room_messages = {}
-for room in rooms:
-    room_id = room['id']
-    room_messages[room_id] = load_messages(f'chat_{room_id}.json')
+def add_room_message(room_id, message, search_extra=''):
+    """Atribui o próximo ID à mensagem, adiciona à sala e persiste.
+    
+    ``search_extra`` é indexado na busca junto com a mensagem (ex: tags
+    de uma imagem).
+    """
+    storage.add_room_message(room_id, message)
+    storage.index_message(f'room:{room_id}', message, extra=search_extra)
+    track_image_reference(message)
+    notifier.notify(f'room:{room_id}')
+    retention.message_added(storage, room_id, message['id'])
+    return message
+
+def add_private_message(from_user, to_user, message, search_extra=''):
+    """Adiciona a mensagem à conversa privada (cache + disco) e avisa os dois lados."""
+    conversation_id = private_cache.conversation_id_for(from_user, to_user)
+    storage.add_private_message(conversation_id, message)
+    storage.index_message(f'private:{conversation_id}', message,
+                          participants=(from_user.lower(), to_user.lower()), extra=search_extra)
+    track_image_reference(message)
+    notifier.notify(f'conversation:{conversation_id}')
+    notify_private(from_user, to_user)
+    return message
 
-# Carrega mensagens privadas
-private_messages = load_messages('private_messages.json')
+def track_image_reference(message):
+    """Conta a referência se a mensagem aponta para um upload ([IMAGE:arquivo])."""
+    filename = uploads.image_reference(message.get('message'))
+    if filename:
+        storage.add_upload_reference(filename)
 
 def get_local_ip():
     """Obtém o IP local da máquina para facilitar o acesso em rede."""
@@ -151,25 +329,15 @@ def register():
         if len(password) < 4:
             return jsonify({'success': False, 'message': 'Senha deve ter no mínimo 4 caracteres'}), 400
         
-        users_data = load_users()
-        
-        # Verifica se o username já existe
-        if find_user_by_username(users_data, username):
+        # Cria novo usuário com ID único (None se o username já existe)
+        new_user = storage.create_user(
+            username,
+            hash_password(password),
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        )
+        if not new_user:
             return jsonify({'success': False, 'message': 'Usuário já existe'}), 400
         
-        # Cria novo usuário com ID único
-        new_user = {
-            'id': users_data['next_id'],
-            'username': username,
-            'password': hash_password(password),
-            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
-        
-        users_data['users'].append(new_user)
-        users_data['next_id'] += 1
-        
-        save_users(users_data)
-        
         return jsonify({'success': True, 'message': 'Usuário criado com sucesso!'})
     except Exception as e:
         return jsonify({'success': False, 'message': f'Erro ao registrar: {str(e)}'}), 500
@@ -185,10 +353,8 @@ def authenticate():
         if not username or not password:
             return jsonify({'success': False, 'message': 'Usuário e senha são obrigatórios'}), 400
         
-        users_data = load_users()
-        
-        # Busca o usuário pelo username
-        user = find_user_by_username(users_data, username)
+        # Busca o usuário pelo username (índice em memória ou SQLite)
+        user = storage.find_user(username)
         
         if not user:
             return jsonify({'success': False, 'message': 'Usuário não encontrado'}), 401
@@ -243,39 +409,65 @@ def send():
     try:
         data = request.get_json()
         room_id = data.get('room_id', 'geral')
+        # O envio é confirmado antes de ser gravado (journal): uma sala
+        # inexistente tem que ser recusada aqui
+        if room_id not in room_ids:
+            return jsonify({'status': 'error', 'message': 'Sala não encontrada'}), 404
         
+        now = datetime.now()
         message = {
             'user': data['user'],
             'message': data['message'],
-            'timestamp': datetime.now().strftime('%H:%M:%S')
+            'timestamp': now.strftime('%H:%M:%S'),
+            'date': now.strftime('%Y-%m-%d')  # Partição do arquivo morto
         }
         
-        # Garante que a sala existe no dicionário
-        if room_id not in room_messages:
-            room_messages[room_id] = []
-        
-        room_messages[room_id].append(message)
-        save_messages(room_messages[room_id], f'chat_{room_id}.json')
-        return jsonify({'status': 'success'})
+        add_room_message(room_id, message)
+        presence.touch(room_id, session['username'])
+        return jsonify({'status': 'success', 'id': message['id']})
     except Exception as e:
         print(f"Erro ao enviar mensagem: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-# Dicionário para controlar quem está digitando em cada sala
-typing_users = {}
+# Tamanho padrão e máximo de uma página do histórico
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
 
 @app.route('/messages')
 def get_messages():
-    """Retorna todas as mensagens de uma sala específica."""
+    """Retorna as mensagens de uma sala específica.
+    
+    Com ?after=<id> retorna apenas as mensagens posteriores a esse ID,
+    para que o polling receba só o que é novo.
+    
+    Com ?limit=N (e opcionalmente ?before=<id>) retorna uma página do
+    histórico: as N mensagens mais recentes anteriores a before (ou as N
+    últimas da sala), em ordem crescente.
+    
+    Com ?format=compact a lista vem em colunas (veja compression.py).
+    """
     # Verifica autenticação
     if 'username' not in session:
         return jsonify({'error': 'Não autenticado'}), 401
     
     try:
         room_id = request.args.get('room_id', 'geral')
-        if room_id not in room_messages:
-            room_messages[room_id] = []
-        return jsonify(room_messages[room_id])
+        after_id = request.args.get('after', type=int)
+        presence.touch(room_id, session['username'])
+        
+        # Nada mudou desde o último poll: 304 sem serializar nada
+        etag = version_etag('room', notifier.version(f'room:{room_id}'))
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        
+        before_id = request.args.get('before', type=int)
+        limit = request.args.get('limit', type=int)
+        if after_id is None and (before_id is not None or limit is not None):
+            limit = min(max(limit or HISTORY_PAGE_SIZE, 1), HISTORY_MAX_PAGE_SIZE)
+            return with_etag(messages_response(storage.room_history(room_id, before_id, limit)), etag)
+        
+        return with_etag(messages_response(storage.room_messages(room_id, after_id)), etag)
     except Exception as e:
         print(f"Erro ao buscar mensagens: {e}")
         return jsonify([])
@@ -293,13 +485,8 @@ def set_typing():
         room_id = data.get('room_id', 'geral')
         is_typing = data.get('is_typing', False)
         
-        if room_id not in typing_users:
-            typing_users[room_id] = {}
-        
-        if is_typing:
-            typing_users[room_id][user] = datetime.now()
-        else:
-            typing_users[room_id].pop(user, None)
+        # Só avisa os inscritos quando alguém começa ou para de digitar
+        presence.set_typing(room_id, user, bool(is_typing))
         
         return jsonify({'status': 'success'})
     except Exception as e:
@@ -317,25 +504,116 @@ def get_typing():
         room_id = request.args.get('room_id', 'geral')
         current_user = request.args.get('user', '')
         
-        if room_id not in typing_users:
-            return jsonify([])
-        
-        # Remove usuários que pararam de digitar há mais de 3 segundos
-        now = datetime.now()
-        active_users = []
-        
-        for user, last_typing in list(typing_users[room_id].items()):
-            if (now - last_typing).seconds < 3:
-                if user != current_user:  # Não inclui o próprio usuário
-                    active_users.append(user)
-            else:
-                typing_users[room_id].pop(user, None)
-        
-        return jsonify(active_users)
+        # A expiração (3s sem notificação) é feita em segundo plano pelo
+        # presence, que também muda a versão do canal
+        etag = version_etag('typing', notifier.version(f'typing:{room_id}'))
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        # Não inclui o próprio usuário
+        return with_etag(jsonify(presence.typing_users(room_id, exclude=current_user)), etag)
     except Exception as e:
         print(f"Erro ao buscar usuários digitando: {e}")
         return jsonify([])
 
+@app.route('/room-state')
+def get_room_state():
+    """Estado da sala numa única requisição: quem está digitando, quem está
+    online e o ID da última mensagem (para saber se vale buscar /messages).
+    """
+    if 'username' not in session:
+        return jsonify({'error': 'Não autenticado'}), 401
+    
+    try:
+        room_id = request.args.get('room_id', 'geral')
+        current_user = session['username']
+        presence.touch(room_id, current_user)
+        
+        etag = version_etag(
+            'state', current_user,
+            notifier.version(f'room:{room_id}'),
+            notifier.version(f'typing:{room_id}'),
+            notifier.version(f'presence:{room_id}')
+        )
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        
+        return with_etag(jsonify({
+            'last_message_id': storage.last_message_id(room_id),
+            'typing': presence.typing_users(room_id, exclude=current_user),
+            'online': presence.online_users(room_id)
+        }), etag)
+    except Exception as e:
+        print(f"Erro ao buscar estado da sala: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# Intervalo máximo sem eventos antes de mandar um keepalive no stream SSE
+EVENTS_KEEPALIVE = 15
+
+def notify_private(from_user, to_user):
+    """Avisa os dois participantes de uma conversa privada."""
+    notifier.notify(f'private:{from_user.lower()}')
+    notifier.notify(f'private:{to_user.lower()}')
+
+def event_channels(room_id, username):
+    """Canais do push de um usuário numa sala -> nome do evento SSE."""
+    return {
+        f'room:{room_id}': 'messages',
+        f'typing:{room_id}': 'typing',
+        f'presence:{room_id}': 'presence',
+        f'private:{username.lower()}': 'private'
+    }
+
+@app.route('/events')
+def events():
+    """Stream SSE com avisos de novas mensagens, digitação, presença e
+    mensagens privadas.
+    
+    Os eventos só avisam que algo mudou ('messages', 'typing', 'presence'
+    ou 'private');
+    o cliente então busca o conteúdo pelos endpoints normais. O polling
+    continua funcionando como fallback.
+    """
+    # Verifica autenticação
+    if 'username' not in session:
+        return jsonify({'error': 'Não autenticado'}), 401
+    
+    room_id = request.args.get('room_id', 'geral')
+    username = session['username']
+    channels = event_channels(room_id, username)
+    
+    def stream():
+        waiter = notifier.subscribe(channels)
+        seen = {channel: notifier.version(channel) for channel in channels}
+        try:
+            yield 'retry: 3000\n\n'
+            last_write = time.monotonic()
+            while True:
+                # Com vários processos, confere as versões periodicamente:
+                # a mudança pode ter sido feita por outro processo
+                # Conexão aberta = usuário online (o keepalive renova antes
+                # de ONLINE_TTL vencer)
+                presence.touch(room_id, username)
+                waiter.wait(notifier.wait_timeout(EVENTS_KEEPALIVE))
+                waiter.clear()
+                for channel, event_name in channels.items():
+                    current = notifier.version(channel)
+                    if current != seen[channel]:
+                        seen[channel] = current
+                        last_write = time.monotonic()
+                        yield f'event: {event_name}\ndata: {current}\n\n'
+                if time.monotonic() - last_write >= EVENTS_KEEPALIVE:
+                    last_write = time.monotonic()
+                    yield ': keepalive\n\n'
+        finally:
+            notifier.unsubscribe(channels, waiter)
+    
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/rato')
 def private_chat():
     """Rota para o chat privado."""
@@ -354,19 +632,7 @@ def send_private():
         to_user = data['to_user']
         message_text = data['message']
         
-        # Cria ID único da conversa (sempre na mesma ordem alfabética)
-        users_sorted = sorted([from_user.lower(), to_user.lower()])
-        conversation_id = f"{users_sorted[0]}_{users_sorted[1]}"
-        
-        # Carrega mensagens da conversa
-        conv_file = f'data/private_{conversation_id}.json'
-        if os.path.exists(conv_file):
-            with open(conv_file, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
-        else:
-            messages = []
-        
-        # Adiciona nova mensagem
+        # Adiciona nova mensagem (cache em memória + log em disco)
         message = {
             'from': from_user,
             'to': to_user,
@@ -374,11 +640,7 @@ def send_private():
             'timestamp': datetime.now().strftime('%H:%M:%S'),
             'date': datetime.now().strftime('%Y-%m-%d')
         }
-        messages.append(message)
-        
-        # Salva mensagens
-        with open(conv_file, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, indent=4, ensure_ascii=False)
+        add_private_message(from_user, to_user, message)
         
         return jsonify({'status': 'success'})
     except Exception as e:
@@ -387,7 +649,11 @@ def send_private():
 
 @app.route('/messages-private/<target_user>')
 def get_private_messages(target_user):
-    """Retorna mensagens privadas entre o usuário atual e outro usuário."""
+    """Retorna mensagens privadas entre o usuário atual e outro usuário.
+    
+    Aceita ?after=<id> para retornar só as mensagens novas e
+    ?format=compact, como /messages.
+    """
     # Verifica autenticação
     if 'username' not in session:
         return jsonify({'error': 'Não autenticado'}), 401
@@ -395,124 +661,211 @@ def get_private_messages(target_user):
     try:
         current_user = session['username']
         
-        # Cria ID único da conversa
-        users_sorted = sorted([current_user.lower(), target_user.lower()])
-        conversation_id = f"{users_sorted[0]}_{users_sorted[1]}"
+        conversation_id = private_cache.conversation_id_for(current_user, target_user)
         
-        # Carrega mensagens
-        conv_file = f'data/private_{conversation_id}.json'
-        if os.path.exists(conv_file):
-            with open(conv_file, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
-            return jsonify(messages)
-        else:
-            return jsonify([])
+        # Versão da conversa + usuário (a URL é a mesma para os dois lados)
+        etag = version_etag('private', current_user, notifier.version(f'conversation:{conversation_id}'))
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        
+        after_id = request.args.get('after', type=int)
+        messages = storage.private_messages(conversation_id, after_id)
+        # Quem buscou a conversa leu até a última mensagem
+        read_id = messages[-1]['id'] if messages else (after_id or 0)
+        if read_id and storage.mark_conversation_read(current_user, conversation_id, read_id):
+            notifier.notify(f'conversations:{current_user.lower()}')
+        return with_etag(messages_response(messages), etag)
     except Exception as e:
         print(f"Erro ao buscar mensagens privadas: {e}")
         return jsonify([])
 
+@app.route('/conversations')
+def list_conversations():
+    """Conversas privadas do usuário atual, da mais recente para a mais
+    antiga, com o ID da última mensagem e quantas ainda não foram lidas.
+    
+    O cliente consulta só esta rota e busca as mensagens apenas das
+    conversas cujo last_message_id mudou.
+    """
+    # Verifica autenticação
+    if 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Não autenticado'}), 401
+    
+    try:
+        username = session['username']
+        # Muda com cada mensagem privada do usuário e com cada leitura dele
+        etag = version_etag('conversations', username,
+                            notifier.version(f'private:{username.lower()}'),
+                            notifier.version(f'conversations:{username.lower()}'))
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        
+        conversations = storage.conversations(username)
+        return with_etag(jsonify({
+            'status': 'success',
+            'conversations': conversations,
+            'unread_total': sum(conversation['unread'] for conversation in conversations)
+        }), etag)
+    except Exception as e:
+        print(f"Erro ao listar conversas: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 def allowed_file(filename):
     """Verifica se a extensão do arquivo é permitida."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Folga para os cabeçalhos e campos de texto de um upload multipart
+MULTIPART_OVERHEAD = 64 * 1024
+# Maior corpo aceito em qualquer rota: a imagem em base64 (4/3 do tamanho)
+# mais a folga. O Werkzeug aplica o limite enquanto lê o corpo, então vale
+# também para uploads sem Content-Length (Transfer-Encoding: chunked)
+MAX_REQUEST_SIZE = MAX_FILE_SIZE * 4 // 3 + MULTIPART_OVERHEAD
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_SIZE
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({'status': 'error', 'message': 'Requisição muito grande'}), 413
+
+def form_bool(value):
+    """Converte booleanos vindos de JSON (bool) ou de formulário ('true')."""
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() == 'true'
+
 @app.route('/upload-image', methods=['POST'])
 def upload_image():
-    """Endpoint para upload de imagens (paste ou arquivo)."""
+    """Endpoint para upload de imagens (paste ou arquivo).
+    
+    Aceita dois formatos:
+    - multipart/form-data com o arquivo no campo 'image', gravado em disco
+      em blocos e com o limite de tamanho verificado durante a leitura;
+    - JSON com 'image_data' em base64 (formato antigo).
+    Os demais campos (room_id, is_private, target_user, tags e
+    is_private_gallery) vêm junto, no formulário ou no JSON.
+    """
     if 'username' not in session:
         return jsonify({'status': 'error', 'message': 'Não autenticado'}), 401
     
     try:
-        # Verifica se é paste (base64) ou upload de arquivo
-        if 'image_data' in request.json:
+        if request.mimetype == 'multipart/form-data':
+            # Upload de arquivo (streaming)
+            if request.content_length and request.content_length > MAX_FILE_SIZE + MULTIPART_OVERHEAD:
+                return jsonify({'status': 'error', 'message': 'Imagem maior que o tamanho máximo'}), 413
+            
+            image = request.files.get('image')
+            if image is None:
+                return jsonify({'status': 'error', 'message': 'Nenhuma imagem fornecida'}), 400
+            
+            params = request.form
+            filename = uploads.save_upload_stream(image.stream)
+        else:
             # Paste de clipboard (base64)
-            image_data = request.json['image_data']
-            room_id = request.json.get('room_id', 'geral')
-            is_private_msg = request.json.get('is_private', False)
-            target_user = request.json.get('target_user', None)
-            tags = request.json.get('tags', '')  # Tags do meme
-            is_private_gallery = request.json.get('is_private_gallery', False)  # Private na galeria
+            params = request.get_json(silent=True) or {}
+            if 'image_data' not in params:
+                return jsonify({'status': 'error', 'message': 'Nenhuma imagem fornecida'}), 400
+            
+            image_data = params['image_data']
             
             # Remove o prefixo data:image/...;base64,
             if 'base64,' in image_data:
                 image_data = image_data.split('base64,')[1]
             
-            # Decodifica e salva
-            image_bytes = base64.b64decode(image_data)
-            
-            # Gera nome único
-            filename = f"{uuid.uuid4()}.png"
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
+            # Rejeita antes de decodificar (base64 ocupa 4/3 do tamanho)
+            if len(image_data) * 3 // 4 > MAX_FILE_SIZE + 3:
+                return jsonify({'status': 'error', 'message': 'Imagem maior que o tamanho máximo'}), 413
             
-            with open(filepath, 'wb') as f:
-                f.write(image_bytes)
-            
-            # Adiciona à galeria
-            gallery = load_gallery()
-            meme_entry = {
-                'filename': filename,
-                'uploaded_by': session['username'],
-                'uploaded_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'tags': [tag.strip().lower() for tag in tags.split(',') if tag.strip()],
-                'is_private': is_private_gallery,
-                'room_id': room_id if not is_private_msg else None,
-                'target_user': target_user if is_private_msg else None
-            }
-            gallery.append(meme_entry)
-            save_gallery(gallery)
-            
-            # Cria mensagem com imagem
-            message = {
-                'user': session['username'],
-                'message': f'[IMAGE:{filename}]',
-                'timestamp': datetime.now().strftime('%H:%M:%S'),
-                'type': 'image'
-            }
-            
-            # Salva mensagem
-            if is_private_msg and target_user:
-                # Mensagem privada
-                current_user = session['username']
-                users_sorted = sorted([current_user.lower(), target_user.lower()])
-                conversation_id = f"{users_sorted[0]}_{users_sorted[1]}"
-                conv_file = f'data/private_{conversation_id}.json'
-                
-                if os.path.exists(conv_file):
-                    with open(conv_file, 'r', encoding='utf-8') as f:
-                        messages = json.load(f)
-                else:
-                    messages = []
-                
-                message['from'] = current_user
-                message['to'] = target_user
-                message['date'] = datetime.now().strftime('%Y-%m-%d')
-                messages.append(message)
-                
-                with open(conv_file, 'w', encoding='utf-8') as f:
-                    json.dump(messages, f, indent=4, ensure_ascii=False)
-            else:
-                # Mensagem pública
-                if room_id not in room_messages:
-                    room_messages[room_id] = []
-                
-                room_messages[room_id].append(message)
-                save_messages(room_messages[room_id], f'chat_{room_id}.json')
+            # Decodifica e salva com a extensão do formato real
+            filename = uploads.save_upload_bytes(base64.b64decode(image_data))
+        
+        room_id = params.get('room_id', 'geral')
+        is_private_msg = form_bool(params.get('is_private', False))
+        target_user = params.get('target_user') or None
+        tags = params.get('tags', '')  # Tags do meme
+        is_private_gallery = form_bool(params.get('is_private_gallery', False))  # Private na galeria
+        if not is_private_msg and room_id not in room_ids:
+            return jsonify({'status': 'error', 'message': 'Sala não encontrada'}), 404
+        
+        # Adiciona à galeria (índice em memória + log em disco). Se a mesma
+        # imagem já está lá, só as tags novas são somadas à entrada existente
+        meme_entry = {
+            'filename': filename,
+            'uploaded_by': session['username'],
+            'uploaded_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'tags': [tag.strip().lower() for tag in tags.split(',') if tag.strip()],
+            'is_private': is_private_gallery,
+            'room_id': room_id if not is_private_msg else None,
+            'target_user': target_user if is_private_msg else None
+        }
+        _, created = storage.add_meme(meme_entry)
+        if created:
+            storage.add_upload_reference(filename)
+        
+        # Miniatura gerada em segundo plano (a requisição não espera)
+        thumbnails.schedule_thumbnail(filename)
+        notifier.notify('gallery')
+        
+        # Cria mensagem com imagem
+        message = {
+            'user': session['username'],
+            'message': f'[IMAGE:{filename}]',
+            'timestamp': datetime.now().strftime('%H:%M:%S'),
+            'date': datetime.now().strftime('%Y-%m-%d'),
+            'type': 'image'
+        }
+        
+        # Salva mensagem
+        if is_private_msg and target_user:
+            # Mensagem privada
+            current_user = session['username']
             
-            return jsonify({'status': 'success', 'filename': filename})
+            message['from'] = current_user
+            message['to'] = target_user
+            message['date'] = datetime.now().strftime('%Y-%m-%d')
+            add_private_message(current_user, target_user, message, search_extra=tags)
         else:
-            return jsonify({'status': 'error', 'message': 'Nenhuma imagem fornecida'}), 400
-            
+            # Mensagem pública
+            add_room_message(room_id, message, search_extra=tags)
+        
+        return jsonify({'status': 'success', 'filename': filename})
+    except uploads.UploadTooLarge as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 413
+    except RequestEntityTooLarge:
+        # Corpo passou de MAX_REQUEST_SIZE durante a leitura (ex: chunked)
+        return jsonify({'status': 'error', 'message': 'Imagem maior que o tamanho máximo'}), 413
+    except uploads.UploadError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
         print(f"Erro ao fazer upload de imagem: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    """Serve arquivos de upload."""
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    """Serve arquivos de upload com cache longo (os arquivos nunca mudam).
+    
+    Com ?size=thumb serve a miniatura WebP, se ela já existir; caso
+    contrário agenda sua geração e serve o original.
+    """
+    if request.args.get('size') == 'thumb':
+        if os.path.exists(thumbnails.thumbnail_path(filename)):
+            response = send_from_directory(thumbnails.THUMB_FOLDER, thumbnails.thumbnail_name(filename))
+            response.headers['Cache-Control'] = UPLOAD_CACHE_CONTROL
+            return response
+        if os.path.exists(os.path.join(UPLOAD_FOLDER, filename)):
+            thumbnails.schedule_thumbnail(filename)
+        # Original no lugar da miniatura: cache curto, para pegar a miniatura depois
+        response = send_from_directory(UPLOAD_FOLDER, filename)
+        response.headers['Cache-Control'] = 'public, max-age=60'
+        return response
+    
+    response = send_from_directory(UPLOAD_FOLDER, filename)
+    response.headers['Cache-Control'] = UPLOAD_CACHE_CONTROL
+    return response
 
 @app.route('/gallery', methods=['GET'])
 def get_gallery():
-    """Retorna memes da galeria filtrados por tags e privacidade."""
+    """Retorna memes da galeria filtrados por tags (ou prefixo) e privacidade."""
     if 'username' not in session:
         return jsonify({'status': 'error', 'message': 'Não autenticado'}), 401
     
@@ -522,34 +875,218 @@ def get_gallery():
     is_private_chat = request.args.get('is_private', 'false') == 'true'
     target_user = request.args.get('target_user', '')
     
-    gallery = load_gallery()
-    filtered_memes = []
-    
-    for meme in gallery:
-        # Verifica privacidade
-        if meme.get('is_private', False):
-            # Meme privado - só mostra se foi upado pelo usuário atual ou na conversa atual
-            if meme.get('uploaded_by') != current_user:
-                # Se não foi upado pelo user, verifica se está na conversa privada correta
-                if is_private_chat:
-                    meme_target = meme.get('target_user', '')
-                    if not (meme_target == target_user or meme_target == current_user):
-                        continue
-                else:
-                    continue
-        
-        # Filtra por tags se fornecido
-        if search_tags:
-            search_list = [tag.strip() for tag in search_tags.split(',') if tag.strip()]
-            meme_tags = meme.get('tags', [])
-            
-            # Verifica se alguma tag bate
-            if not any(search_tag in meme_tags for search_tag in search_list):
+    # A galeria só muda com uploads: versão global + usuário
+    etag = version_etag('gallery', current_user, notifier.version('gallery'))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
+    # Paginação opcional: ?limit=N&offset=M
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(limit, 1)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    
+    memes, total = storage.search_memes(
+        current_user,
+        tags=search_tags,
+        is_private_chat=is_private_chat,
+        target_user=target_user,
+        limit=limit,
+        offset=offset
+    )
+    
+    response = {'status': 'success', 'memes': memes, 'total': total}
+    if limit is not None and offset + limit < total:
+        response['next_offset'] = offset + limit
+    return with_etag(jsonify(response), etag)
+
+# Tamanho padrão e máximo de uma página de resultados da busca
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+@app.route('/search')
+def search_messages():
+    """Busca textual nas mensagens, das mais recentes para as mais antigas.
+    
+    - q: termos (todos precisam aparecer; sem diferenciar acentos)
+    - room_id: busca só nessa sala (única forma de buscar em salas ocultas)
+    - with: busca só na conversa privada com esse usuário
+    - limit/offset: paginação
+    Sem room_id nem with, busca nas salas públicas e nas conversas privadas
+    do usuário.
+    """
+    if 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Não autenticado'}), 401
+    
+    try:
+        query = request.args.get('q', '').strip()
+        current_user = session['username']
+        room_id = request.args.get('room_id')
+        with_user = request.args.get('with')
+        limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), SEARCH_MAX_PAGE_SIZE)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        
+        user = None
+        if with_user:
+            scopes = [f'private:{private_cache.conversation_id_for(current_user, with_user)}']
+        elif room_id:
+            scopes = [f'room:{room_id}']
+        else:
+            # Salas ocultas ficam de fora: só aparecem buscando nelas
+            scopes = [f"room:{room['id']}" for room in rooms if not room.get('hidden')]
+            user = current_user
+        
+        matches, total = storage.search_messages(query, scopes, user, limit, offset)
+        
+        results = []
+        for scope, message_id in matches:
+            kind, key = scope.split(':', 1)
+            # O conteúdo vem do histórico (busca pelo ID no índice da sala/conversa)
+            if kind == 'room':
+                page = storage.room_history(key, message_id + 1, 1)
+            else:
+                page = storage.private_history(key, message_id + 1, 1)
+            if not page or page[0]['id'] != message_id:
                 continue
+            message = page[0]
+            if kind == 'room':
+                results.append({'room_id': key, 'message': message})
+            else:
+                other = message.get('to') if message.get('from', '').lower() == current_user.lower() else message.get('from')
+                results.append({'with': other, 'message': message})
         
-        filtered_memes.append(meme)
+        response = {'status': 'success', 'results': results, 'total': total}
+        if offset + limit < total:
+            response['next_offset'] = offset + limit
+        return jsonify(response)
+    except Exception as e:
+        print(f"Erro ao buscar mensagens: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def search_documents(store):
+    """Todas as mensagens de ``store`` no formato de ``rebuild_search``.
+    
+    Imagens são indexadas pelas tags que têm na galeria.
+    """
+    tags_by_file = {}
+    for meme in store.all_memes():
+        tags_by_file.setdefault(meme['filename'], []).extend(meme.get('tags', []))
+    
+    def image_tags(message):
+        filename = uploads.image_reference(message.get('message'))
+        return ' '.join(tags_by_file.get(filename, [])) if filename else ''
+    
+    for room in rooms:
+        for message in store.all_room_messages(room['id']):
+            yield f"room:{room['id']}", message, None, image_tags(message)
+    for conversation_id in store.conversation_ids():
+        for message in store.private_messages(conversation_id):
+            participants = (message.get('from', '').lower(), message.get('to', '').lower())
+            yield f'private:{conversation_id}', message, participants, image_tags(message)
+
+def ensure_server_stopped():
+    """Recusa regravar os históricos JSON com o servidor no ar.
     
-    return jsonify({'status': 'success', 'memes': filtered_memes})
+    Os locks dos arquivos e o estado dos logs (``message_log``) são de cada
+    processo: um comando que reescreve um snapshot e zera o log perderia
+    as mensagens que o servidor gravasse no meio. Com SQLite não há risco.
+    """
+    if not storage.shared and write_behind.owned_elsewhere():
+        raise click.ClickException(
+            'O servidor está rodando (journal em uso em data/journal): '
+            'pare-o antes deste comando. O arquivamento automático continua no servidor.'
+        )
+
+@app.cli.command('archive-rooms')
+def archive_rooms():
+    """Arquiva agora o que passou da janela quente e aplica os prazos."""
+    ensure_server_stopped()
+    for room in rooms:
+        archived, removed = retention.compact_room(storage, room['id'])
+        print(f"{room['id']}: {archived} arquivada(s), {removed} apagada(s) pelo prazo")
+
+@app.cli.command('reindex-search')
+def reindex_search():
+    """Recria o índice da busca a partir dos históricos."""
+    ensure_server_stopped()
+    count = storage.rebuild_search(search_documents(storage))
+    print(f"{count} mensagem(ns) indexada(s)")
+
+@app.route('/metrics')
+def get_metrics():
+    """Métricas no formato texto do Prometheus (apenas acesso local)."""
+    # Pelo ngrok as requisições também chegam de 127.0.0.1, mas com X-Forwarded-For
+    if request.remote_addr not in ('127.0.0.1', '::1') or 'X-Forwarded-For' in request.headers:
+        return jsonify({'status': 'error', 'message': 'Acesso negado'}), 403
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.cli.command('gc-uploads')
+@click.option('--recount/--no-recount', default=True,
+              help='Recalcula as referências lendo todos os históricos (padrão) '
+                   'ou usa as contagens guardadas.')
+def gc_uploads(recount):
+    """Apaga os uploads que nenhuma mensagem ou meme referencia.
+    
+    Por padrão as referências são recontadas lendo todos os históricos.
+    Com ``--no-recount`` valem as contagens mantidas a cada envio (e
+    descontadas quando o prazo da sala apaga mensagens); se elas nunca
+    foram montadas, a recontagem é feita assim mesmo. Um arquivo sem
+    contagem nunca é apagado.
+    """
+    def references():
+        for meme in storage.all_memes():
+            yield meme['filename']
+        # Históricos completos das salas e conversas privadas
+        for msg in storage.all_messages():
+            filename = uploads.image_reference(msg.get('message'))
+            if filename:
+                yield filename
+    
+    if not recount and not storage.upload_references_built():
+        print("Contagens de referências ainda não montadas: recontando")
+        recount = True
+    if recount:
+        ensure_server_stopped()
+        # Lista os arquivos antes da varredura: um upload novo que não
+        # aparecer nos históricos fica sem contagem (e é mantido)
+        known = uploads.stored_files()
+        storage.rebuild_upload_references(references(), known)
+    removed = uploads.collect_garbage(count_references=storage.upload_reference_count)
+    for filename in removed:
+        thumbnails.remove_thumbnail(filename)
+    print(f"{len(removed)} arquivo(s) removido(s)")
+    for filename in removed:
+        print(f"  - {filename}")
+
+@app.cli.command('import-sqlite')
+def import_sqlite():
+    """Importa os dados JSON de data/ para o banco SQLite."""
+    from sqlite_storage import SqliteStorage
+    from storage import SQLITE_PATH
+    target = SqliteStorage(SQLITE_PATH)
+    summary = target.import_json(uploads.image_reference)
+    summary['search'] = target.rebuild_search(search_documents(target))
+    summary['conversations'] = target.rebuild_conversations()
+    print(f"Importado para {SQLITE_PATH}:")
+    for kind, count in summary.items():
+        print(f"  - {kind}: {count}")
+
+@app.cli.command('reindex-conversations')
+def reindex_conversations():
+    """Recria o índice de conversas privadas a partir dos históricos."""
+    ensure_server_stopped()
+    count = storage.rebuild_conversations()
+    print(f"{count} conversa(s) indexada(s)")
+
+@app.cli.command('backfill-thumbs')
+def backfill_thumbs():
+    """Gera as miniaturas que faltam para os uploads existentes."""
+    if not thumbnails.thumbnails_enabled():
+        print("Pillow não está instalado: pip install pillow")
+        return
+    created = thumbnails.backfill()
+    print(f"{created} miniatura(s) gerada(s)")
 
 @app.route('/sewage')
 def sewage():
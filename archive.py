@@ -0,0 +1,273 @@
+"""Arquivo morto das salas: segmentos comprimidos, particionados por data.
+
+Quando uma sala passa da sua janela "quente" (as mensagens mais recentes,
+mantidas em memória/no histórico ativo), as mensagens mais antigas são
+movidas para ``data/archive/<sala>/<data>-<primeiro id>.jsonl.gz``: uma
+mensagem JSON por linha, em gzip, um segmento por dia de mensagens. Um
+arquivamento do mesmo dia que o último segmento o regrava com as mensagens
+novas no final (até ``SEGMENT_MAX_MESSAGES``), para não acumular arquivos
+pequenos; a troca é atômica (arquivo temporário + rename).
+
+O ``index.json`` de cada sala lista os segmentos (data, primeiro e último
+ID, quantidade), em ordem de ID. Com ele, buscar uma página do histórico no
+arquivo só descomprime os segmentos que contêm aquela faixa de IDs; os
+segmentos lidos por último ficam num pequeno cache.
+
+A retenção (``days``) apaga segmentos inteiros cuja data passou do prazo.
+
+O arquivamento de uma sala é serializado entre processos por um lock de
+arquivo (``fcntl``, quando disponível), então pode ser disparado por mais
+de um processo servidor.
+"""
+import bisect
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows: um único processo servidor, o lock de thread basta
+    fcntl = None
+
+from message_log import DATA_DIR
+
+ARCHIVE_DIR = os.path.join(DATA_DIR, 'archive')
+INDEX_FILENAME = 'index.json'
+SEGMENT_MAX_MESSAGES = 5000
+SEGMENT_CACHE_SIZE = 8  # Segmentos descomprimidos mantidos em memória
+
+# (caminho, quantidade) -> lista de mensagens. A quantidade faz parte da
+# chave: um segmento regravado com mais mensagens nunca é lido do cache antigo
+_segment_cache = OrderedDict()
+_manifests = {}  # sala -> (assinatura do index.json, segmentos)
+_lock = threading.RLock()
+
+
+def _room_dir(room_id):
+    return os.path.join(ARCHIVE_DIR, room_id)
+
+
+def _index_path(room_id):
+    return os.path.join(_room_dir(room_id), INDEX_FILENAME)
+
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except FileNotFoundError:
+        return None
+
+
+def segments(room_id):
+    """Segmentos da sala em ordem de ID: [{'file', 'date', 'first_id', 'last_id', 'count'}]."""
+    path = _index_path(room_id)
+    signature = _signature(path)
+    cached = _manifests.get(room_id)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    if signature is None:
+        entries = []
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)['segments']
+    _manifests[room_id] = (signature, entries)
+    return entries
+
+
+def _write_index(room_id, entries):
+    path = _index_path(room_id)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'segments': entries}, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class _ArchiveLock:
+    """Lock de arquivamento de uma sala (threads e, com fcntl, processos)."""
+
+    def __init__(self, room_id):
+        self.path = os.path.join(_room_dir(room_id), '.lock')
+
+    def __enter__(self):
+        _lock.acquire()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        _lock.release()
+
+
+def last_archived_id(room_id):
+    entries = segments(room_id)
+    return entries[-1]['last_id'] if entries else 0
+
+
+def archived_count(room_id):
+    return sum(entry['count'] for entry in segments(room_id))
+
+
+def _message_date(message, default):
+    """Data da mensagem (YYYY-MM-DD); mensagens antigas não têm data."""
+    value = message.get('date')
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date().isoformat()
+    except (TypeError, ValueError):
+        return default
+
+
+def write_segments(room_id, messages):
+    """Grava as mensagens (em ordem de ID) em segmentos novos.
+
+    Mensagens já arquivadas (ID até o último arquivado) são ignoradas, então
+    repetir um arquivamento interrompido não duplica nada. Retorna o maior
+    ID arquivado.
+    """
+    with _ArchiveLock(room_id):
+        entries = list(segments(room_id))
+        last_id = entries[-1]['last_id'] if entries else 0
+        pending = [message for message in messages if message['id'] > last_id]
+        if not pending:
+            return last_id
+
+        # Agrupa por data, mantendo a ordem de ID dentro de cada grupo
+        today = date.today().isoformat()
+        groups = OrderedDict()
+        for message in pending:
+            groups.setdefault(_message_date(message, today), []).append(message)
+
+        for day, group in sorted(groups.items(), key=lambda item: item[1][0]['id']):
+            last = entries[-1] if entries else None
+            if last and last['date'] == day and last['count'] + len(group) <= SEGMENT_MAX_MESSAGES:
+                # Continua o segmento do mesmo dia
+                group = _read_segment(room_id, last) + group
+                entries.pop()
+            filename = f"{day}-{group[0]['id']}.jsonl.gz"
+            path = os.path.join(_room_dir(room_id), filename)
+            with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+                for message in group:
+                    f.write(json.dumps(message, ensure_ascii=False) + '\n')
+            os.replace(path + '.tmp', path)
+            entries.append({
+                'file': filename,
+                'date': day,
+                'first_id': group[0]['id'],
+                'last_id': group[-1]['id'],
+                'count': len(group)
+            })
+
+        # Segmentos de datas diferentes podem intercalar IDs: ordena pelo início
+        entries.sort(key=lambda entry: entry['first_id'])
+        _write_index(room_id, entries)
+        return pending[-1]['id']
+
+
+def _read_segment(room_id, entry):
+    path = os.path.join(_room_dir(room_id), entry['file'])
+    key = (path, entry['count'])
+    with _lock:
+        messages = _segment_cache.get(key)
+        if messages is not None:
+            _segment_cache.move_to_end(key)
+            return messages
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        messages = [json.loads(line) for line in f if line.strip()]
+    # Lido antes de uma regravação: o arquivo novo tem mais mensagens
+    messages = messages[:entry['count']]
+    with _lock:
+        _segment_cache[key] = messages
+        while len(_segment_cache) > SEGMENT_CACHE_SIZE:
+            _segment_cache.popitem(last=False)
+    return messages
+
+
+def read_before(room_id, before_id=None, limit=50):
+    """Até ``limit`` mensagens arquivadas com ID menor que before_id (as mais
+    recentes delas, em ordem crescente).
+    """
+    entries = segments(room_id)
+    if not entries or limit <= 0:
+        return []
+    if before_id is None:
+        before_id = entries[-1]['last_id'] + 1
+
+    # Segmentos que começam antes de before_id, do mais novo para o mais antigo
+    starts = [entry['first_id'] for entry in entries]
+    candidates = entries[:bisect.bisect_left(starts, before_id)]
+    found = []
+    for entry in reversed(candidates):
+        try:
+            messages = _read_segment(room_id, entry)
+        except FileNotFoundError:
+            continue  # Apagado pela retenção enquanto líamos o índice
+        found.extend(message for message in messages if message['id'] < before_id)
+        # Segmentos de datas diferentes podem intercalar: só para quando nenhum
+        # segmento anterior pode ter IDs maiores que os já encontrados
+        if len(found) >= limit:
+            found.sort(key=lambda message: message['id'])
+            lowest = found[-limit]['id']
+            if all(other['last_id'] < lowest for other in candidates[:candidates.index(entry)]):
+                break
+    found.sort(key=lambda message: message['id'])
+    return found[-limit:]
+
+
+def iter_messages(room_id):
+    """Todas as mensagens arquivadas da sala, em ordem de ID."""
+    messages = []
+    for entry in segments(room_id):
+        try:
+            messages.extend(_read_segment(room_id, entry))
+        except FileNotFoundError:
+            continue
+    messages.sort(key=lambda message: message['id'])
+    return messages
+
+
+def archived_rooms():
+    try:
+        return sorted(name for name in os.listdir(ARCHIVE_DIR)
+                      if os.path.isdir(os.path.join(ARCHIVE_DIR, name)))
+    except FileNotFoundError:
+        return []
+
+
+def apply_retention(room_id, days, on_expired=None):
+    """Apaga os segmentos com data anterior a ``days`` dias atrás.
+
+    ``on_expired(mensagens)`` é chamada com as mensagens de cada segmento
+    antes de apagá-lo (ex: para descontar as referências aos uploads).
+    Retorna o número de mensagens removidas.
+    """
+    cutoff = (date.today() - timedelta(days=days)).isoformat()
+    with _ArchiveLock(room_id):
+        entries = segments(room_id)
+        expired = [entry for entry in entries if entry['date'] < cutoff]
+        if not expired:
+            return 0
+        _write_index(room_id, [entry for entry in entries if entry['date'] >= cutoff])
+        for entry in expired:
+            path = os.path.join(_room_dir(room_id), entry['file'])
+            if on_expired is not None:
+                try:
+                    on_expired(_read_segment(room_id, entry))
+                except FileNotFoundError:
+                    pass
+            with _lock:
+                _segment_cache.pop((path, entry['count']), None)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return sum(entry['count'] for entry in expired)
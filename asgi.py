@@ -0,0 +1,301 @@
+"""Ponto de entrada ASGI (asyncio) para muitas conexões abertas.
+
+O ``python app.py`` usa o servidor de desenvolvimento do Werkzeug, com uma
+thread por requisição: cada aba com o push (``/events``) aberto prende uma
+thread. Aqui o ``/events`` é servido direto no event loop: cada conexão é
+só uma corrotina esperando um ``asyncio.Event``, acordada pelo ``notifier``
+(com ``loop.call_soon_threadsafe``) quando um dos seus canais muda. Milhares
+de abas paradas cabem num processo, com alguns KB por conexão.
+
+Todas as outras rotas (``/send``, ``/messages``, ``/typing``,
+``/send-private``, ``/messages-private/<usuário>``, ``/upload-image``,
+``/gallery``...) continuam sendo o app Flask, chamado num pool de threads
+(``CHAT_ASGI_THREADS``): a leitura e gravação dos arquivos nunca bloqueia o
+event loop, e as rotas, hooks, limites e métricas são os mesmos.
+
+Uso (requer um servidor ASGI, ex: ``pip install uvicorn``)::
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+ou ``python asgi.py``. Rode um único processo com o backend JSON; com
+``CHAT_STORAGE=sqlite`` podem ser vários (``--workers``).
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app as chat_app
+import metrics
+import notifier
+import presence
+import write_behind
+
+THREADS = int(os.environ.get('CHAT_ASGI_THREADS', 32))
+# Corpo máximo aceito (o mesmo limite do app)
+MAX_BODY_SIZE = chat_app.MAX_REQUEST_SIZE
+# Corpos maiores que isso vão para um arquivo temporário, e não para a
+# memória (uploads de vários MB em paralelo)
+BODY_SPOOL_SIZE = 256 * 1024
+
+flask_app = chat_app.app
+_executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix='asgi')
+
+
+async def _in_thread(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, function, *args)
+
+
+async def _shared_io(function, *args):
+    """Roda no pool só se tocar o armazenamento compartilhado (SQLite)."""
+    if chat_app.storage.shared:
+        return await _in_thread(function, *args)
+    return function(*args)
+
+
+class _LoopWaiter:
+    """Inscrito do notifier que acorda uma corrotina (de qualquer thread)."""
+
+    __slots__ = ('loop', 'event')
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            pass  # Loop já encerrado
+
+
+# ========== WSGI (Flask) NUM POOL DE THREADS ==========
+
+def _environ(scope, body=None, length=0):
+    """Monta o environ WSGI de uma requisição ASGI (``body``: arquivo com o corpo)."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body if body is not None else io.BytesIO(),
+        'CONTENT_LENGTH': str(length),  # O corpo já foi lido inteiro (mesmo se veio em chunks)
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            continue
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def _call_wsgi(environ):
+    """Executa o app Flask (numa thread do pool). Retorna (status, cabeçalhos, corpo)."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+        return chunks.append
+
+    chunks = []
+    result = flask_app(environ, start_response)
+    try:
+        for chunk in result:
+            chunks.append(chunk)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], b''.join(chunks)
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+async def _read_body(receive):
+    """Lê o corpo inteiro para um arquivo temporário (em memória até
+    ``BODY_SPOOL_SIZE``). Retorna (arquivo, tamanho), ou (None, 0) se o
+    cliente desconectou.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_SIZE)
+    size = 0
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None, 0
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > MAX_BODY_SIZE:
+                raise _BodyTooLarge()
+            body.write(chunk)
+            if not message.get('more_body'):
+                body.seek(0)
+                return body, size
+    except BaseException:
+        body.close()
+        raise
+
+
+async def _send_response(send, status, headers, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_json(send, status, payload):
+    await _send_response(send, status, [('Content-Type', 'application/json')], json.dumps(payload).encode())
+
+
+async def _wsgi(scope, receive, send):
+    try:
+        body, length = await _read_body(receive)
+    except _BodyTooLarge:
+        await _send_json(send, 413, {'status': 'error', 'message': 'Requisição muito grande'})
+        return
+    if body is None:
+        return
+    with body:
+        status, headers, content = await _in_thread(_call_wsgi, _environ(scope, body, length))
+    await _send_response(send, status, headers, content)
+
+
+# ========== PUSH (SSE) NO EVENT LOOP ==========
+
+def _session_user(request):
+    """Usuário logado, lido do cookie de sessão do Flask (ou None)."""
+    session = flask_app.session_interface.open_session(flask_app, request)
+    return session.get('username') if session else None
+
+
+async def _watch_disconnect(receive, closed, waiter):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    closed.append(True)
+    waiter.event.set()
+
+
+async def _events(scope, receive, send):
+    """O mesmo stream do /events do app.py, sem prender uma thread."""
+    start = time.perf_counter()
+    request = flask_app.request_class(_environ(scope))
+    username = _session_user(request)
+    if not username:
+        await _send_json(send, 401, {'error': 'Não autenticado'})
+        metrics.inc('chat_requests_total', route='events', status=401)
+        return
+
+    room_id = request.args.get('room_id', 'geral')
+    channels = chat_app.event_channels(room_id, username)
+    loop = asyncio.get_running_loop()
+    waiter = notifier.subscribe(channels, _LoopWaiter(loop))
+    closed = []
+    watcher = asyncio.create_task(_watch_disconnect(receive, closed, waiter))
+    metrics.inc('chat_requests_total', route='events', status=200)
+    try:
+        seen = {channel: await _shared_io(notifier.version, channel) for channel in channels}
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                        (b'cache-control', b'no-cache'),
+                        (b'x-accel-buffering', b'no')],
+        })
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+        last_write = time.monotonic()
+        while not closed:
+            # Conexão aberta = usuário online (o keepalive renova antes
+            # de ONLINE_TTL vencer)
+            await _shared_io(presence.touch, room_id, username)
+            # Um timer em vez de wait_for: não cria uma task por espera
+            timer = loop.call_later(notifier.wait_timeout(chat_app.EVENTS_KEEPALIVE), waiter.event.set)
+            await waiter.event.wait()
+            timer.cancel()
+            waiter.event.clear()
+            if closed:
+                break
+            chunks = []
+            for channel, event_name in channels.items():
+                current = await _shared_io(notifier.version, channel)
+                if current != seen[channel]:
+                    seen[channel] = current
+                    chunks.append(f'event: {event_name}\ndata: {current}\n\n')
+            if not chunks and time.monotonic() - last_write >= chat_app.EVENTS_KEEPALIVE:
+                chunks.append(': keepalive\n\n')
+            if chunks:
+                last_write = time.monotonic()
+                await send({'type': 'http.response.body', 'body': ''.join(chunks).encode(), 'more_body': True})
+    except OSError:
+        pass  # Cliente desconectou no meio de um envio
+    finally:
+        notifier.unsubscribe(channels, waiter)
+        watcher.cancel()
+        metrics.observe('chat_request_duration_seconds', time.perf_counter() - start, route='events')
+
+
+# ========== APLICAÇÃO ASGI ==========
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Journal e threads de segundo plano (veja start_background_workers)
+            await _in_thread(chat_app.start_background_workers)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Grava as mensagens pendentes antes de o processo sair
+            await _in_thread(write_behind.flush_all)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    elif scope['type'] == 'http':
+        if not chat_app._workers['started']:
+            # Servidor sem lifespan: o /events não passa pelos hooks do Flask
+            await _in_thread(chat_app.start_background_workers)
+        if scope['path'] == '/events' and scope['method'] == 'GET':
+            await _events(scope, receive, send)
+        else:
+            await _wsgi(scope, receive, send)
+    elif scope['type'] == 'websocket':
+        await send({'type': 'websocket.close'})
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("Para usar o servidor asyncio, instale o uvicorn: pip install uvicorn")
+        sys.exit(1)
+    local_ip = chat_app.get_local_ip()
+    print(f"\nServidor (asyncio) rodando em: http://{local_ip}:5000\n")
+    uvicorn.run(app, host='0.0.0.0', port=5000, log_level='warning')
@@ -0,0 +1,396 @@
+"""Benchmark de carga: simula usuários usando o chat como o index.html.
+
+Cada usuário simulado, a cada segundo (simulado):
+
+- faz o polling da sala a cada 2s (``/room-state`` e, se houver mensagem
+  nova, ``/messages?after=``; com ``--pattern polling``, o padrão antigo:
+  ``/messages?after=`` a cada 2s e ``/typing`` a cada 3s);
+- de vez em quando digita e envia uma rajada de mensagens (``/typing`` +
+  ``/send``);
+- parte dos usuários mantém uma aba privada aberta (``/conversations`` a
+  cada 2s e ``/messages-private?after=`` quando a conversa muda; com
+  ``--pattern polling``, ``/messages-private`` a cada 2s) e envia mensagens
+  privadas;
+- de vez em quando cola uma imagem (``/upload-image``).
+
+Os ETags são reenviados como um navegador faria (``If-None-Match``). O tempo
+simulado corre o mais rápido possível: o resultado mede quanto o servidor
+aguenta, não o tempo real.
+
+Uso:
+    python benchmark.py --users 50 --duration 60
+    python benchmark.py --backend json sqlite --preload 20000
+    python benchmark.py --url http://127.0.0.1:5000 --users 20 --server-pid 1234
+
+Sem ``--url``, o app roda no próprio processo (Flask test client), num
+diretório temporário com dados novos. Com mais de um ``--backend``, cada um
+roda num subprocesso e o resultado é comparado no final.
+"""
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'bench1234'
+
+
+def make_png(seed):
+    """PNG 8x8 válido e único por seed (cada upload vira um arquivo novo)."""
+    rng = random.Random(seed)
+    raw = b''.join(b'\x00' + bytes(rng.randrange(256) for _ in range(8 * 3)) for _ in range(8))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', 8, 8, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw))
+            + chunk(b'IEND', b''))
+
+
+def multipart(fields, filename, content):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+        f'Content-Type: image/png\r\n\r\n'.encode() + content + b'\r\n'
+    )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def rss_bytes(pid=None):
+    """Memória residente do processo (Linux); sem /proc, o pico do processo atual."""
+    try:
+        with open(f'/proc/{pid or "self"}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        if pid:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# ========== SESSÕES (test client ou HTTP) ==========
+
+class TestClientSession:
+    """Usuário falando com o app no mesmo processo."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, content_type=None, headers=None):
+        response = self.client.open(path, method=method, data=body, content_type=content_type,
+                                    headers=headers or {})
+        return response.status_code, response.get_data(), response.headers.get('ETag')
+
+
+class HttpSession:
+    """Usuário falando com um servidor já rodando."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def request(self, method, path, body=None, content_type=None, headers=None):
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers or {})
+        if content_type:
+            req.add_header('Content-Type', content_type)
+        try:
+            with self.opener.open(req) as response:
+                return response.status, response.read(), response.headers.get('ETag')
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.headers.get('ETag')
+
+
+# ========== USUÁRIO SIMULADO ==========
+
+class SimulatedUser:
+    def __init__(self, session, name, room_id, peer, args, stats, samples):
+        self.session = session
+        self.name = name
+        self.room_id = room_id
+        self.peer = peer  # Usuário da aba privada aberta (ou None)
+        self.args = args
+        self.stats = stats  # rota -> [latências]
+        self.samples = samples  # Todas as latências, em ordem de chegada
+        self.rng = random.Random(name)
+        self.offset = self.rng.randrange(6)  # Espalha os polls entre os segundos
+        self.last_id = 0
+        self.last_private_id = 0
+        self.etags = {}
+
+    def call(self, route, method, path, payload=None, body=None, content_type=None):
+        headers = {}
+        if method == 'GET' and path in self.etags:
+            headers['If-None-Match'] = self.etags[path]
+        if payload is not None:
+            body, content_type = json.dumps(payload).encode(), 'application/json'
+        start = time.perf_counter()
+        status, data, etag = self.session.request(method, path, body, content_type, headers)
+        elapsed = time.perf_counter() - start
+        self.stats.setdefault(route, []).append(elapsed)
+        self.samples.append(elapsed)
+        if etag:
+            self.etags[path] = etag
+        if status == 200 and method == 'GET':
+            return json.loads(data)
+        return None
+
+    def login(self):
+        credentials = {'username': self.name, 'password': PASSWORD}
+        self.call('register', 'POST', '/register', credentials)
+        self.call('authenticate', 'POST', '/authenticate', credentials)
+
+    def poll_room(self):
+        room = self.room_id
+        if self.args.pattern == 'polling':
+            messages = self.call('messages', 'GET', f'/messages?room_id={room}&after={self.last_id}')
+            if messages:
+                self.last_id = messages[-1]['id']
+            return
+        state = self.call('room_state', 'GET', f'/room-state?room_id={room}')
+        if state and state['last_message_id'] > self.last_id:
+            path = (f'/messages?room_id={room}&after={self.last_id}&format=compact' if self.last_id
+                    else f'/messages?room_id={room}&limit=50&format=compact')
+            messages = self.call('messages', 'GET', path)
+            if messages and messages['count']:
+                self.last_id = messages['columns']['id'][-1]
+
+    def poll_private(self):
+        if self.args.pattern != 'polling':
+            summary = self.call('conversations', 'GET', '/conversations')
+            if not summary or not any(conversation['with'] == self.peer
+                                      and conversation['last_message_id'] > self.last_private_id
+                                      for conversation in summary['conversations']):
+                return
+        messages = self.call('private_messages', 'GET',
+                             f'/messages-private/{self.peer}?after={self.last_private_id}')
+        if messages:
+            self.last_private_id = messages[-1]['id']
+
+    def send_burst(self):
+        self.call('typing_post', 'POST', '/typing', {'user': self.name, 'room_id': self.room_id, 'is_typing': True})
+        for i in range(self.rng.randint(1, self.args.burst)):
+            self.call('send', 'POST', '/send', {'user': self.name, 'room_id': self.room_id,
+                                                'message': f'mensagem {i} de {self.name}'})
+        self.call('typing_post', 'POST', '/typing', {'user': self.name, 'room_id': self.room_id, 'is_typing': False})
+
+    def paste_image(self, seed):
+        body, content_type = multipart({'room_id': self.room_id, 'tags': 'bench'}, 'paste.png', make_png(seed))
+        self.call('upload_image', 'POST', '/upload-image', body=body, content_type=content_type)
+
+    def tick(self, second):
+        """Tudo o que o usuário faz neste segundo simulado."""
+        phase = second + self.offset
+        if phase % 2 == 0:
+            self.poll_room()
+            if self.peer:
+                self.poll_private()
+        if self.args.pattern == 'polling' and phase % 3 == 0:
+            self.call('typing_get', 'GET', f'/typing?room_id={self.room_id}&user={self.name}')
+        if self.rng.random() < self.args.send_rate:
+            self.send_burst()
+        if self.peer and self.rng.random() < self.args.send_rate / 2:
+            self.call('send_private', 'POST', '/send-private', {'to_user': self.peer, 'message': 'psiu'})
+        if self.rng.random() < self.args.image_rate:
+            self.paste_image(f'{self.name}-{second}')
+
+
+# ========== EXECUÇÃO ==========
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p * len(ordered)) - 1, 0)]
+
+
+def load_app(backend):
+    """Importa o app num diretório temporário, com dados novos."""
+    workdir = tempfile.mkdtemp(prefix='chat-bench-')
+    shutil.copy(os.path.join(REPO_DIR, 'rooms.json'), workdir)
+    os.chdir(workdir)
+    os.environ['CHAT_STORAGE'] = backend
+    os.environ.pop('CHAT_SQLITE_PATH', None)
+    # O limite de requisições usa o relógio real, e o tempo simulado corre
+    # muito mais rápido: desligado, salvo se pedido (CHAT_RATE_LIMIT=1)
+    os.environ.setdefault('CHAT_RATE_LIMIT', '0')
+    sys.path.insert(0, REPO_DIR)
+    import app as chat_app
+    return chat_app, workdir
+
+
+def preload(chat_app, rooms, count):
+    """Enche as salas com histórico antes de começar (direto no storage)."""
+    for i in range(count):
+        room_id = rooms[i % len(rooms)]
+        chat_app.storage.add_room_message(room_id, {
+            'user': 'preload', 'message': f'histórico {i}', 'timestamp': '00:00:00'
+        })
+
+
+def run(args):
+    workdir = None
+    if args.url:
+        make_session = lambda: HttpSession(args.url)
+        rooms = [room['id'] for room in json.load(open(os.path.join(REPO_DIR, 'rooms.json')))['rooms']
+                 if not room.get('hidden')]
+        memory = lambda: rss_bytes(args.server_pid) if args.server_pid else None
+    else:
+        chat_app, workdir = load_app(args.backend[0])
+        make_session = lambda: TestClientSession(chat_app.app)
+        rooms = [room['id'] for room in chat_app.rooms if not room.get('hidden')]
+        memory = rss_bytes
+        preload(chat_app, rooms, args.preload)
+
+    stats = {}
+    samples = []
+    names = [f'bench{uuid.uuid4().hex[:6]}{i}' for i in range(args.users)]
+    users = []
+    for i, name in enumerate(names):
+        # Um terço dos usuários tem uma conversa privada aberta com o vizinho
+        peer = names[(i + 1) % len(names)] if i % 3 == 0 and len(names) > 1 else None
+        users.append(SimulatedUser(make_session(), name, rooms[i % len(rooms)], peer, args, stats, samples))
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(SimulatedUser.login, users))
+        stats.clear()
+        samples.clear()
+
+        reports = []
+        total_requests = 0
+        started = time.perf_counter()
+        window_start = started
+        for second in range(args.duration):
+            list(pool.map(lambda user: user.tick(second), users))
+            if (second + 1) % args.report_every == 0 or second + 1 == args.duration:
+                # Latências só desta janela: mostra a degradação com o histórico
+                now = time.perf_counter()
+                window = samples[total_requests:]
+                report = {
+                    'second': second + 1,
+                    'history': args.preload + len(stats.get('send', [])),
+                    'requests': len(window),
+                    'throughput': len(window) / (now - window_start),
+                    'p50_ms': percentile(window, 0.50) * 1000,
+                    'p99_ms': percentile(window, 0.99) * 1000,
+                    'rss_mb': (memory() or 0) / 1024 / 1024,
+                }
+                reports.append(report)
+                total_requests += len(window)
+                window_start = now
+                if not args.json:
+                    print(f"t={report['second']:>4}s  histórico={report['history']:>7}  "
+                          f"req/s={report['throughput']:>8.1f}  p50={report['p50_ms']:>7.2f}ms  "
+                          f"p99={report['p99_ms']:>7.2f}ms  rss={report['rss_mb']:>7.1f}MB")
+        elapsed = time.perf_counter() - started
+
+    all_latencies = samples
+    result = {
+        'backend': 'http' if args.url else args.backend[0],
+        'users': args.users,
+        'requests': len(all_latencies),
+        'elapsed_s': elapsed,
+        'throughput': len(all_latencies) / elapsed if elapsed else 0,
+        'p50_ms': percentile(all_latencies, 0.50) * 1000,
+        'p99_ms': percentile(all_latencies, 0.99) * 1000,
+        'rss_mb': (memory() or 0) / 1024 / 1024,
+        'routes': {
+            route: {
+                'count': len(values),
+                'p50_ms': percentile(values, 0.50) * 1000,
+                'p99_ms': percentile(values, 0.99) * 1000,
+            }
+            for route, values in sorted(stats.items())
+        },
+        'reports': reports,
+    }
+    if workdir and not args.keep_data:
+        chat_app.thumbnails.shutdown()
+        chat_app.write_behind.flush_all()
+        chat_app.search_index.flush()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def print_result(result):
+    print(f"\n== {result['backend']}: {result['users']} usuários, {result['requests']} requisições "
+          f"em {result['elapsed_s']:.1f}s ==")
+    print(f"throughput={result['throughput']:.1f} req/s  p50={result['p50_ms']:.2f}ms  "
+          f"p99={result['p99_ms']:.2f}ms  rss={result['rss_mb']:.1f}MB")
+    print(f"{'rota':<18}{'reqs':>8}{'p50 (ms)':>11}{'p99 (ms)':>11}")
+    for route, route_stats in result['routes'].items():
+        print(f"{route:<18}{route_stats['count']:>8}{route_stats['p50_ms']:>11.2f}{route_stats['p99_ms']:>11.2f}")
+
+
+def compare(args):
+    """Roda cada backend num subprocesso (o app só pode ser importado uma vez)."""
+    results = []
+    for backend in args.backend:
+        command = [sys.executable, os.path.abspath(__file__), '--json', '--backend', backend]
+        for option in ('users', 'duration', 'concurrency', 'send_rate', 'burst', 'image_rate',
+                       'preload', 'report_every', 'pattern'):
+            command += [f'--{option.replace("_", "-")}', str(getattr(args, option))]
+        print(f"Rodando backend {backend}...", flush=True)
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    for result in results:
+        print_result(result)
+    print(f"\n{'backend':<10}{'req/s':>10}{'p50 (ms)':>11}{'p99 (ms)':>11}{'rss (MB)':>11}")
+    for result in results:
+        print(f"{result['backend']:<10}{result['throughput']:>10.1f}{result['p50_ms']:>11.2f}"
+              f"{result['p99_ms']:>11.2f}{result['rss_mb']:>11.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de carga do chat')
+    parser.add_argument('--users', type=int, default=20, help='usuários simulados')
+    parser.add_argument('--duration', type=int, default=30, help='segundos simulados')
+    parser.add_argument('--concurrency', type=int, default=8, help='requisições em paralelo')
+    parser.add_argument('--send-rate', type=float, default=0.05, help='chance de enviar mensagens a cada segundo')
+    parser.add_argument('--burst', type=int, default=3, help='máximo de mensagens por rajada')
+    parser.add_argument('--image-rate', type=float, default=0.005, help='chance de colar uma imagem a cada segundo')
+    parser.add_argument('--preload', type=int, default=0, help='mensagens no histórico antes de começar')
+    parser.add_argument('--report-every', type=int, default=10, help='intervalo dos relatórios parciais')
+    parser.add_argument('--pattern', choices=['room-state', 'polling'], default='room-state',
+                        help='room-state (cliente atual) ou polling (/messages + /typing)')
+    parser.add_argument('--backend', nargs='+', default=['json'], help='json, sqlite ou vários para comparar')
+    parser.add_argument('--url', help='usa um servidor já rodando em vez do test client')
+    parser.add_argument('--server-pid', type=int, help='PID do servidor (memória com --url)')
+    parser.add_argument('--keep-data', action='store_true', help='não apaga o diretório temporário')
+    parser.add_argument('--json', action='store_true', help='imprime o resultado em JSON')
+    args = parser.parse_args()
+
+    if len(args.backend) > 1 and not args.url:
+        compare(args)
+        return
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print_result(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Respostas menores: compressão negociada e formato compacto das mensagens.
+
+Compressão: as respostas JSON (e as páginas HTML) com pelo menos
+``MIN_SIZE`` bytes saem comprimidas com brotli, se o cliente aceitar e o
+pacote ``brotli`` estiver instalado (``pip install brotli``), ou com gzip.
+Respostas pequenas (a maioria dos polls) não compensam o custo e vão como
+estão; respostas em stream (SSE) e arquivos (uploads) nunca são comprimidos.
+
+Formato compacto: a lista de mensagens repete as chaves (``user``,
+``message``, ``timestamp``...) em cada item. Com ``format=compact`` ela vira
+uma lista de valores por campo::
+
+    {"count": 2, "fields": ["id", "user", ...],
+     "columns": {"id": [1, 2], "user": ["ana", "bob"], ...}}
+
+Um campo que a mensagem não tem fica ``null`` na coluna dele.
+"""
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:  # brotli é opcional: sem ele, só gzip
+    brotli = None
+
+COMPRESSION_ENABLED = os.environ.get('CHAT_COMPRESSION', '1') != '0'
+MIN_SIZE = int(os.environ.get('CHAT_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Bem mais rápido que o padrão (11), quase o mesmo tamanho
+COMPRESSIBLE_TYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript'}
+
+
+def choose_encoding(accept_encodings):
+    """Melhor codificação aceita pelo cliente ('br', 'gzip' ou None).
+
+    ``accept_encodings`` é o ``request.accept_encodings`` do Flask.
+    """
+    if not COMPRESSION_ENABLED:
+        return None
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def should_compress(mimetype, size):
+    return size >= MIN_SIZE and mimetype in COMPRESSIBLE_TYPES
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def compact_messages(messages):
+    """Converte a lista de mensagens para colunas (um array por campo)."""
+    fields = []
+    for message in messages:
+        for field in message:
+            if field not in fields:
+                fields.append(field)
+    return {
+        'count': len(messages),
+        'fields': fields,
+        'columns': {field: [message.get(field) for message in messages] for field in fields}
+    }
@@ -0,0 +1,165 @@
+"""Índice das conversas privadas de cada usuário (backend JSON).
+
+Para cada usuário guarda, por conversa: com quem é, o ID da última
+mensagem, a data da última atividade e quantas mensagens recebidas ainda
+não foram lidas. Assim ``/conversations`` responde com um resumo pequeno
+em vez de o cliente consultar cada conversa.
+
+Persistência no ``data/conversations.json`` (via ``message_log``): cada
+mensagem ou leitura vira um evento no log; na compactação os eventos são
+aplicados ao estado guardado no snapshot (``{"users": {...}}``), como nas
+contagens de referência dos uploads.
+
+``summarize`` monta o mesmo estado a partir dos históricos (todas as
+mensagens antigas contam como lidas) e também é usado pelo backend SQLite.
+"""
+import copy
+import os
+import threading
+from datetime import datetime
+
+from message_log import DATA_DIR, LOG_SUFFIX, load_records, append_record, save_records, register_compactor
+
+CONVERSATIONS_FILENAME = 'conversations.json'
+
+_users = {}  # username minúsculo -> {conversation_id: entrada}
+_state = {'loaded': False}
+_lock = threading.Lock()
+
+
+def now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def message_time(message):
+    """Data e hora de uma mensagem do histórico (as antigas não têm data)."""
+    return f"{message.get('date', '')} {message.get('timestamp', '')}".strip()
+
+
+def _new_entry(other):
+    return {'with': other, 'last_message_id': 0, 'last_activity': '', 'unread': 0, 'last_read_id': 0}
+
+
+def _apply(users, event):
+    """Aplica um evento ('message' ou 'read') ao estado ``users``."""
+    conversation_id = event['conversation']
+    if event['type'] == 'message':
+        sender, recipient = event['from'], event['to']
+        sides = [(sender, recipient, True)]
+        if recipient.lower() != sender.lower():
+            sides.append((recipient, sender, False))
+        for user, other, is_sender in sides:
+            entry = users.setdefault(user.lower(), {}).setdefault(conversation_id, _new_entry(other))
+            entry['with'] = other
+            entry['last_message_id'] = max(entry['last_message_id'], event['id'])
+            entry['last_activity'] = event['at']
+            if is_sender:
+                # Quem responde já leu a conversa
+                entry['unread'] = 0
+                entry['last_read_id'] = entry['last_message_id']
+            else:
+                entry['unread'] += 1
+    elif event['type'] == 'read':
+        entry = users.get(event['user'], {}).get(conversation_id)
+        if entry is not None:
+            entry['last_read_id'] = max(entry['last_read_id'], event['id'])
+            entry['unread'] = min(entry['unread'], max(entry['last_message_id'] - entry['last_read_id'], 0))
+
+
+def _compact(events, extra):
+    """Na compactação, aplica os eventos ao estado do snapshot."""
+    users = copy.deepcopy(extra.get('users', {}))
+    for event in events:
+        _apply(users, event)
+    return [], {'users': users}
+
+
+register_compactor(CONVERSATIONS_FILENAME, _compact)
+
+
+def _ensure_loaded():
+    if _state['loaded']:
+        return
+    with _lock:
+        if _state['loaded']:
+            return
+        events, extra = load_records(CONVERSATIONS_FILENAME, key='events')
+        _, state = _compact(events, extra)
+        _users.clear()
+        _users.update(state['users'])
+        _state['loaded'] = True
+
+
+def exists():
+    """Se o índice já foi criado (senão, monte-o com ``rebuild``)."""
+    path = os.path.join(DATA_DIR, CONVERSATIONS_FILENAME)
+    return os.path.exists(path) or os.path.exists(path + LOG_SUFFIX)
+
+
+def record_message(conversation_id, message):
+    """Atualiza o índice dos dois participantes com uma mensagem nova."""
+    _ensure_loaded()
+    event = {'type': 'message', 'conversation': conversation_id, 'from': message['from'],
+             'to': message['to'], 'id': message['id'], 'at': now()}
+    with _lock:
+        append_record(event, CONVERSATIONS_FILENAME, key='events')
+        _apply(_users, event)
+
+
+def mark_read(username, conversation_id, message_id):
+    """Marca a conversa como lida até message_id. Retorna True se mudou algo."""
+    _ensure_loaded()
+    user = username.lower()
+    with _lock:
+        entry = _users.get(user, {}).get(conversation_id)
+        if entry is None or (entry['unread'] == 0 and entry['last_read_id'] >= message_id):
+            return False
+        event = {'type': 'read', 'user': user, 'conversation': conversation_id, 'id': message_id}
+        append_record(event, CONVERSATIONS_FILENAME, key='events')
+        _apply(_users, event)
+    return True
+
+
+def conversations(username):
+    """Conversas do usuário, da atividade mais recente para a mais antiga."""
+    _ensure_loaded()
+    with _lock:
+        entries = [dict(entry) for entry in _users.get(username.lower(), {}).values()]
+    return sort_entries(entries)
+
+
+def sort_entries(entries):
+    entries.sort(key=lambda entry: (entry['last_activity'], entry['last_message_id']), reverse=True)
+    for entry in entries:
+        entry.pop('last_read_id', None)
+    return entries
+
+
+def summarize(histories):
+    """Estado do índice a partir de (conversation_id, mensagens) já gravados.
+
+    Tudo o que já está no histórico conta como lido.
+    """
+    users = {}
+    for conversation_id, messages in histories:
+        for message in messages:
+            if 'from' not in message or 'to' not in message:
+                continue
+            _apply(users, {'type': 'message', 'conversation': conversation_id, 'from': message['from'],
+                           'to': message['to'], 'id': message['id'], 'at': message_time(message)})
+    for user_conversations in users.values():
+        for entry in user_conversations.values():
+            entry['unread'] = 0
+            entry['last_read_id'] = entry['last_message_id']
+    return users
+
+
+def rebuild(histories):
+    """Recria o índice do zero a partir dos históricos. Retorna o número de conversas."""
+    users = summarize(histories)
+    with _lock:
+        save_records([], CONVERSATIONS_FILENAME, key='events', extra={'users': users})
+        _users.clear()
+        _users.update(users)
+        _state['loaded'] = True
+    return len({conversation_id for user_conversations in users.values() for conversation_id in user_conversations})
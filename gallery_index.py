@@ -0,0 +1,192 @@
+"""Galeria de memes com índice invertido de tags em memória.
+
+A galeria (``data/gallery.json`` + log de appends) é carregada uma vez e
+mantida indexada:
+
+- tag -> IDs dos memes, com uma lista ordenada de tags para busca por
+  prefixo (type-ahead);
+- partições por visibilidade: memes públicos, privados por quem enviou e
+  privados por destinatário da conversa.
+
+Assim uma busca custa proporcionalmente ao número de resultados, e não ao
+tamanho da galeria.
+
+Como os uploads são endereçados pelo conteúdo, colar de novo uma imagem que
+já está na galeria (com a mesma visibilidade) não cria outra entrada: as tags
+novas são somadas à entrada existente. No log, a atualização é gravada como
+um novo registro com o mesmo ``id``, que substitui o anterior na leitura.
+
+Escritas (e a carga inicial) são serializadas por um lock; as buscas leem
+os índices sem lock, já que as listas de IDs só crescem.
+"""
+import bisect
+import heapq
+import threading
+
+from message_log import load_records, append_record, assign_message_ids, register_compactor
+
+GALLERY_FILENAME = 'gallery.json'
+
+_memes = {}  # id -> meme
+_tag_index = {}  # tag -> [ids em ordem crescente]
+_sorted_tags = []  # Todas as tags, ordenadas, para busca por prefixo
+_public_ids = []
+_private_by_uploader = {}  # username -> [ids]
+_private_by_target = {}  # target_user -> [ids]
+_by_key = {}  # chave de deduplicação -> id
+_state = {'loaded': False, 'last_id': 0}
+_lock = threading.Lock()
+
+
+def dedup_key(meme):
+    """Entradas com a mesma chave representam o mesmo meme na galeria."""
+    if not meme.get('is_private', False):
+        return ('public', meme['filename'])
+    return ('private', meme['filename'], meme.get('uploaded_by'), meme.get('target_user'))
+
+
+def _index_tags(meme_id, tags):
+    for tag in tags:
+        ids = _tag_index.get(tag)
+        if ids is None:
+            ids = _tag_index[tag] = []
+            bisect.insort(_sorted_tags, tag)
+        if not ids or ids[-1] < meme_id:
+            ids.append(meme_id)
+        elif meme_id not in ids:
+            bisect.insort(ids, meme_id)
+
+
+def _index_meme(meme):
+    """Adiciona o meme aos índices (IDs sempre crescentes)."""
+    meme_id = meme['id']
+    previous = _memes.get(meme_id)
+    _memes[meme_id] = meme
+    if previous is not None:
+        # Atualização de uma entrada existente: só as tags podem mudar
+        _index_tags(meme_id, [t for t in meme.get('tags', []) if t not in previous.get('tags', [])])
+        return
+
+    _state['last_id'] = max(_state['last_id'], meme_id)
+    _by_key.setdefault(dedup_key(meme), meme_id)
+    _index_tags(meme_id, meme.get('tags', []))
+
+    if not meme.get('is_private', False):
+        _public_ids.append(meme_id)
+    else:
+        _private_by_uploader.setdefault(meme.get('uploaded_by'), []).append(meme_id)
+        if meme.get('target_user'):
+            _private_by_target.setdefault(meme['target_user'], []).append(meme_id)
+
+
+def _compact_gallery(memes, extra):
+    """Na compactação, mantém só a versão mais recente de cada entrada."""
+    latest = {}
+    for meme in assign_message_ids(memes):
+        latest[meme['id']] = meme
+    return [latest[meme_id] for meme_id in sorted(latest)], extra
+
+
+register_compactor(GALLERY_FILENAME, _compact_gallery)
+
+
+def _ensure_loaded():
+    if _state['loaded']:
+        return
+    with _lock:
+        if _state['loaded']:
+            return
+        memes, _ = load_records(GALLERY_FILENAME, key='memes')
+        for meme in assign_message_ids(memes):
+            _index_meme(meme)
+        _state['loaded'] = True
+
+
+def add_meme(meme):
+    """Persiste um meme na galeria e atualiza os índices.
+
+    Se a mesma imagem já está na galeria com a mesma visibilidade, apenas
+    soma as tags novas à entrada existente. Retorna (meme, criado).
+    """
+    _ensure_loaded()
+    with _lock:
+        existing_id = _by_key.get(dedup_key(meme))
+        if existing_id is not None:
+            existing = _memes[existing_id]
+            new_tags = [tag for tag in meme.get('tags', []) if tag not in existing.get('tags', [])]
+            if new_tags:
+                updated = dict(existing, tags=existing.get('tags', []) + new_tags)
+                append_record(updated, GALLERY_FILENAME, key='memes')
+                _index_meme(updated)
+                existing = updated
+            return existing, False
+
+        meme['id'] = _state['last_id'] + 1
+        append_record(meme, GALLERY_FILENAME, key='memes')
+        _index_meme(meme)
+        return meme, True
+
+
+def all_memes():
+    """Todas as entradas da galeria, em ordem de inclusão."""
+    _ensure_loaded()
+    return [_memes[meme_id] for meme_id in sorted(_memes)]
+
+
+def _tags_with_prefix(prefix):
+    """Tags que começam com o prefixo (busca binária na lista ordenada)."""
+    start = bisect.bisect_left(_sorted_tags, prefix)
+    for tag in _sorted_tags[start:]:
+        if not tag.startswith(prefix):
+            break
+        yield tag
+
+
+def _is_visible(meme, current_user, is_private_chat, target_user):
+    """Mesma regra de privacidade de sempre para memes privados."""
+    if not meme.get('is_private', False):
+        return True
+    if meme.get('uploaded_by') == current_user:
+        return True
+    # Meme de outra pessoa: só aparece na conversa privada correta
+    if is_private_chat:
+        meme_target = meme.get('target_user', '')
+        return meme_target == target_user or meme_target == current_user
+    return False
+
+
+def _unique(ids):
+    """Remove repetidos de uma sequência ordenada."""
+    last = None
+    for meme_id in ids:
+        if meme_id != last:
+            yield meme_id
+            last = meme_id
+
+
+def search(current_user, tags='', is_private_chat=False, target_user='', limit=None, offset=0):
+    """Busca memes visíveis para o usuário, filtrando por tags (ou prefixos).
+
+    Retorna (memes da página, total de resultados).
+    """
+    _ensure_loaded()
+    search_list = [tag.strip() for tag in tags.lower().split(',') if tag.strip()]
+
+    if search_list:
+        # União dos IDs de todas as tags que batem com algum termo
+        id_lists = [_tag_index[tag] for term in search_list for tag in _tags_with_prefix(term)]
+        candidates = _unique(heapq.merge(*id_lists))
+        ids = [
+            meme_id for meme_id in candidates
+            if _is_visible(_memes[meme_id], current_user, is_private_chat, target_user)
+        ]
+    else:
+        # Sem filtro: junta só as partições que o usuário pode ver
+        partitions = [_public_ids, _private_by_uploader.get(current_user, [])]
+        if is_private_chat:
+            partitions.append(_private_by_target.get(target_user, []))
+            partitions.append(_private_by_target.get(current_user, []))
+        ids = list(_unique(heapq.merge(*partitions)))
+
+    page = ids[offset:offset + limit] if limit is not None else ids[offset:]
+    return [_memes[meme_id] for meme_id in page], len(ids)
@@ -0,0 +1,342 @@
+"""Armazenamento append-only para os históricos em JSON.
+
+Cada arquivo lógico (ex: ``chat_geral.json``) é formado por duas partes:
+
+- o snapshot ``data/<arquivo>``, no mesmo formato de sempre
+  (``{"messages": [...], "seq": N}``), reescrito apenas na compactação;
+- o log ``data/<arquivo>.log``, com um registro JSON por linha
+  (``{"seq": N, "record": {...}}``) para cada item adicionado depois do snapshot.
+
+Assim cada envio grava só a mensagem nova em vez de reserializar o histórico
+inteiro. O ``seq`` permite recuperar de uma queda no meio da compactação: os
+registros do log com ``seq`` menor ou igual ao do snapshot já foram absorvidos
+e são ignorados na leitura.
+
+Cada arquivo tem seu próprio lock: escritas em arquivos diferentes (salas,
+conversas) não esperam umas pelas outras.
+
+Os históricos de mensagens também têm um cabeçalho ``data/<arquivo>.head``
+(``{"seq": N, "count": N, "last_id": N}``), regravado junto com o snapshot.
+Com ele e o log (que nunca passa de ``COMPACT_THRESHOLD`` registros),
+``read_header`` sabe quantas mensagens há e qual o último ID sem ler o
+snapshot.
+"""
+import json
+import os
+import threading
+
+import metrics
+
+DATA_DIR = 'data'
+LOG_SUFFIX = '.log'
+HEADER_SUFFIX = '.head'
+COMPACT_THRESHOLD = 500  # Registros no log antes de reescrever o snapshot
+
+# Estado de cada arquivo: {filename: {'seq': último seq gravado, 'pending': registros no log}}
+_log_state = {}
+
+# Funções opcionais que reduzem os registros na compactação: {filename: fn}
+_compactors = {}
+
+# Indentação do snapshot por arquivo (padrão: SNAPSHOT_INDENT)
+SNAPSHOT_INDENT = 4
+_snapshot_indent = {}
+
+# Grava os registros com escrita adiada de um arquivo (set_pending_flusher)
+_pending_flusher = {'fn': None}
+
+_file_locks = {}  # filename -> RLock
+_file_locks_guard = threading.Lock()
+
+
+def file_lock(filename):
+    """Lock (reentrante) que serializa as escritas de um arquivo."""
+    lock = _file_locks.get(filename)
+    if lock is None:
+        with _file_locks_guard:
+            lock = _file_locks.setdefault(filename, threading.RLock())
+    return lock
+
+
+def _snapshot_path(filename):
+    return os.path.join(DATA_DIR, filename)
+
+
+def _log_path(filename):
+    return os.path.join(DATA_DIR, filename + LOG_SUFFIX)
+
+
+def _header_path(filename):
+    return os.path.join(DATA_DIR, filename + HEADER_SUFFIX)
+
+
+def _last_id(records, last_id=0):
+    """Último ID da lista, contando como ``assign_message_ids`` os registros sem ID."""
+    for record in records:
+        last_id = record.get('id', last_id + 1)
+    return last_id
+
+
+def _write_header(filename, records, seq):
+    path = _header_path(filename)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'seq': seq, 'count': len(records), 'last_id': _last_id(records)}, f)
+    os.replace(path + '.tmp', path)
+
+
+def _read_snapshot(filename, key):
+    """Lê o snapshot e retorna (registros, seq, dados extras)."""
+    try:
+        with open(_snapshot_path(filename), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return [], 0, {}
+    if isinstance(data, list):
+        # Formato antigo das conversas privadas: lista pura
+        return data, 0, {}
+    records = data.pop(key, [])
+    seq = data.pop('seq', 0)
+    return records, seq, data
+
+
+def _replay_log(filename, snapshot_seq):
+    """Lê os registros do log posteriores ao snapshot.
+
+    Uma última linha incompleta (queda no meio de uma escrita) é descartada e
+    o arquivo é truncado no último registro válido, para que os próximos
+    appends comecem numa linha limpa.
+    """
+    path = _log_path(filename)
+    records = []
+    last_seq = snapshot_seq
+    pending = 0
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return records, last_seq, pending
+
+    valid_end = 0
+    for line in content.splitlines(keepends=True):
+        if not line.endswith(b'\n'):
+            break
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            break
+        valid_end += len(line)
+        pending += 1
+        if entry['seq'] <= last_seq:
+            continue  # Já está no snapshot
+        records.append(entry['record'])
+        last_seq = entry['seq']
+
+    if valid_end < len(content):
+        print(f"Log {path} com registro incompleto, truncando em {valid_end} bytes")
+        with open(path, 'r+b') as f:
+            f.truncate(valid_end)
+
+    return records, last_seq, pending
+
+
+def _write_snapshot(filename, key, records, seq, extra=None):
+    """Grava o snapshot de forma atômica (arquivo temporário + rename)."""
+    path = _snapshot_path(filename)
+    tmp_path = path + '.tmp'
+    data = dict(extra or {})
+    data[key] = records
+    data['seq'] = seq
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=_snapshot_indent.get(filename, SNAPSHOT_INDENT), ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def assign_message_ids(messages):
+    """Garante que toda mensagem tenha um 'id' monotônico.
+
+    Mensagens antigas, gravadas antes dos IDs, recebem a posição na lista;
+    como o histórico só cresce, o ID atribuído é sempre o mesmo.
+    """
+    last_id = 0
+    for msg in messages:
+        if 'id' not in msg:
+            msg['id'] = last_id + 1
+        last_id = msg['id']
+    return messages
+
+
+def messages_after(messages, after_id):
+    """Retorna as mensagens com ID maior que after_id (busca binária)."""
+    lo, hi = 0, len(messages)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if messages[mid]['id'] <= after_id:
+            lo = mid + 1
+        else:
+            hi = mid
+    return messages[lo:]
+
+
+def messages_before(messages, before_id=None, limit=50):
+    """Retorna até ``limit`` mensagens com ID menor que before_id (as mais
+    recentes delas, em ordem crescente). Sem before_id, as últimas ``limit``.
+    """
+    hi = len(messages)
+    if before_id is not None:
+        lo = 0
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if messages[mid]['id'] < before_id:
+                lo = mid + 1
+            else:
+                hi = mid
+    return messages[max(hi - limit, 0):hi]
+
+
+def load_records(filename, key='messages'):
+    """Carrega snapshot + log e retorna (registros, dados extras do snapshot)."""
+    with file_lock(filename):
+        _flush_pending(filename)
+        records, seq, extra = _read_snapshot(filename, key)
+        log_records, last_seq, pending = _replay_log(filename, seq)
+        records.extend(log_records)
+        _log_state[filename] = {'seq': last_seq, 'pending': pending}
+    return records, extra
+
+
+def read_header(filename):
+    """(número de mensagens, último ID) do histórico, sem ler o snapshot.
+
+    Sem cabeçalho (históricos gravados antes dele), lê o histórico inteiro
+    uma vez e grava só o cabeçalho: uma leitura nunca reescreve o histórico.
+    """
+    with file_lock(filename):
+        _flush_pending(filename)
+        try:
+            with open(_header_path(filename), 'r', encoding='utf-8') as f:
+                header = json.load(f)
+        except (FileNotFoundError, ValueError):
+            messages = load_messages(filename)
+            if not os.path.exists(_snapshot_path(filename)) and not messages:
+                return 0, 0
+            # Cobre snapshot + log até o último seq: os próximos appends
+            # (seq maior) são somados na leitura
+            _write_header(filename, messages, _log_state[filename]['seq'])
+            return len(messages), _last_id(messages)
+        log_records, last_seq, pending = _replay_log(filename, header['seq'])
+        if filename not in _log_state:
+            _log_state[filename] = {'seq': last_seq, 'pending': pending}
+    return header['count'] + len(log_records), _last_id(log_records, header['last_id'])
+
+
+def load_messages(filename):
+    """Carrega mensagens do snapshot JSON e do log de appends."""
+    messages, _ = load_records(filename)
+    return messages
+
+
+def save_records(records, filename, key='messages', extra=None):
+    """Reescreve o snapshot completo e zera o log."""
+    with file_lock(filename):
+        # Os pendentes vão para o log antes, e o log é zerado logo abaixo
+        _flush_pending(filename)
+        state = _log_state.get(filename)
+        if state is None:
+            load_records(filename, key)
+            state = _log_state[filename]
+        with metrics.timed('chat_storage_write_seconds', op='snapshot'):
+            _write_snapshot(filename, key, records, state['seq'], extra)
+            # Antes de zerar o log: se o processo cair aqui, um cabeçalho
+            # antigo somado ao log ainda dá a contagem certa
+            if key == 'messages':
+                _write_header(filename, records, state['seq'])
+        # O snapshot já contém tudo: o log pode ser descartado
+        with open(_log_path(filename), 'w', encoding='utf-8'):
+            pass
+        state['pending'] = 0
+
+
+def save_messages(messages, filename):
+    """Salva o histórico completo (compactação manual)."""
+    save_records(messages, filename)
+
+
+def append_record(record, filename, key='messages'):
+    """Adiciona um registro ao log, sem reescrever o histórico."""
+    append_records([record], filename, key)
+
+
+def append_records(records, filename, key='messages'):
+    """Adiciona vários registros ao log numa única escrita."""
+    with file_lock(filename):
+        state = _log_state.get(filename)
+        if state is None:
+            load_records(filename, key)
+            state = _log_state[filename]
+
+        lines = []
+        for record in records:
+            state['seq'] += 1
+            lines.append(json.dumps({'seq': state['seq'], 'record': record}, ensure_ascii=False) + '\n')
+        data = ''.join(lines)
+        with metrics.timed('chat_storage_write_seconds', op='append'):
+            with open(_log_path(filename), 'a', encoding='utf-8') as f:
+                f.write(data)
+        metrics.inc('chat_storage_bytes_written_total', len(data))
+        state['pending'] += len(records)
+
+        if state['pending'] >= COMPACT_THRESHOLD:
+            compact(filename, key)
+
+
+def append_message(message, filename):
+    """Adiciona uma mensagem ao histórico gravando apenas ela."""
+    append_record(message, filename)
+
+
+def set_pending_flusher(flusher):
+    """Registra ``flusher(filename)``, que grava no log os registros ainda
+    pendentes do arquivo (escrita adiada, veja ``write_behind.py``).
+
+    É chamada (com o lock do arquivo) antes de ler ou reescrever o
+    histórico, então quem lê do disco sempre vê tudo o que foi aceito.
+    """
+    _pending_flusher['fn'] = flusher
+
+
+def _flush_pending(filename):
+    flusher = _pending_flusher['fn']
+    if flusher is not None:
+        flusher(filename)
+
+
+def register_compactor(filename, compactor):
+    """Registra uma função ``compactor(records, extra) -> (records, extra)``.
+
+    Ela é aplicada na compactação do arquivo, permitindo, por exemplo,
+    somar registros incrementais em vez de guardar todos no snapshot.
+    """
+    _compactors[filename] = compactor
+
+
+def set_snapshot_indent(filename, indent):
+    """Indentação do snapshot do arquivo; ``None`` grava tudo numa linha
+    (arquivos grandes que ninguém lê à mão, como o índice da busca).
+    """
+    _snapshot_indent[filename] = indent
+
+
+def compact(filename, key='messages'):
+    """Incorpora o log ao snapshot.
+
+    Se o processo cair entre gravar o snapshot e zerar o log, os registros
+    repetidos são ignorados na próxima leitura graças ao ``seq``.
+    """
+    with file_lock(filename):
+        records, extra = load_records(filename, key)
+        compactor = _compactors.get(filename)
+        if compactor is not None:
+            records, extra = compactor(records, extra)
+        save_records(records, filename, key, extra)
@@ -0,0 +1,141 @@
+"""Métricas do servidor no formato texto do Prometheus.
+
+Contadores e histogramas ficam em memória, no processo, e são atualizados
+nos pontos quentes (requisições, gravações em disco). Valores que já existem
+em outro lugar (tamanho das salas, estatísticas de cache) são lidos só na
+hora da coleta, por funções registradas com ``register_gauge``.
+
+``render()`` gera o texto servido em ``/metrics``. Não depende de nenhuma
+biblioteca externa.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# Limites (em segundos) dos buckets dos histogramas de latência
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_lock = threading.Lock()
+_metadata = {}  # nome -> (tipo, ajuda)
+_counters = {}  # (nome, labels) -> valor
+_histograms = {}  # (nome, labels) -> {'buckets': [...], 'counts': [...], 'sum': s, 'count': n}
+_gauges = {}  # nome -> função que retorna [(labels, valor)]
+
+
+def describe(name, kind, help_text):
+    """Registra o tipo ('counter', 'histogram', 'gauge') e a descrição da métrica."""
+    _metadata[name] = (kind, help_text)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Soma ``value`` ao contador."""
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """Registra uma observação no histograma."""
+    key = (name, _labels(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0
+            }
+        for i, bound in enumerate(histogram['buckets']):
+            if value <= bound:
+                histogram['counts'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+@contextmanager
+def timed(name, **labels):
+    """Mede a duração do bloco num histograma de latência."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def register_gauge(name, help_text, collect, kind='gauge'):
+    """Registra uma métrica calculada na coleta.
+
+    ``collect()`` retorna uma lista de pares (labels, valor), com os labels
+    num dict; use ``[({}, valor)]`` para um valor único. Use
+    ``kind='counter'`` para totais que só crescem (ex: hits de cache).
+    """
+    describe(name, kind, help_text)
+    _gauges[name] = collect
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def render():
+    """Todas as métricas no formato de exposição texto do Prometheus."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: dict(h, counts=list(h['counts'])) for key, h in _histograms.items()}
+
+    samples = {}  # nome -> [linhas]
+    for (name, labels), value in sorted(counters.items()):
+        samples.setdefault(name, []).append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+    for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(histogram['buckets'], histogram['counts']):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {histogram["count"]}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(histogram["sum"])}')
+        lines.append(f'{name}_count{_format_labels(labels)} {histogram["count"]}')
+
+    for name, collect in list(_gauges.items()):
+        try:
+            values = collect()
+        except Exception as e:
+            print(f"Erro ao coletar a métrica {name}: {e}")
+            continue
+        samples[name] = [
+            f'{name}{_format_labels(_labels(dict(labels)))} {_format_value(value)}'
+            for labels, value in values
+        ]
+
+    output = []
+    for name in sorted(samples):
+        kind, help_text = _metadata.get(name, ('untyped', ''))
+        output.append(f'# HELP {name} {help_text}')
+        output.append(f'# TYPE {name} {kind}')
+        output.extend(samples[name])
+    return '\n'.join(output) + '\n'
+
+
+describe('chat_requests_total', 'counter', 'Requisições atendidas, por rota e status')
+describe('chat_request_duration_seconds', 'histogram', 'Tempo de resposta por rota')
+describe('chat_response_bytes_total', 'counter', 'Bytes enviados nas respostas (já comprimidas), por rota')
+describe('chat_compression_saved_bytes_total', 'counter', 'Bytes economizados pela compressão das respostas')
+describe('chat_storage_write_seconds', 'histogram', 'Tempo gasto gravando históricos (append, snapshot, sqlite)')
+describe('chat_storage_bytes_written_total', 'counter', 'Bytes gravados nos históricos JSON')
@@ -0,0 +1,80 @@
+"""Notificações de mudança para clientes conectados (push via SSE).
+
+Cada canal (ex: ``room:geral``, ``typing:geral``, ``private:ana``) tem um
+contador de versão. Quem escreve chama ``notify(canal)``; quem espera se
+inscreve com um objeto que tenha ``set()`` (normalmente ``threading.Event``)
+e é acordado apenas quando um dos seus canais muda.
+
+Com vários processos servidores, as versões ficam num armazenamento
+compartilhado (``set_version_store``, ex: o backend SQLite). Um processo só
+consegue acordar os próprios inscritos, então quem espera também confere as
+versões a cada ``SHARED_POLL_INTERVAL`` segundos (veja ``wait_timeout``).
+"""
+import threading
+
+SHARED_POLL_INTERVAL = 1.0
+
+_lock = threading.Lock()
+_versions = {}  # canal -> versão atual
+_subscribers = {}  # canal -> set de inscritos
+_version_store = None  # Objeto com get_version/bump_version, ou None (memória)
+
+
+def set_version_store(store):
+    """Passa a guardar as versões em ``store`` (compartilhado entre processos)."""
+    global _version_store
+    _version_store = store
+
+
+def version(channel):
+    """Versão atual de um canal (0 se nunca mudou)."""
+    if _version_store is not None:
+        return _version_store.get_version(channel)
+    return _versions.get(channel, 0)
+
+
+def wait_timeout(timeout):
+    """Quanto um inscrito pode esperar antes de conferir as versões de novo."""
+    if _version_store is not None:
+        return min(timeout, SHARED_POLL_INTERVAL)
+    return timeout
+
+
+def notify(channel):
+    """Marca o canal como alterado e acorda seus inscritos."""
+    if _version_store is not None:
+        _version_store.bump_version(channel)
+    with _lock:
+        if _version_store is None:
+            _versions[channel] = _versions.get(channel, 0) + 1
+        waiters = list(_subscribers.get(channel, ()))
+    for waiter in waiters:
+        waiter.set()
+
+
+def subscribe(channels, waiter=None):
+    """Inscreve um waiter nos canais e o retorna."""
+    if waiter is None:
+        waiter = threading.Event()
+    with _lock:
+        for channel in channels:
+            _subscribers.setdefault(channel, set()).add(waiter)
+    return waiter
+
+
+def unsubscribe(channels, waiter):
+    """Remove o waiter dos canais."""
+    with _lock:
+        for channel in channels:
+            waiters = _subscribers.get(channel)
+            if waiters is None:
+                continue
+            waiters.discard(waiter)
+            if not waiters:
+                del _subscribers[channel]
+
+
+def subscriber_count():
+    """Número de inscrições ativas (para diagnóstico)."""
+    with _lock:
+        return sum(len(waiters) for waiters in _subscribers.values())
@@ -0,0 +1,165 @@
+"""Presença (quem está online) e digitação por sala, com expiração.
+
+Cada registro tem um prazo de validade em ``time.monotonic()`` (não é
+afetado por mudanças no relógio do sistema). Os prazos ficam num único heap
+compartilhado por todas as salas; uma thread em segundo plano varre o heap
+a cada ``SWEEP_INTERVAL`` segundos e remove o que venceu, mesmo em salas
+que ninguém está consultando. Quando a lista de uma sala muda (alguém entra,
+sai, começa ou para de digitar), o canal correspondente do ``notifier`` é
+avisado: ``typing:<sala>`` ou ``presence:<sala>``.
+
+Renovar um registro só empilha um novo prazo; os prazos antigos que ficam
+no heap são reconhecidos e descartados na varredura.
+
+Com vários processos servidores, os registros ficam num armazenamento
+compartilhado (``set_store``, ex: a tabela ``presence`` do backend SQLite),
+com o prazo em ``time.time()``: as listas precisam ser as mesmas em todos
+os processos, já que as versões dos canais (e com elas os ETags) também
+são. A varredura de cada processo apaga do banco o que venceu e avisa os
+canais; quem apagou primeiro é quem avisa.
+"""
+import heapq
+import threading
+import time
+
+import notifier
+
+TYPING_TTL = 3.0  # Segundos até "digitando" expirar sem nova notificação
+ONLINE_TTL = 30.0  # Segundos até um usuário sem requisições sair da lista
+SWEEP_INTERVAL = 1.0
+# No armazenamento compartilhado, um prazo ainda válido só é regravado se
+# avançar mais que esta fração do TTL (poupa uma escrita por poll)
+SHARED_REFRESH_FRACTION = 0.25
+
+TYPING = 'typing'
+ONLINE = 'presence'
+
+_entries = {}  # (tipo, sala) -> {usuário: prazo}
+_deadlines = []  # heap de (prazo, tipo, sala, usuário)
+_lock = threading.Lock()
+_sweeper = {'thread': None}
+_store = None  # Objeto com refresh_presence/remove_presence/..., ou None (memória)
+
+
+def set_store(store):
+    """Passa a guardar os registros em ``store`` (compartilhado entre processos)."""
+    global _store
+    _store = store
+
+
+def _refresh(kind, room_id, user, ttl):
+    """Renova o prazo do usuário. Retorna True se ele acabou de entrar na lista."""
+    if _store is not None:
+        return _refresh_shared(kind, room_id, user, ttl)
+    expires_at = time.monotonic() + ttl
+    with _lock:
+        users = _entries.setdefault((kind, room_id), {})
+        is_new = user not in users
+        users[user] = expires_at
+        heapq.heappush(_deadlines, (expires_at, kind, room_id, user))
+    if is_new:
+        notifier.notify(f'{kind}:{room_id}')
+    return is_new
+
+
+def _refresh_shared(kind, room_id, user, ttl):
+    now = time.time()
+    expires_at = now + ttl
+    current = _store.presence_expiry(kind, room_id, user)
+    if current is not None and current > now and expires_at - current < ttl * SHARED_REFRESH_FRACTION:
+        return False
+    is_new = _store.refresh_presence(kind, room_id, user, expires_at, now)
+    if is_new:
+        notifier.notify(f'{kind}:{room_id}')
+    return is_new
+
+
+def _remove(kind, room_id, user):
+    if _store is not None:
+        if not _store.remove_presence(kind, room_id, user):
+            return False
+        notifier.notify(f'{kind}:{room_id}')
+        return True
+    with _lock:
+        users = _entries.get((kind, room_id))
+        if not users or users.pop(user, None) is None:
+            return False
+        if not users:
+            del _entries[(kind, room_id)]
+    notifier.notify(f'{kind}:{room_id}')
+    return True
+
+
+def _active(kind, room_id):
+    if _store is not None:
+        return _store.active_presence(kind, room_id, time.time())
+    with _lock:
+        return sorted(_entries.get((kind, room_id), {}))
+
+
+def set_typing(room_id, user, is_typing):
+    """Marca (ou desmarca) o usuário como digitando. Retorna True se mudou."""
+    if is_typing:
+        return _refresh(TYPING, room_id, user, TYPING_TTL)
+    return _remove(TYPING, room_id, user)
+
+
+def typing_users(room_id, exclude=None):
+    """Usuários digitando na sala, sem o próprio usuário (``exclude``)."""
+    return [user for user in _active(TYPING, room_id) if user != exclude]
+
+
+def touch(room_id, user):
+    """Registra atividade do usuário na sala (mantém-no online)."""
+    return _refresh(ONLINE, room_id, user, ONLINE_TTL)
+
+
+def online_users(room_id):
+    return _active(ONLINE, room_id)
+
+
+def sweep(now=None):
+    """Remove os registros vencidos e avisa os canais que mudaram.
+
+    Retorna o conjunto de canais alterados.
+    """
+    if _store is not None:
+        changed = {f'{kind}:{room_id}' for kind, room_id in _store.expire_presence(now or time.time())}
+        for channel in changed:
+            notifier.notify(channel)
+        return changed
+    if now is None:
+        now = time.monotonic()
+    changed = set()
+    with _lock:
+        while _deadlines and _deadlines[0][0] <= now:
+            expires_at, kind, room_id, user = heapq.heappop(_deadlines)
+            users = _entries.get((kind, room_id))
+            # Prazo antigo de um registro já renovado (ou removido): ignora
+            if not users or users.get(user) != expires_at:
+                continue
+            del users[user]
+            if not users:
+                del _entries[(kind, room_id)]
+            changed.add(f'{kind}:{room_id}')
+    for channel in changed:
+        notifier.notify(channel)
+    return changed
+
+
+def _sweep_forever():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            sweep()
+        except Exception as e:
+            print(f"Erro ao expirar presença: {e}")
+
+
+def start_sweeper():
+    """Inicia (uma única vez) a thread que expira os registros."""
+    with _lock:
+        if _sweeper['thread'] is None:
+            thread = threading.Thread(target=_sweep_forever, name='presence-sweeper', daemon=True)
+            thread.start()
+            _sweeper['thread'] = thread
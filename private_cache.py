@@ -0,0 +1,131 @@
+"""Cache em memória das conversas privadas, com despejo LRU.
+
+As conversas ficam em ``data/private_<a>_<b>.json`` (via ``message_log``).
+As mais usadas ficam em RAM, de modo que o polling de um chat privado não
+precisa ler e parsear o arquivo a cada requisição. O cache é limitado por um
+orçamento aproximado de memória: quando ele estoura, as conversas usadas há
+mais tempo são descartadas (elas continuam no disco).
+
+Cada mensagem nova vai para o journal do ``write_behind`` antes de a
+requisição retornar e é gravada no log da conversa em segundo plano.
+
+Concorrência: a estrutura LRU tem um lock próprio, segurado só por
+instantes. Carregar do disco e adicionar mensagens usa um lock por conversa
+(locks "listrados" por hash, em número fixo), então conversas diferentes
+não esperam umas pelas outras. Leituras devolvem a lista em cache sem lock:
+mensagens só são adicionadas ao final.
+"""
+import threading
+from collections import OrderedDict
+
+import write_behind
+from message_log import load_messages, assign_message_ids
+
+PRIVATE_CACHE_MAX_BYTES = 16 * 1024 * 1024  # Orçamento aproximado do cache
+MESSAGE_OVERHEAD_BYTES = 200  # Custo estimado de um dict de mensagem em RAM
+CONVERSATION_OVERHEAD_BYTES = 500  # Custo fixo de cada conversa no cache
+LOCK_STRIPES = 64  # Número de locks compartilhados entre as conversas
+
+# conversation_id -> {'messages': [...], 'size': bytes estimados}
+_cache = OrderedDict()
+_cache_bytes = 0
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+_cache_lock = threading.Lock()
+_conversation_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+
+
+def conversation_lock(conversation_id):
+    """Lock que serializa carga e escrita de uma conversa."""
+    return _conversation_locks[hash(conversation_id) % LOCK_STRIPES]
+
+
+def conversation_id_for(user_a, user_b):
+    """ID único da conversa (sempre na mesma ordem alfabética)."""
+    users_sorted = sorted([user_a.lower(), user_b.lower()])
+    return f"{users_sorted[0]}_{users_sorted[1]}"
+
+
+def conversation_filename(conversation_id):
+    return f'private_{conversation_id}.json'
+
+
+def _estimate_size(message):
+    """Estimativa barata do espaço ocupado por uma mensagem."""
+    return MESSAGE_OVERHEAD_BYTES + sum(len(str(value)) for value in message.values())
+
+
+def _evict():
+    """Descarta as conversas menos usadas até caber no orçamento.
+
+    Deve ser chamada com _cache_lock.
+    """
+    global _cache_bytes
+    # Mantém sempre a conversa mais recente, mesmo que sozinha passe do limite
+    while _cache_bytes > PRIVATE_CACHE_MAX_BYTES and len(_cache) > 1:
+        _, entry = _cache.popitem(last=False)
+        _cache_bytes -= entry['size']
+        stats['evictions'] += 1
+
+
+def _cached(conversation_id):
+    with _cache_lock:
+        entry = _cache.get(conversation_id)
+        if entry is None:
+            return None
+        _cache.move_to_end(conversation_id)
+        stats['hits'] += 1
+        return entry['messages']
+
+
+def get_conversation(conversation_id):
+    """Retorna a lista de mensagens da conversa, do cache ou do disco."""
+    global _cache_bytes
+    messages = _cached(conversation_id)
+    if messages is not None:
+        return messages
+
+    with conversation_lock(conversation_id):
+        # Outra thread pode ter carregado enquanto esperávamos o lock
+        messages = _cached(conversation_id)
+        if messages is not None:
+            return messages
+
+        messages = assign_message_ids(load_messages(conversation_filename(conversation_id)))
+        size = CONVERSATION_OVERHEAD_BYTES + sum(_estimate_size(m) for m in messages)
+        with _cache_lock:
+            stats['misses'] += 1
+            _cache[conversation_id] = {'messages': messages, 'size': size}
+            _cache_bytes += size
+            _evict()
+        return messages
+
+
+def append_private_message(conversation_id, message):
+    """Adiciona a mensagem à conversa (cache + disco) e retorna-a com ID."""
+    global _cache_bytes
+    with conversation_lock(conversation_id):
+        messages = get_conversation(conversation_id)
+        message['id'] = messages[-1]['id'] + 1 if messages else 1
+        write_behind.append_message(message, conversation_filename(conversation_id))
+        messages.append(message)
+
+        with _cache_lock:
+            entry = _cache.get(conversation_id)
+            if entry is not None:
+                size = _estimate_size(message)
+                entry['size'] += size
+                _cache_bytes += size
+                _evict()
+    return message
+
+
+def cache_usage():
+    """Resumo do uso do cache (para diagnóstico)."""
+    with _cache_lock:
+        return {
+            'conversations': len(_cache),
+            'bytes': _cache_bytes,
+            'max_bytes': PRIVATE_CACHE_MAX_BYTES,
+            **stats
+        }
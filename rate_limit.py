@@ -0,0 +1,136 @@
+"""Limite de requisições por sessão e por rota (token bucket) e orçamento global.
+
+O túnel do ngrok aceita cerca de 360 requisições por minuto no total, então
+o servidor controla o volume em dois níveis:
+
+- cada sessão (usuário logado, ou IP) tem um balde de fichas por rota, com
+  taxa e rajada em ``ROUTE_LIMITS``. Sem fichas, a requisição recebe 429
+  com ``Retry-After``;
+- todas as requisições gastam fichas de um balde global de
+  ``GLOBAL_BUDGET`` por minuto. Quando ele acaba, só as rotas de polling
+  (``DEFERRABLE``) são recusadas: envios e uploads nunca esperam por elas.
+
+Para que o 429 seja raro, cada resposta leva a dica ``X-Poll-Interval``
+(segundos): o intervalo de polling que mantém o volume recente abaixo de
+``TARGET_UTILIZATION`` do orçamento. O ``index.html`` usa essa dica (e
+recua sozinho com a aba oculta ou a sala parada).
+
+O estado é local ao processo: com vários processos (SQLite), divida o
+orçamento entre eles com ``CHAT_REQUEST_BUDGET``.
+"""
+import math
+import os
+import threading
+import time
+
+RATE_LIMIT_ENABLED = os.environ.get('CHAT_RATE_LIMIT', '1') != '0'
+GLOBAL_BUDGET = float(os.environ.get('CHAT_REQUEST_BUDGET', 300))  # Requisições por minuto
+GLOBAL_BURST_SECONDS = 10  # Rajada global: fichas de até 10s de orçamento
+TARGET_UTILIZATION = 0.8
+BASE_POLL_INTERVAL = 2.0  # Segundos (o intervalo normal do index.html)
+MAX_POLL_INTERVAL = 30.0
+RATE_WINDOW = 10  # Segundos usados para medir o volume recente
+IDLE_BUCKET_SECONDS = 600  # Baldes sem uso por esse tempo são descartados
+
+# endpoint -> (fichas por segundo, rajada) por sessão
+ROUTE_LIMITS = {
+    'get_room_state': (2.0, 10),  # também chamada a cada aviso do push
+    'get_messages': (2.0, 10),
+    'get_typing': (1.0, 5),
+    'get_private_messages': (2.0, 10),
+    'list_conversations': (1.0, 5),
+    'set_typing': (2.0, 5),
+    'send': (2.0, 10),
+    'send_private': (2.0, 10),
+    'upload_image': (0.2, 5),
+    'get_gallery': (1.0, 10),
+    'search_messages': (1.0, 10),
+    'authenticate': (0.1, 5),
+    'register': (0.1, 5),
+}
+
+# Rotas de polling: recusadas quando o orçamento global acaba
+DEFERRABLE = {'get_room_state', 'get_messages', 'get_typing', 'get_private_messages', 'list_conversations'}
+
+_buckets = {}  # (sessão, endpoint) -> [fichas, último abastecimento]
+_global = {'tokens': GLOBAL_BUDGET / 60 * GLOBAL_BURST_SECONDS, 'updated': time.monotonic()}
+_recent = [0] * RATE_WINDOW  # requisições em cada um dos últimos segundos
+_recent_second = {'value': int(time.monotonic())}
+_lock = threading.Lock()
+_next_prune = {'at': time.monotonic() + IDLE_BUCKET_SECONDS}
+
+
+def _take(bucket, rate, burst, now):
+    """Abastece o balde e tenta gastar uma ficha. Retorna segundos até haver uma (0 = ok)."""
+    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        return 0
+    return (1 - bucket[0]) / rate
+
+
+def _count_request(now):
+    """Registra a requisição na janela de volume recente (com _lock)."""
+    second = int(now)
+    elapsed = second - _recent_second['value']
+    if elapsed > 0:
+        for offset in range(1, min(elapsed, RATE_WINDOW) + 1):
+            _recent[(_recent_second['value'] + offset) % RATE_WINDOW] = 0
+        _recent_second['value'] = second
+    _recent[second % RATE_WINDOW] += 1
+
+
+def _prune(now):
+    """Descarta os baldes sem uso (com _lock)."""
+    limit = now - IDLE_BUCKET_SECONDS
+    for key in [key for key, bucket in _buckets.items() if bucket[1] < limit]:
+        del _buckets[key]
+    _next_prune['at'] = now + IDLE_BUCKET_SECONDS
+
+
+def poll_interval():
+    """Intervalo de polling sugerido aos clientes, em segundos."""
+    with _lock:
+        per_minute = sum(_recent) * 60 / RATE_WINDOW
+    target = GLOBAL_BUDGET * TARGET_UTILIZATION
+    # Volume acima do alvo: os clientes precisam consultar proporcionalmente menos
+    interval = BASE_POLL_INTERVAL * max(per_minute / target, 1) if target else MAX_POLL_INTERVAL
+    return round(min(interval, MAX_POLL_INTERVAL), 1)
+
+
+def check(session_key, endpoint):
+    """Conta a requisição. Retorna None se ela pode seguir, ou os segundos
+    que o cliente deve esperar.
+    """
+    if not RATE_LIMIT_ENABLED:
+        return None
+    now = time.monotonic()
+    with _lock:
+        _count_request(now)
+        if now >= _next_prune['at']:
+            _prune(now)
+
+        limit = ROUTE_LIMITS.get(endpoint)
+        if limit is not None:
+            rate, burst = limit
+            bucket = _buckets.get((session_key, endpoint))
+            if bucket is None:
+                bucket = _buckets[(session_key, endpoint)] = [burst, now]
+            wait = _take(bucket, rate, burst, now)
+            if wait:
+                return wait
+
+        global_rate = GLOBAL_BUDGET / 60
+        global_bucket = [_global['tokens'], _global['updated']]
+        wait = _take(global_bucket, global_rate, global_rate * GLOBAL_BURST_SECONDS, now)
+        if wait and endpoint in DEFERRABLE:
+            return wait
+        # Rotas que não esperam (envios, uploads) passam mesmo sem saldo
+        _global['tokens'], _global['updated'] = max(global_bucket[0], 0), now
+    return None
+
+
+def retry_after_header(wait):
+    """Valor do cabeçalho Retry-After (segundos inteiros, no mínimo 1)."""
+    return str(max(1, math.ceil(wait)))
@@ -0,0 +1,127 @@
+"""Retenção das salas: janela quente, arquivamento e prazo de guarda.
+
+Cada sala mantém no histórico ativo (em memória no backend JSON) só as
+mensagens mais recentes; as anteriores vão para o arquivo morto
+(``archive.py``), que continua acessível pelo histórico paginado e pela
+busca. Configuração opcional por sala no ``rooms.json``::
+
+    "retention": {"hot_messages": 500, "days": 365}
+
+- ``hot_messages``: mensagens mantidas no histórico ativo (padrão
+  ``DEFAULT_HOT_MESSAGES``);
+- ``days``: dias que as mensagens ficam no arquivo morto antes de serem
+  apagadas (sem ``days``, ficam para sempre).
+
+O arquivamento roda numa thread própria, fora da requisição: um envio só
+agenda a verificação da sala (a cada ``ARCHIVE_EVERY`` mensagens), e o
+lock da sala só é segurado para trocar a lista em memória. Uma segunda
+thread passa por todas as salas na inicialização e a cada
+``RETENTION_INTERVAL`` segundos (prazo em dias e salas paradas).
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import archive
+import metrics
+import uploads
+
+DEFAULT_HOT_MESSAGES = int(os.environ.get('CHAT_HOT_MESSAGES', 1000))
+ARCHIVE_EVERY = 100  # Mensagens novas numa sala entre duas verificações
+RETENTION_INTERVAL = 3600
+
+_policies = {}  # sala -> {'hot_messages': N, 'days': D ou None}
+_pending = set()  # salas com arquivamento já agendado
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archiver')
+_scheduler = {'thread': None}
+
+
+def configure(rooms):
+    """Lê a configuração ``retention`` de cada sala do ``rooms.json``."""
+    for room in rooms:
+        config = room.get('retention') or {}
+        days = config.get('days')
+        _policies[room['id']] = {
+            # Pelo menos uma mensagem fica no histórico ativo (ela dá o próximo ID)
+            'hot_messages': max(int(config.get('hot_messages', DEFAULT_HOT_MESSAGES)), 1),
+            'days': int(days) if days is not None else None
+        }
+
+
+def policy(room_id):
+    return _policies.get(room_id, {'hot_messages': DEFAULT_HOT_MESSAGES, 'days': None})
+
+
+def compact_room(storage, room_id):
+    """Arquiva o que passou da janela quente e aplica o prazo da sala.
+
+    Retorna (mensagens arquivadas, mensagens apagadas).
+    """
+    room_policy = policy(room_id)
+    with metrics.timed('chat_archive_seconds'):
+        archived = storage.archive_room(room_id, room_policy['hot_messages'])
+        removed = 0
+        if room_policy['days'] is not None:
+            removed = archive.apply_retention(room_id, room_policy['days'],
+                                              on_expired=lambda messages: _release_uploads(storage, messages))
+    if archived:
+        metrics.inc('chat_archived_messages_total', archived, room=room_id)
+    if removed:
+        metrics.inc('chat_expired_messages_total', removed, room=room_id)
+    return archived, removed
+
+
+def _release_uploads(storage, messages):
+    """Desconta as referências às imagens das mensagens apagadas pelo prazo."""
+    for message in messages:
+        filename = uploads.image_reference(message.get('message'))
+        if filename:
+            storage.release_upload_reference(filename)
+
+
+def _run(storage, room_id):
+    with _lock:
+        _pending.discard(room_id)
+    try:
+        compact_room(storage, room_id)
+    except Exception as e:
+        print(f"Erro ao arquivar a sala {room_id}: {e}")
+
+
+def schedule(storage, room_id):
+    """Agenda o arquivamento da sala (uma vez, mesmo se chamado várias)."""
+    with _lock:
+        if room_id in _pending:
+            return
+        _pending.add(room_id)
+    _executor.submit(_run, storage, room_id)
+
+
+def message_added(storage, room_id, message_id):
+    """Chamada a cada mensagem nova: de tempos em tempos agenda a sala."""
+    if message_id % ARCHIVE_EVERY == 0:
+        schedule(storage, room_id)
+
+
+def _compact_forever(storage):
+    while True:
+        for room_id in list(_policies):
+            schedule(storage, room_id)
+        time.sleep(RETENTION_INTERVAL)
+
+
+def start_scheduler(storage):
+    """Inicia (uma única vez) a passagem periódica por todas as salas."""
+    with _lock:
+        if _scheduler['thread'] is None:
+            thread = threading.Thread(target=_compact_forever, args=(storage,),
+                                      name='retention-scheduler', daemon=True)
+            thread.start()
+            _scheduler['thread'] = thread
+
+
+metrics.describe('chat_archive_seconds', 'histogram', 'Tempo de cada arquivamento de sala')
+metrics.describe('chat_archived_messages_total', 'counter', 'Mensagens movidas para o arquivo morto')
+metrics.describe('chat_expired_messages_total', 'counter', 'Mensagens apagadas pelo prazo de retenção')
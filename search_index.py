@@ -0,0 +1,413 @@
+"""Busca textual nas mensagens com um índice invertido em segmentos.
+
+O texto é quebrado em tokens sem acento e em minúsculas ("Ação" e "acao"
+são o mesmo token). Cada mensagem indexada vira um documento; dentro de um
+segmento os documentos são numerados em ordem de chegada, então as listas
+de documentos de cada token já estão em ordem: percorrê-las de trás para
+frente (e os segmentos do mais novo para o mais antigo) dá os resultados
+mais recentes primeiro.
+
+A indexação não acontece na requisição: ``add_message`` só põe a mensagem
+numa fila, e uma thread (``search-indexer``) tokeniza e grava as mensagens
+em lotes. Uma queda pode perder do índice as mensagens que ainda estavam
+na fila; ``flask --app app reindex-search`` recria o índice.
+
+Segmentos:
+
+- o ativo fica em memória e em ``data/search_index.json`` (snapshot + log
+  do ``message_log``, snapshot sem indentação), com os tokens já
+  calculados. Ele nunca passa de ``SEGMENT_DOCS`` documentos, então a carga
+  na inicialização e a compactação do log (feita pela thread da indexação)
+  são pequenas;
+- cheio, ele é fechado em ``data/search/segment-<primeiro doc>.json.gz``
+  (documentos e listas de cada token, em gzip), listado no ``index.json``
+  da pasta. Os segmentos fechados só são lidos numa busca, e os últimos
+  lidos ficam num pequeno cache: a memória não cresce com o histórico.
+  Cada entrada do ``index.json`` tem um filtro de Bloom dos tokens do
+  segmento, então a busca só abre os segmentos que podem ter todos os
+  termos (termos comuns ainda leem todos eles: com históricos muito
+  grandes, prefira o backend SQLite).
+
+Um documento guarda só onde está a mensagem (``room:<id>`` ou
+``private:<conversa>``, o ID e, nas privadas, os participantes); o conteúdo
+é buscado no histórico na hora de montar a resposta.
+
+``tokenize`` também é usado pelo backend SQLite, que guarda os mesmos
+tokens numa tabela FTS5.
+"""
+import atexit
+import base64
+import bisect
+import gzip
+import hashlib
+import json
+import os
+import queue
+import re
+import shutil
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from message_log import DATA_DIR, load_records, append_records, save_records, set_snapshot_indent
+
+SEARCH_FILENAME = 'search_index.json'
+SEGMENT_DIR = os.path.join(DATA_DIR, 'search')
+MANIFEST_FILENAME = 'index.json'
+SEGMENT_DOCS = int(os.environ.get('CHAT_SEARCH_SEGMENT_DOCS', 20000))  # Documentos por segmento
+SEGMENT_CACHE_SIZE = 4  # Segmentos fechados mantidos em memória
+BLOOM_BITS_PER_TOKEN = 10  # ~1% de falsos positivos com BLOOM_HASHES
+BLOOM_HASHES = 7
+MIN_TOKEN_LENGTH = 2
+
+_TOKEN_RE = re.compile(r'\w+')
+
+# Segmento ativo: primeiro documento (numeração global) e (documentos, listas)
+_active = {'first_doc': 0, 'index': ([], {})}
+_segments = []  # segmentos fechados, do mais antigo ao mais novo: {'file', 'first_doc', 'count'}
+_segment_cache = OrderedDict()  # arquivo -> (documentos, listas)
+_blooms = {}  # arquivo -> filtro de Bloom já decodificado
+_queue = queue.Queue()  # (escopo, id, texto, participantes) ainda não indexados
+_state = {'loaded': False, 'worker': None}
+_lock = threading.Lock()
+
+set_snapshot_indent(SEARCH_FILENAME, None)
+
+
+def fold(text):
+    """Minúsculas e sem acentos (NFKD sem as marcas combinantes)."""
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def tokenize(text):
+    """Tokens únicos do texto, na ordem em que aparecem."""
+    tokens = []
+    for token in _TOKEN_RE.findall(fold(text or '')):
+        if len(token) >= MIN_TOKEN_LENGTH and token not in tokens:
+            tokens.append(token)
+    return tokens
+
+
+def _add(index, record):
+    """Adiciona o documento ao segmento (o ativo, só com _lock)."""
+    docs, postings = index
+    doc = len(docs)
+    users = record.get('users')
+    docs.append((record['scope'], record['id'], tuple(users) if users else None))
+    for token in record['tokens']:
+        postings.setdefault(token, []).append(doc)
+
+
+def _build(records):
+    index = ([], {})
+    for record in records:
+        _add(index, record)
+    return index
+
+
+# ========== SEGMENTOS FECHADOS ==========
+
+def _manifest_path():
+    return os.path.join(SEGMENT_DIR, MANIFEST_FILENAME)
+
+
+def _read_manifest():
+    try:
+        with open(_manifest_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)['segments']
+    except FileNotFoundError:
+        return []
+
+
+def _write_manifest(entries):
+    path = _manifest_path()
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'segments': entries}, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def _bloom_positions(token, size):
+    digest = hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest()
+    h1, h2 = int.from_bytes(digest[:4], 'little'), int.from_bytes(digest[4:], 'little') | 1
+    return [(h1 + i * h2) % size for i in range(BLOOM_HASHES)]
+
+
+def _bloom(tokens):
+    """Filtro de Bloom (base64) com os tokens do segmento."""
+    # Tamanho múltiplo de 8: quem consulta o deduz do número de bytes
+    bits = bytearray(max(len(tokens) * BLOOM_BITS_PER_TOKEN // 8 + 1, 8))
+    size = len(bits) * 8
+    for token in tokens:
+        for position in _bloom_positions(token, size):
+            bits[position >> 3] |= 1 << (position & 7)
+    return base64.b64encode(bytes(bits)).decode('ascii')
+
+
+def _may_contain(entry, tokens):
+    """False se o segmento com certeza não tem algum dos tokens."""
+    bits = _blooms.get(entry['file'])
+    if bits is None:
+        bits = _blooms[entry['file']] = base64.b64decode(entry['bloom'])
+    size = len(bits) * 8
+    return all(bits[position >> 3] & (1 << (position & 7))
+               for token in tokens for position in _bloom_positions(token, size))
+
+
+def _write_segment(first_doc, index):
+    """Grava um segmento fechado e retorna a entrada dele no índice."""
+    docs, postings = index
+    os.makedirs(SEGMENT_DIR, exist_ok=True)
+    filename = f'segment-{first_doc}.json.gz'
+    path = os.path.join(SEGMENT_DIR, filename)
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump({'docs': docs, 'postings': postings}, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+    return {'file': filename, 'first_doc': first_doc, 'count': len(docs), 'bloom': _bloom(postings)}
+
+
+def _cache_segment(filename, index):
+    with _lock:
+        _segment_cache[filename] = index
+        _segment_cache.move_to_end(filename)
+        while len(_segment_cache) > SEGMENT_CACHE_SIZE:
+            _segment_cache.popitem(last=False)
+
+
+def _read_segment(entry):
+    with _lock:
+        index = _segment_cache.get(entry['file'])
+        if index is not None:
+            _segment_cache.move_to_end(entry['file'])
+            return index
+    with gzip.open(os.path.join(SEGMENT_DIR, entry['file']), 'rt', encoding='utf-8') as f:
+        data = json.load(f)
+    index = ([(scope, message_id, tuple(users) if users else None) for scope, message_id, users in data['docs']],
+             data['postings'])
+    _cache_segment(entry['file'], index)
+    return index
+
+
+def _active_records():
+    """Registros do segmento ativo em disco e o número do primeiro.
+
+    Se o processo caiu ao fechar um segmento (depois de gravar o
+    ``index.json`` e antes de zerar o ativo), os documentos que já estão num
+    segmento fechado são descartados.
+    """
+    records, extra = load_records(SEARCH_FILENAME, key='docs')
+    first_doc = extra.get('first_doc', 0)
+    sealed_end = _segments[-1]['first_doc'] + _segments[-1]['count'] if _segments else 0
+    if first_doc < sealed_end:
+        records = records[sealed_end - first_doc:]
+        first_doc = sealed_end
+        save_records(records, SEARCH_FILENAME, key='docs', extra={'first_doc': first_doc})
+    return records, first_doc
+
+
+def _ensure_loaded():
+    if _state['loaded']:
+        return
+    with _lock:
+        if _state['loaded']:
+            return
+        _segments[:] = _read_manifest()
+        records, first_doc = _active_records()
+        _active['first_doc'], _active['index'] = first_doc, _build(records)
+        _state['loaded'] = True
+
+
+def _seal():
+    """Fecha o segmento ativo em segmentos de SEGMENT_DOCS documentos.
+
+    O que sobra (menos que SEGMENT_DOCS) continua como segmento ativo.
+    Chamada só pela thread da indexação, a única que escreve no índice.
+    """
+    records, first_doc = _active_records()
+    full = len(records) // SEGMENT_DOCS * SEGMENT_DOCS
+    if not full:
+        return
+    entries = list(_segments)
+    for start in range(0, full, SEGMENT_DOCS):
+        index = _build(records[start:start + SEGMENT_DOCS])
+        entries.append(_write_segment(first_doc + start, index))
+    _write_manifest(entries)
+    rest = records[full:]
+    save_records(rest, SEARCH_FILENAME, key='docs', extra={'first_doc': first_doc + full})
+    with _lock:
+        _segments[:] = entries
+        _active['first_doc'], _active['index'] = first_doc + full, _build(rest)
+    # O segmento recém-fechado é o mais provável na próxima busca
+    _cache_segment(entries[-1]['file'], index)
+
+
+# ========== INDEXAÇÃO EM SEGUNDO PLANO ==========
+
+def _index_batch(batch):
+    _ensure_loaded()
+    records = []
+    for scope, message_id, text, participants in batch:
+        tokens = tokenize(text)
+        if not tokens:
+            continue
+        record = {'scope': scope, 'id': message_id, 'tokens': tokens}
+        if participants:
+            record['users'] = list(participants)
+        records.append(record)
+    if records:
+        # Uma escrita por lote (e a compactação do log, quando vem) fora do _lock
+        append_records(records, SEARCH_FILENAME, key='docs')
+        with _lock:
+            for record in records:
+                _add(_active['index'], record)
+    if len(_active['index'][0]) >= SEGMENT_DOCS:
+        _seal()
+
+
+def _index_forever():
+    while True:
+        batch = [_queue.get()]
+        while True:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _index_batch(batch)
+        except Exception as e:
+            print(f"Erro ao indexar mensagens para a busca: {e}")
+        finally:
+            for _ in batch:
+                _queue.task_done()
+
+
+def _start_worker():
+    if _state['worker'] is not None:
+        return
+    with _lock:
+        if _state['worker'] is None:
+            worker = threading.Thread(target=_index_forever, name='search-indexer', daemon=True)
+            worker.start()
+            _state['worker'] = worker
+            atexit.register(flush)
+
+
+def add_message(scope, message_id, text, participants=None):
+    """Agenda a indexação de uma mensagem nova (feita em segundo plano).
+
+    ``participants`` (nas conversas privadas) são os usernames em
+    minúsculas de quem pode ver a mensagem.
+    """
+    if not text:
+        return
+    _start_worker()
+    _queue.put((scope, message_id, text, tuple(participants) if participants else None))
+
+
+def flush():
+    """Espera a fila de indexação esvaziar."""
+    if _state['worker'] is not None:
+        _queue.join()
+
+
+def pending_count():
+    return _queue.qsize()
+
+
+# ========== BUSCA ==========
+
+def _contains(docs, doc):
+    i = bisect.bisect_left(docs, doc)
+    return i < len(docs) and docs[i] == doc
+
+
+def _matches(index, tokens, scopes, user):
+    """Documentos do segmento com todos os tokens, do mais novo para o mais antigo."""
+    docs, postings = index
+    lists = [postings.get(token) for token in tokens]
+    if not all(lists):
+        return []
+    # Percorre a lista menor e confere as outras por busca binária
+    lists.sort(key=len)
+    smallest, others = lists[0], lists[1:]
+    matches = []
+    for doc in reversed(smallest):
+        if not all(_contains(other, doc) for other in others):
+            continue
+        scope, message_id, participants = docs[doc]
+        if scope in scopes or (participants and user in participants):
+            matches.append((scope, message_id))
+    return matches
+
+
+def search(query, scopes=(), user=None, limit=20, offset=0):
+    """Mensagens que têm todos os termos, das mais recentes para as antigas.
+
+    São aceitos documentos dos escopos em ``scopes`` e das conversas
+    privadas em que ``user`` participa (``user=None`` ignora as privadas).
+    Retorna ([(escopo, id da mensagem)] da página, total).
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return [], 0
+    _ensure_loaded()
+    scopes = set(scopes)
+    user = user.lower() if user else None
+    with _lock:
+        active, segments = _active['index'], list(_segments)
+
+    matches = _matches(active, tokens, scopes, user)
+    for entry in reversed(segments):
+        if not _may_contain(entry, tokens):
+            continue
+        try:
+            index = _read_segment(entry)
+        except FileNotFoundError:
+            continue  # Apagado por um reindex-search enquanto buscávamos
+        matches.extend(_matches(index, tokens, scopes, user))
+    return matches[offset:offset + limit], len(matches)
+
+
+def rebuild(documents):
+    """Recria o índice do zero.
+
+    ``documents`` é um iterável de (escopo, mensagem, participantes, texto
+    extra), com cada conversa em ordem cronológica.
+    """
+    records = []
+    for scope, message, participants, extra in documents:
+        tokens = tokenize(message_search_text(message, extra))
+        if tokens:
+            record = {'scope': scope, 'id': message['id'], 'tokens': tokens}
+            if participants:
+                record['users'] = list(participants)
+            records.append(record)
+    flush()
+
+    shutil.rmtree(SEGMENT_DIR, ignore_errors=True)
+    full = len(records) // SEGMENT_DOCS * SEGMENT_DOCS
+    entries = [_write_segment(start, _build(records[start:start + SEGMENT_DOCS]))
+               for start in range(0, full, SEGMENT_DOCS)]
+    if entries:
+        _write_manifest(entries)
+    rest = records[full:]
+    save_records(rest, SEARCH_FILENAME, key='docs', extra={'first_doc': full})
+    with _lock:
+        _segments[:] = entries
+        _segment_cache.clear()
+        _blooms.clear()
+        _active['first_doc'], _active['index'] = full, _build(rest)
+        _state['loaded'] = True
+    return len(records)
+
+
+def message_search_text(message, extra=''):
+    """Texto pesquisável de uma mensagem: o conteúdo (imagens não têm
+    texto, só a referência ao arquivo) mais ``extra`` (ex: tags da imagem).
+    """
+    text = message.get('message') or ''
+    if message.get('type') == 'image' or text.startswith('[IMAGE:'):
+        text = ''
+    return f'{text} {extra}'.strip()
@@ -0,0 +1,638 @@
+"""Backend SQLite (modo WAL) para rodar o app com vários processos.
+
+Tudo que os processos precisam enxergar igual fica no banco: usuários,
+mensagens das salas, conversas privadas, galeria (com uma tabela de tags
+para a busca por prefixo), contagem de referências dos uploads, as versões
+dos canais do ``notifier`` (usadas nos ETags e no push) e quem está online
+e digitando (``presence``, com o prazo de cada registro).
+
+Com WAL, leitores não bloqueiam o escritor nem uns aos outros; as escritas
+usam ``BEGIN IMMEDIATE``, então o próximo ID de uma sala ou conversa é
+calculado e gravado na mesma transação, sem colisão entre processos. Cada
+thread usa sua própria conexão.
+
+As mensagens e memes são guardados como JSON (coluna ``data``), no mesmo
+formato dos arquivos, ao lado das colunas usadas nas consultas.
+
+As mensagens antigas das salas saem do banco para o mesmo arquivo morto
+do backend JSON (``archive.py``, em ``data/archive``).
+"""
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+
+import archive
+import conversation_index
+import gallery_index
+import metrics
+import search_index
+from message_log import load_messages, load_records
+from storage import json_history_files, history_with_archive
+
+BUSY_TIMEOUT_MS = 5000  # Quanto uma escrita espera pelo lock de outro processo
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    username_key TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL,
+    created_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS room_messages (
+    room_id TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (room_id, id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS private_messages (
+    conversation_id TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS gallery (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dedup_key TEXT NOT NULL UNIQUE,
+    is_private INTEGER NOT NULL,
+    uploaded_by TEXT,
+    target_user TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS gallery_private_uploader ON gallery (uploaded_by) WHERE is_private;
+CREATE INDEX IF NOT EXISTS gallery_private_target ON gallery (target_user) WHERE is_private;
+
+CREATE TABLE IF NOT EXISTS gallery_tags (
+    tag TEXT NOT NULL,
+    meme_id INTEGER NOT NULL,
+    PRIMARY KEY (tag, meme_id)
+) WITHOUT ROWID;
+
+-- Índice de conversas privadas de cada usuário (/conversations)
+CREATE TABLE IF NOT EXISTS conversations (
+    username_key TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    with_user TEXT NOT NULL,
+    last_message_id INTEGER NOT NULL,
+    last_activity TEXT NOT NULL,
+    unread INTEGER NOT NULL DEFAULT 0,
+    last_read_id INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (username_key, conversation_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS upload_refs (
+    filename TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Busca: tokens já normalizados (search_index.tokenize); rowid = ordem de chegada
+CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(
+    tokens, scope UNINDEXED, message_id UNINDEXED, users UNINDEXED
+);
+
+CREATE TABLE IF NOT EXISTS channel_versions (
+    channel TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Online e digitando (presence.py); expires_at em segundos (time.time())
+CREATE TABLE IF NOT EXISTS presence (
+    kind TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (kind, room_id, username)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS presence_expires ON presence (expires_at);
+"""
+
+# Maior caractere Unicode: "prefixo" <= tag < "prefixo" + isto
+_PREFIX_END = '\U0010ffff'
+
+
+def _dumps(record):
+    return json.dumps(record, ensure_ascii=False)
+
+
+class SqliteStorage:
+    """Armazenamento compartilhado entre processos num arquivo SQLite."""
+
+    # Versões dos canais ficam no banco: todos os processos as enxergam
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._local = threading.local()
+        db = self._connection()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(SCHEMA)
+        with self._transaction() as db:
+            db.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)',
+                       ('instance_id', uuid.uuid4().hex[:8]))
+        # Fixo para o banco (e não por processo): um ETag gerado por um
+        # processo continua válido quando o próximo poll cai em outro
+        self.instance_id = db.execute("SELECT value FROM meta WHERE key = 'instance_id'").fetchone()[0]
+        # Bancos criados antes do índice de conversas: monta uma vez
+        if not db.execute("SELECT 1 FROM meta WHERE key = 'conversations_built'").fetchone():
+            self.rebuild_conversations()
+
+    def start_workers(self):
+        """Nada a iniciar: cada escrita já vai direto para o banco."""
+
+    def _connection(self):
+        """Conexão da thread atual (sqlite3 não compartilha conexões entre threads)."""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """Transação de escrita (pega o lock de escrita logo no início)."""
+        db = self._connection()
+        with metrics.timed('chat_storage_write_seconds', op='sqlite'):
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    # ----- Mensagens (salas e conversas privadas) -----
+
+    def _messages(self, table, key_column, key, after_id):
+        db = self._connection()
+        rows = db.execute(
+            f'SELECT data FROM {table} WHERE {key_column} = ? AND id > ? ORDER BY id',
+            (key, after_id or 0)
+        )
+        return [json.loads(data) for (data,) in rows]
+
+    def _history(self, table, key_column, key, before_id, limit):
+        """Página anterior a before_id, lida de trás para frente pelo índice."""
+        db = self._connection()
+        if before_id is None:
+            rows = db.execute(
+                f'SELECT data FROM {table} WHERE {key_column} = ? ORDER BY id DESC LIMIT ?',
+                (key, limit)
+            ).fetchall()
+        else:
+            rows = db.execute(
+                f'SELECT data FROM {table} WHERE {key_column} = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                (key, before_id, limit)
+            ).fetchall()
+        return [json.loads(data) for (data,) in reversed(rows)]
+
+    def _add_message(self, table, key_column, key, message):
+        with self._transaction() as db:
+            self._insert_message(db, table, key_column, key, message)
+        return message
+
+    @staticmethod
+    def _insert_message(db, table, key_column, key, message):
+        last_id = db.execute(f'SELECT MAX(id) FROM {table} WHERE {key_column} = ?', (key,)).fetchone()[0]
+        message['id'] = (last_id or 0) + 1
+        db.execute(f'INSERT INTO {table} ({key_column}, id, data) VALUES (?, ?, ?)',
+                   (key, message['id'], _dumps(message)))
+
+    def room_messages(self, room_id, after_id=None):
+        return self._messages('room_messages', 'room_id', room_id, after_id)
+
+    def last_message_id(self, room_id):
+        row = self._connection().execute(
+            'SELECT MAX(id) FROM room_messages WHERE room_id = ?', (room_id,)
+        ).fetchone()
+        return row[0] or archive.last_archived_id(room_id)
+
+    def room_sizes(self):
+        return self._connection().execute(
+            'SELECT room_id, COUNT(*) FROM room_messages GROUP BY room_id'
+        ).fetchall()
+
+    def room_history(self, room_id, before_id=None, limit=50):
+        page = self._history('room_messages', 'room_id', room_id, before_id, limit)
+        return history_with_archive(room_id, page, before_id, limit)
+
+    def all_room_messages(self, room_id):
+        return archive.iter_messages(room_id) + self.room_messages(room_id)
+
+    def archive_room(self, room_id, keep):
+        """Move para o arquivo morto tudo menos as ``keep`` últimas mensagens.
+
+        Os segmentos são gravados fora de transação; só a remoção das linhas
+        arquivadas pega o lock de escrita. Se dois processos arquivarem a
+        mesma sala, o arquivo morto ignora o que já tem.
+        """
+        db = self._connection()
+        last_id = db.execute('SELECT MAX(id) FROM room_messages WHERE room_id = ?', (room_id,)).fetchone()[0]
+        if not last_id:
+            return 0
+        rows = db.execute(
+            'SELECT data FROM room_messages WHERE room_id = ? AND id <= ? ORDER BY id',
+            (room_id, last_id - keep)
+        ).fetchall()
+        if not rows:
+            return 0
+        archived_id = archive.write_segments(room_id, [json.loads(data) for (data,) in rows])
+        with self._transaction() as db:
+            db.execute('DELETE FROM room_messages WHERE room_id = ? AND id <= ?', (room_id, archived_id))
+        return len(rows)
+
+    def add_room_message(self, room_id, message):
+        return self._add_message('room_messages', 'room_id', room_id, message)
+
+    def private_messages(self, conversation_id, after_id=None):
+        return self._messages('private_messages', 'conversation_id', conversation_id, after_id)
+
+    def private_history(self, conversation_id, before_id=None, limit=50):
+        return self._history('private_messages', 'conversation_id', conversation_id, before_id, limit)
+
+    def add_private_message(self, conversation_id, message):
+        """Adiciona a mensagem e atualiza o índice de conversas, na mesma transação."""
+        at = conversation_index.now()
+        with self._transaction() as db:
+            self._insert_message(db, 'private_messages', 'conversation_id', conversation_id, message)
+            # Quem envia já leu a conversa; quem recebe ganha uma não lida
+            db.execute(
+                'INSERT INTO conversations (username_key, conversation_id, with_user, last_message_id, '
+                'last_activity, unread, last_read_id) VALUES (?, ?, ?, ?, ?, 0, ?) '
+                'ON CONFLICT (username_key, conversation_id) DO UPDATE SET with_user = excluded.with_user, '
+                'last_message_id = excluded.last_message_id, last_activity = excluded.last_activity, '
+                'unread = 0, last_read_id = excluded.last_message_id',
+                (message['from'].lower(), conversation_id, message['to'], message['id'], at, message['id'])
+            )
+            if message['to'].lower() != message['from'].lower():
+                db.execute(
+                    'INSERT INTO conversations (username_key, conversation_id, with_user, last_message_id, '
+                    'last_activity, unread) VALUES (?, ?, ?, ?, ?, 1) '
+                    'ON CONFLICT (username_key, conversation_id) DO UPDATE SET with_user = excluded.with_user, '
+                    'last_message_id = excluded.last_message_id, last_activity = excluded.last_activity, '
+                    'unread = unread + 1',
+                    (message['to'].lower(), conversation_id, message['from'], message['id'], at)
+                )
+        return message
+
+    def conversation_ids(self):
+        rows = self._connection().execute('SELECT DISTINCT conversation_id FROM private_messages')
+        return [conversation_id for (conversation_id,) in rows]
+
+    # ----- Índice de conversas por usuário -----
+
+    def conversations(self, username):
+        rows = self._connection().execute(
+            'SELECT with_user, last_message_id, last_activity, unread FROM conversations '
+            'WHERE username_key = ? ORDER BY last_activity DESC, last_message_id DESC',
+            (username.lower(),)
+        )
+        return [{'with': with_user, 'last_message_id': last_message_id, 'last_activity': last_activity,
+                 'unread': unread}
+                for with_user, last_message_id, last_activity, unread in rows]
+
+    def mark_conversation_read(self, username, conversation_id, message_id):
+        # No SET, last_read_id ainda é o valor antigo
+        with self._transaction() as db:
+            cursor = db.execute(
+                'UPDATE conversations SET last_read_id = max(last_read_id, ?), '
+                'unread = min(unread, max(last_message_id - max(last_read_id, ?), 0)) '
+                'WHERE username_key = ? AND conversation_id = ? AND (unread > 0 OR last_read_id < ?)',
+                (message_id, message_id, username.lower(), conversation_id, message_id)
+            )
+        return cursor.rowcount > 0
+
+    def rebuild_conversations(self):
+        histories = ((conversation_id, self.private_messages(conversation_id))
+                     for conversation_id in self.conversation_ids())
+        users = conversation_index.summarize(histories)
+        rows = [(user, conversation_id, entry['with'], entry['last_message_id'], entry['last_activity'],
+                 entry['unread'], entry['last_read_id'])
+                for user, user_conversations in users.items()
+                for conversation_id, entry in user_conversations.items()]
+        with self._transaction() as db:
+            db.execute('DELETE FROM conversations')
+            db.executemany('INSERT INTO conversations (username_key, conversation_id, with_user, last_message_id, '
+                           'last_activity, unread, last_read_id) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('conversations_built', '1')")
+        return len({row[1] for row in rows})
+
+    # ----- Busca -----
+
+    def _search_row(self, scope, message, participants, extra):
+        tokens = search_index.tokenize(search_index.message_search_text(message, extra))
+        if not tokens:
+            return None
+        # Participantes entre '|' para conferir com instr() na consulta
+        users = '|' + '|'.join(participants) + '|' if participants else ''
+        return ' '.join(tokens), scope, message['id'], users
+
+    def index_message(self, scope, message, participants=None, extra=''):
+        row = self._search_row(scope, message, participants, extra)
+        if row is not None:
+            with self._transaction() as db:
+                db.execute('INSERT INTO message_search (tokens, scope, message_id, users) VALUES (?, ?, ?, ?)', row)
+
+    def search_messages(self, query, scopes=(), user=None, limit=20, offset=0):
+        tokens = search_index.tokenize(query)
+        if not tokens:
+            return [], 0
+        # Todos os termos (AND implícito do FTS5), cada um entre aspas
+        match = ' '.join(f'"{token}"' for token in tokens)
+        scopes = list(scopes)
+        visible = []
+        params = [match]
+        if scopes:
+            visible.append(f"scope IN ({', '.join('?' for _ in scopes)})")
+            params += scopes
+        if user:
+            visible.append("instr(users, ?) > 0")
+            params.append(f'|{user.lower()}|')
+        if not visible:
+            return [], 0
+        condition = f"message_search MATCH ? AND ({' OR '.join(visible)})"
+        db = self._connection()
+        total = db.execute(f'SELECT COUNT(*) FROM message_search WHERE {condition}', params).fetchone()[0]
+        rows = db.execute(
+            f'SELECT scope, message_id FROM message_search WHERE {condition} ORDER BY rowid DESC LIMIT ? OFFSET ?',
+            params + [limit, offset]
+        ).fetchall()
+        return [(scope, message_id) for scope, message_id in rows], total
+
+    def rebuild_search(self, documents):
+        rows = [row for row in (self._search_row(*document) for document in documents) if row is not None]
+        with self._transaction() as db:
+            db.execute('DELETE FROM message_search')
+            db.executemany('INSERT INTO message_search (tokens, scope, message_id, users) VALUES (?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def all_messages(self):
+        db = self._connection()
+        for table in ('room_messages', 'private_messages'):
+            for (data,) in db.execute(f'SELECT data FROM {table}'):
+                yield json.loads(data)
+        for room_id in archive.archived_rooms():
+            yield from archive.iter_messages(room_id)
+
+    # ----- Usuários -----
+
+    def _user(self, row):
+        if row is None:
+            return None
+        user_id, username, password, created_at = row
+        return {'id': user_id, 'username': username, 'password': password, 'created_at': created_at}
+
+    def find_user(self, username):
+        row = self._connection().execute(
+            'SELECT id, username, password, created_at FROM users WHERE username_key = ?',
+            (username.casefold(),)
+        ).fetchone()
+        return self._user(row)
+
+    def get_user(self, user_id):
+        row = self._connection().execute(
+            'SELECT id, username, password, created_at FROM users WHERE id = ?', (user_id,)
+        ).fetchone()
+        return self._user(row)
+
+    def create_user(self, username, password_hash, created_at):
+        """Cria o usuário; retorna None se o username já existir."""
+        try:
+            with self._transaction() as db:
+                cursor = db.execute(
+                    'INSERT INTO users (username, username_key, password, created_at) VALUES (?, ?, ?, ?)',
+                    (username, username.casefold(), password_hash, created_at)
+                )
+        except sqlite3.IntegrityError:
+            return None
+        return {'id': cursor.lastrowid, 'username': username, 'password': password_hash, 'created_at': created_at}
+
+    # ----- Galeria -----
+
+    def add_meme(self, meme):
+        """Mesma regra do ``gallery_index``: imagem repetida só soma tags."""
+        key = _dumps(gallery_index.dedup_key(meme))
+        with self._transaction() as db:
+            row = db.execute('SELECT id, data FROM gallery WHERE dedup_key = ?', (key,)).fetchone()
+            if row is not None:
+                meme_id, data = row
+                existing = json.loads(data)
+                new_tags = [tag for tag in meme.get('tags', []) if tag not in existing.get('tags', [])]
+                if new_tags:
+                    existing['tags'] = existing.get('tags', []) + new_tags
+                    db.execute('UPDATE gallery SET data = ? WHERE id = ?', (_dumps(existing), meme_id))
+                    db.executemany('INSERT OR IGNORE INTO gallery_tags (tag, meme_id) VALUES (?, ?)',
+                                   [(tag, meme_id) for tag in new_tags])
+                return existing, False
+
+            meme['id'] = self._insert_meme(db, meme, key)
+        return meme, True
+
+    def _insert_meme(self, db, meme, key):
+        is_private = bool(meme.get('is_private', False))
+        cursor = db.execute(
+            'INSERT INTO gallery (id, dedup_key, is_private, uploaded_by, target_user, data) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (meme.get('id'), key, is_private, meme.get('uploaded_by'), meme.get('target_user'), '{}')
+        )
+        meme_id = cursor.lastrowid
+        db.execute('UPDATE gallery SET data = ? WHERE id = ?', (_dumps(dict(meme, id=meme_id)), meme_id))
+        db.executemany('INSERT OR IGNORE INTO gallery_tags (tag, meme_id) VALUES (?, ?)',
+                       [(tag, meme_id) for tag in meme.get('tags', [])])
+        return meme_id
+
+    def search_memes(self, current_user, tags='', is_private_chat=False, target_user='', limit=None, offset=0):
+        """Busca memes visíveis (tags por prefixo). Retorna (página, total)."""
+        where = ['(is_private = 0 OR uploaded_by = ?']
+        params = [current_user]
+        if is_private_chat:
+            # Meme de outra pessoa: só aparece na conversa privada correta
+            where[0] += ' OR target_user IN (?, ?)'
+            params += [target_user, current_user]
+        where[0] += ')'
+
+        search_list = [tag.strip() for tag in tags.lower().split(',') if tag.strip()]
+        if search_list:
+            ranges = ' OR '.join('(tag >= ? AND tag < ?)' for _ in search_list)
+            where.append(f'id IN (SELECT meme_id FROM gallery_tags WHERE {ranges})')
+            for term in search_list:
+                params += [term, term + _PREFIX_END]
+
+        db = self._connection()
+        condition = ' AND '.join(where)
+        total = db.execute(f'SELECT COUNT(*) FROM gallery WHERE {condition}', params).fetchone()[0]
+        rows = db.execute(
+            f'SELECT data FROM gallery WHERE {condition} ORDER BY id LIMIT ? OFFSET ?',
+            params + [limit if limit is not None else -1, offset]
+        )
+        return [json.loads(data) for (data,) in rows], total
+
+    def all_memes(self):
+        rows = self._connection().execute('SELECT data FROM gallery ORDER BY id')
+        return [json.loads(data) for (data,) in rows]
+
+    # ----- Referências aos uploads -----
+
+    def add_upload_reference(self, filename, delta=1):
+        with self._transaction() as db:
+            db.execute(
+                'INSERT INTO upload_refs (filename, count) VALUES (?, MAX(?, 0)) '
+                'ON CONFLICT (filename) DO UPDATE SET count = MAX(count + ?, 0)',
+                (filename, delta, delta)
+            )
+
+    def release_upload_reference(self, filename):
+        self.add_upload_reference(filename, -1)
+
+    def upload_reference_count(self, filename):
+        """Referências ao arquivo, ou None se ele não tem contagem (desconhecido)."""
+        row = self._connection().execute(
+            'SELECT count FROM upload_refs WHERE filename = ?', (filename,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def upload_references_built(self):
+        return self._connection().execute(
+            "SELECT 1 FROM meta WHERE key = 'upload_refs_built'"
+        ).fetchone() is not None
+
+    def rebuild_upload_references(self, filenames, known=()):
+        counts = dict.fromkeys(known, 0)
+        for filename in filenames:
+            counts[filename] = counts.get(filename, 0) + 1
+        with self._transaction() as db:
+            db.execute('DELETE FROM upload_refs')
+            db.executemany('INSERT INTO upload_refs (filename, count) VALUES (?, ?)', counts.items())
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('upload_refs_built', '1')")
+
+    # ----- Versões dos canais (notifier) -----
+
+    def get_version(self, channel):
+        row = self._connection().execute(
+            'SELECT version FROM channel_versions WHERE channel = ?', (channel,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def bump_version(self, channel):
+        with self._transaction() as db:
+            db.execute(
+                'INSERT INTO channel_versions (channel, version) VALUES (?, 1) '
+                'ON CONFLICT (channel) DO UPDATE SET version = version + 1',
+                (channel,)
+            )
+
+    # ----- Online e digitando (presence) -----
+
+    def presence_expiry(self, kind, room_id, user):
+        row = self._connection().execute(
+            'SELECT expires_at FROM presence WHERE kind = ? AND room_id = ? AND username = ?',
+            (kind, room_id, user)
+        ).fetchone()
+        return row[0] if row else None
+
+    def refresh_presence(self, kind, room_id, user, expires_at, now):
+        """Grava o prazo do usuário. Retorna True se ele não estava na lista."""
+        with self._transaction() as db:
+            row = db.execute(
+                'SELECT expires_at FROM presence WHERE kind = ? AND room_id = ? AND username = ?',
+                (kind, room_id, user)
+            ).fetchone()
+            db.execute('INSERT OR REPLACE INTO presence (kind, room_id, username, expires_at) VALUES (?, ?, ?, ?)',
+                       (kind, room_id, user, expires_at))
+        # Um registro vencido que a varredura ainda não apagou já não aparecia
+        return row is None or row[0] <= now
+
+    def remove_presence(self, kind, room_id, user):
+        with self._transaction() as db:
+            cursor = db.execute('DELETE FROM presence WHERE kind = ? AND room_id = ? AND username = ?',
+                                (kind, room_id, user))
+        return cursor.rowcount > 0
+
+    def active_presence(self, kind, room_id, now):
+        rows = self._connection().execute(
+            'SELECT username FROM presence WHERE kind = ? AND room_id = ? AND expires_at > ? ORDER BY username',
+            (kind, room_id, now)
+        )
+        return [user for (user,) in rows]
+
+    def expire_presence(self, now):
+        """Apaga os registros vencidos. Retorna os (tipo, sala) alterados."""
+        db = self._connection()
+        # Todo processo varre a cada segundo: só pega o lock de escrita se houver o que apagar
+        if not db.execute('SELECT 1 FROM presence WHERE expires_at <= ? LIMIT 1', (now,)).fetchone():
+            return set()
+        with self._transaction() as db:
+            changed = db.execute('SELECT DISTINCT kind, room_id FROM presence WHERE expires_at <= ?', (now,)).fetchall()
+            db.execute('DELETE FROM presence WHERE expires_at <= ?', (now,))
+        return set(changed)
+
+    # ----- Importação dos arquivos JSON -----
+
+    def import_json(self, image_reference):
+        """Copia os dados de ``data/*.json`` para o banco.
+
+        Registros que já existem no banco (mesmo ID) são mantidos, então a
+        importação pode ser repetida. ``image_reference`` extrai o upload
+        referenciado por uma mensagem, para recalcular as contagens.
+        Retorna um resumo com o número de registros lidos de cada tipo.
+        """
+        summary = {'users': 0, 'room_messages': 0, 'private_messages': 0, 'memes': 0}
+        users, _ = load_records('users.json', key='users')
+        with self._transaction() as db:
+            for user in users:
+                db.execute(
+                    'INSERT OR IGNORE INTO users (id, username, username_key, password, created_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (user['id'], user['username'], user['username'].casefold(),
+                     user['password'], user.get('created_at'))
+                )
+                summary['users'] += 1
+
+        for name in json_history_files():
+            if name.startswith('chat_'):
+                table, key_column, counter = 'room_messages', 'room_id', 'room_messages'
+                key = name[len('chat_'):-len('.json')]
+            else:
+                table, key_column, counter = 'private_messages', 'conversation_id', 'private_messages'
+                key = name[len('private_'):-len('.json')]
+            messages = load_messages(name)
+            with self._transaction() as db:
+                for index, message in enumerate(messages, start=1):
+                    message.setdefault('id', index)
+                    db.execute(f'INSERT OR IGNORE INTO {table} ({key_column}, id, data) VALUES (?, ?, ?)',
+                               (key, message['id'], _dumps(message)))
+            summary[counter] += len(messages)
+
+        memes = gallery_index.all_memes()
+        with self._transaction() as db:
+            for meme in memes:
+                key = _dumps(gallery_index.dedup_key(meme))
+                exists = db.execute('SELECT 1 FROM gallery WHERE id = ? OR dedup_key = ?',
+                                    (meme['id'], key)).fetchone()
+                if not exists:
+                    self._insert_meme(db, meme, key)
+        summary['memes'] = len(memes)
+
+        def references():
+            for meme in self.all_memes():
+                yield meme['filename']
+            for message in self.all_messages():
+                filename = image_reference(message.get('message'))
+                if filename:
+                    yield filename
+
+        self.rebuild_upload_references(references())
+        return summary
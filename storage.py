@@ -0,0 +1,338 @@
+"""Backends de armazenamento do chat.
+
+O app acessa usuários, mensagens das salas, conversas privadas, galeria e
+contagem de referências dos uploads apenas por um objeto "storage", criado
+por ``create_storage`` conforme a variável de ambiente ``CHAT_STORAGE``:
+
+- ``json`` (padrão): os arquivos em ``data/`` (snapshot + log), com índices
+  e caches em memória (``user_store``, ``private_cache``, ``gallery_index``).
+  Cada sala é carregada no primeiro acesso e descarregada depois de
+  ``ROOM_IDLE_SECONDS`` sem uso. As mensagens novas são gravadas em lotes
+  (``write_behind.py``). O estado vive no processo, então só serve
+  para um único processo servidor.
+- ``sqlite``: um banco SQLite em modo WAL (``sqlite_storage.py``),
+  compartilhado por vários processos do mesmo servidor, por exemplo
+  ``gunicorn -w 4 app:app``. Os dados JSON existentes podem ser importados
+  com ``flask --app app import-sqlite``.
+
+Os dois backends têm os mesmos métodos e devolvem as mensagens e memes como
+dicts no mesmo formato dos arquivos JSON.
+
+Nos dois, as mensagens antigas das salas saem do histórico ativo para o
+arquivo morto (``archive.py``, veja ``retention.py``); o histórico
+paginado continua nelas quando a parte ativa acaba.
+"""
+import os
+import threading
+import time
+import uuid
+
+import archive
+import conversation_index
+import gallery_index
+import private_cache
+import search_index
+import uploads
+import user_store
+import write_behind
+from message_log import DATA_DIR, LOG_SUFFIX, load_messages, read_header, save_records, assign_message_ids, messages_after, messages_before
+
+STORAGE_BACKEND = os.environ.get('CHAT_STORAGE', 'json')
+SQLITE_PATH = os.environ.get('CHAT_SQLITE_PATH', os.path.join(DATA_DIR, 'chat.db'))
+
+# Salas sem acesso por esse tempo saem da memória (backend JSON)
+ROOM_IDLE_SECONDS = float(os.environ.get('CHAT_ROOM_IDLE_SECONDS', 600))
+ROOM_UNLOAD_INTERVAL = 60
+
+
+def room_filename(room_id):
+    return f'chat_{room_id}.json'
+
+
+def history_with_archive(room_id, page, before_id, limit):
+    """Completa com o arquivo morto uma página do histórico ativo que ficou curta."""
+    if len(page) >= limit:
+        return page
+    older_than = page[0]['id'] if page else before_id
+    return archive.read_before(room_id, older_than, limit - len(page)) + page
+
+
+def json_history_files():
+    """Nomes dos históricos JSON em ``data/`` (salas e conversas privadas).
+
+    Um histórico pode existir só como log, ainda sem snapshot.
+    """
+    names = {name[:-len(LOG_SUFFIX)] if name.endswith(LOG_SUFFIX) else name
+             for name in os.listdir(DATA_DIR)}
+    return sorted(name for name in names
+                  if name.startswith(('chat_', 'private_')) and name.endswith('.json'))
+
+
+class JsonStorage:
+    """Arquivos JSON + índices em memória (um único processo)."""
+
+    # Estado local ao processo: as versões do notifier também ficam em memória
+    shared = False
+
+    def __init__(self, room_ids):
+        # Identifica esta execução nos ETags (os contadores recomeçam do zero)
+        self.instance_id = uuid.uuid4().hex[:8]
+        # Salas conhecidas; o histórico só é lido no primeiro acesso
+        self._room_ids = set(room_ids)
+        self._rooms = {}  # sala carregada -> mensagens
+        self._last_used = {}  # sala carregada -> time.monotonic() do último acesso
+        # Um lock por sala: envios em salas diferentes não esperam uns pelos
+        # outros. Leituras não usam lock (as listas só crescem no final).
+        self._room_locks = {}
+        self._room_locks_guard = threading.Lock()
+        self._unloader = None
+
+    def start_workers(self):
+        """Liga a escrita adiada: envios vão para o journal e os históricos
+        são gravados em lotes. Só no processo que atende requisições.
+        """
+        write_behind.start()
+
+    def _room_lock(self, room_id):
+        lock = self._room_locks.get(room_id)
+        if lock is None:
+            with self._room_locks_guard:
+                lock = self._room_locks.setdefault(room_id, threading.RLock())
+        return lock
+
+    def _load_room(self, room_id):
+        messages = assign_message_ids(load_messages(room_filename(room_id)))
+        # Queda no meio de um arquivamento: o que já está no arquivo morto sai
+        archived_id = archive.last_archived_id(room_id)
+        if messages and messages[0]['id'] <= archived_id:
+            messages = messages_after(messages, archived_id)
+        return messages
+
+    def _room(self, room_id):
+        """Mensagens da sala, carregando do disco se ela não está em memória."""
+        messages = self._rooms.get(room_id)
+        if messages is None:
+            if room_id not in self._room_ids:
+                return []
+            with self._room_lock(room_id):
+                messages = self._rooms.get(room_id)
+                if messages is None:
+                    messages = self._rooms[room_id] = self._load_room(room_id)
+                    self._start_unloader()
+        self._last_used[room_id] = time.monotonic()
+        return messages
+
+    def unload_idle_rooms(self, idle_seconds=ROOM_IDLE_SECONDS):
+        """Tira da memória as salas sem acesso há ``idle_seconds``. Retorna quantas."""
+        limit = time.monotonic() - idle_seconds
+        unloaded = 0
+        for room_id in list(self._rooms):
+            if self._last_used.get(room_id, 0) > limit:
+                continue
+            with self._room_lock(room_id):
+                # Tudo já está no disco: basta esquecer a lista
+                if self._last_used.get(room_id, 0) <= limit and self._rooms.pop(room_id, None) is not None:
+                    self._last_used.pop(room_id, None)
+                    unloaded += 1
+        return unloaded
+
+    def _unload_forever(self):
+        while True:
+            time.sleep(ROOM_UNLOAD_INTERVAL)
+            try:
+                self.unload_idle_rooms()
+            except Exception as e:
+                print(f"Erro ao descarregar salas: {e}")
+
+    def _start_unloader(self):
+        if self._unloader is None:
+            self._unloader = threading.Thread(target=self._unload_forever, name='room-unloader', daemon=True)
+            self._unloader.start()
+
+    # ----- Salas -----
+
+    def room_messages(self, room_id, after_id=None):
+        messages = self._room(room_id)
+        if after_id is not None:
+            return messages_after(messages, after_id)
+        return messages
+
+    def last_message_id(self, room_id):
+        messages = self._rooms.get(room_id)
+        if messages is None and room_id in self._room_ids:
+            # Sala fora da memória: o cabeçalho do histórico basta
+            _, last_id = read_header(room_filename(room_id))
+        else:
+            last_id = messages[-1]['id'] if messages else 0
+        return last_id or archive.last_archived_id(room_id)
+
+    def room_sizes(self):
+        """Número de mensagens no histórico ativo de cada sala: [(room_id, total)]."""
+        sizes = []
+        for room_id in sorted(self._room_ids):
+            messages = self._rooms.get(room_id)
+            count = len(messages) if messages is not None else read_header(room_filename(room_id))[0]
+            sizes.append((room_id, count))
+        return sizes
+
+    def room_history(self, room_id, before_id=None, limit=50):
+        """Página do histórico anterior a before_id (busca binária por ID),
+        continuando no arquivo morto.
+        """
+        page = messages_before(self._room(room_id), before_id, limit)
+        return history_with_archive(room_id, page, before_id, limit)
+
+    def all_room_messages(self, room_id):
+        """Histórico completo da sala: arquivo morto + histórico ativo."""
+        return archive.iter_messages(room_id) + list(self._room(room_id))
+
+    def archive_room(self, room_id, keep):
+        """Move para o arquivo morto tudo menos as ``keep`` últimas mensagens.
+
+        Os segmentos são gravados sem o lock da sala; ele só é usado no fim,
+        para regravar o snapshot com a janela quente e trocar a lista.
+        Retorna quantas mensagens foram arquivadas.
+        """
+        if room_id not in self._rooms and read_header(room_filename(room_id))[0] <= keep:
+            return 0  # Sem carregar salas que não precisam
+        messages = self._room(room_id)
+        if len(messages) <= keep:
+            return 0
+        old = messages[:len(messages) - keep]
+        archived_id = archive.write_segments(room_id, old)
+        with self._room_lock(room_id):
+            current = self._rooms.get(room_id)
+            # Descarregada enquanto arquivava: o disco já sem o arquivado
+            hot = messages_after(current, archived_id) if current is not None else self._load_room(room_id)
+            save_records(hot, room_filename(room_id))
+            # Leitores com a lista antiga em mãos continuam vendo dados válidos
+            if current is not None:
+                self._rooms[room_id] = hot
+        return len(old)
+
+    def add_room_message(self, room_id, message):
+        """Atribui o próximo ID à mensagem, persiste e publica na sala."""
+        self._room_ids.add(room_id)
+        with self._room_lock(room_id):
+            messages = self._room(room_id)
+            message['id'] = (messages[-1]['id'] if messages else archive.last_archived_id(room_id)) + 1
+            # Vai para o journal antes de publicar: quem lê nunca vê uma
+            # mensagem que se perderia numa queda
+            write_behind.append_message(message, room_filename(room_id))
+            messages.append(message)
+        return message
+
+    # ----- Conversas privadas -----
+
+    def private_messages(self, conversation_id, after_id=None):
+        messages = private_cache.get_conversation(conversation_id)
+        if after_id is not None:
+            return messages_after(messages, after_id)
+        return messages
+
+    def private_history(self, conversation_id, before_id=None, limit=50):
+        return messages_before(private_cache.get_conversation(conversation_id), before_id, limit)
+
+    def add_private_message(self, conversation_id, message):
+        """Adiciona a mensagem e atualiza o índice de conversas dos dois lados."""
+        self._ensure_conversation_index()
+        private_cache.append_private_message(conversation_id, message)
+        conversation_index.record_message(conversation_id, message)
+        return message
+
+    def conversation_ids(self):
+        write_behind.flush_all()  # Conversas novas só ganham arquivo na gravação
+        prefix = 'private_'
+        return [name[len(prefix):-len('.json')] for name in json_history_files() if name.startswith(prefix)]
+
+    # ----- Índice de conversas por usuário -----
+
+    def _ensure_conversation_index(self):
+        # Conversas anteriores ao índice: monta uma vez a partir dos históricos
+        if not conversation_index.exists():
+            self.rebuild_conversations()
+
+    def conversations(self, username):
+        """Conversas do usuário: [{'with', 'last_message_id', 'last_activity', 'unread'}]."""
+        self._ensure_conversation_index()
+        return conversation_index.conversations(username)
+
+    def mark_conversation_read(self, username, conversation_id, message_id):
+        """Marca a conversa como lida até message_id. Retorna True se mudou algo."""
+        self._ensure_conversation_index()
+        return conversation_index.mark_read(username, conversation_id, message_id)
+
+    def rebuild_conversations(self):
+        histories = ((conversation_id, self.private_messages(conversation_id))
+                     for conversation_id in self.conversation_ids())
+        return conversation_index.rebuild(histories)
+
+    # ----- Busca -----
+
+    def index_message(self, scope, message, participants=None, extra=''):
+        """Indexa uma mensagem nova para a busca (``search_index``)."""
+        search_index.add_message(scope, message['id'], search_index.message_search_text(message, extra), participants)
+
+    def search_messages(self, query, scopes=(), user=None, limit=20, offset=0):
+        return search_index.search(query, scopes, user, limit, offset)
+
+    def rebuild_search(self, documents):
+        return search_index.rebuild(documents)
+
+    # ----- Usuários -----
+
+    def find_user(self, username):
+        return user_store.find_user(username)
+
+    def get_user(self, user_id):
+        return user_store.get_user(user_id)
+
+    def create_user(self, username, password_hash, created_at):
+        return user_store.create_user(username, password_hash, created_at)
+
+    # ----- Galeria -----
+
+    def add_meme(self, meme):
+        return gallery_index.add_meme(meme)
+
+    def search_memes(self, current_user, tags='', is_private_chat=False, target_user='', limit=None, offset=0):
+        return gallery_index.search(current_user, tags, is_private_chat, target_user, limit, offset)
+
+    def all_memes(self):
+        return gallery_index.all_memes()
+
+    # ----- Referências aos uploads -----
+
+    def add_upload_reference(self, filename, delta=1):
+        uploads.add_reference(filename, delta)
+
+    def release_upload_reference(self, filename):
+        uploads.release_reference(filename)
+
+    def upload_reference_count(self, filename):
+        return uploads.reference_count(filename)
+
+    def upload_references_built(self):
+        return uploads.references_built()
+
+    def rebuild_upload_references(self, filenames, known=()):
+        uploads.rebuild_references(filenames, known)
+
+    def all_messages(self):
+        """Todas as mensagens (salas, privadas e arquivo morto), lidas do disco."""
+        write_behind.flush_all()
+        for name in json_history_files():
+            yield from load_messages(name)
+        for room_id in archive.archived_rooms():
+            yield from archive.iter_messages(room_id)
+
+
+def create_storage(room_ids, backend=None):
+    """Cria o backend configurado (``CHAT_STORAGE``: json ou sqlite)."""
+    backend = backend or STORAGE_BACKEND
+    if backend == 'json':
+        return JsonStorage(room_ids)
+    if backend == 'sqlite':
+        from sqlite_storage import SqliteStorage
+        return SqliteStorage(SQLITE_PATH)
+    raise ValueError(f'Backend de armazenamento desconhecido: {backend}')
@@ -0,0 +1,159 @@
+"""Miniaturas (WebP) das imagens enviadas.
+
+As miniaturas são geradas em segundo plano, num pool de threads, logo após
+o upload, e ficam em ``data/uploads/thumbs/<nome>.webp``. Enquanto uma
+miniatura não existe, ``/uploads/<arquivo>?size=thumb`` serve o original.
+
+Cada arquivo é gerado por uma única thread de cada vez (o upload e o
+primeiro ``?size=thumb`` podem agendar o mesmo arquivo), num temporário
+próprio trocado de forma atômica pelo nome final: uma miniatura pela
+metade nunca é servida.
+
+Depende do Pillow (``pip install pillow``). Sem ele, nenhuma miniatura é
+gerada e tudo continua funcionando com as imagens originais.
+"""
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow é opcional
+    Image = None
+
+from uploads import UPLOAD_FOLDER
+
+THUMB_FOLDER = os.path.join(UPLOAD_FOLDER, 'thumbs')
+THUMB_MAX_SIZE = (320, 320)
+THUMB_QUALITY = 75
+THUMB_WORKERS = 2
+
+_executor = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix='thumbs')
+_skipped = set()  # Arquivos sem miniatura possível (animados ou inválidos)
+_in_flight = set()  # Arquivos com a miniatura sendo gerada agora
+_lock = threading.Lock()
+
+
+def thumbnails_enabled():
+    return Image is not None
+
+
+def thumbnail_name(filename):
+    return os.path.splitext(filename)[0] + '.webp'
+
+
+def thumbnail_path(filename):
+    return os.path.join(THUMB_FOLDER, thumbnail_name(filename))
+
+
+def _claim(filename):
+    """Reserva o arquivo para esta thread. False se outra já o está gerando."""
+    with _lock:
+        if filename in _in_flight:
+            return False
+        _in_flight.add(filename)
+        return True
+
+
+def _release(filename):
+    with _lock:
+        _in_flight.discard(filename)
+
+
+def _decode(filename):
+    """Abre o upload e reduz ao tamanho da miniatura. None se for animado."""
+    with Image.open(os.path.join(UPLOAD_FOLDER, filename)) as img:
+        if getattr(img, 'is_animated', False):
+            return None
+        img.thumbnail(THUMB_MAX_SIZE)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        # Cópia: a imagem aberta deixa de ser usável quando o arquivo fecha
+        return img.copy()
+
+
+def _generate(filename):
+    target = thumbnail_path(filename)
+    if os.path.exists(target):
+        return False
+    try:
+        img = _decode(filename)
+    except Exception as e:
+        # Só uma imagem que o Pillow não consegue ler fica sem miniatura de vez
+        _skipped.add(filename)
+        print(f"Erro ao ler {filename} para a miniatura: {e}")
+        return False
+    if img is None:
+        _skipped.add(filename)  # GIF animado
+        return False
+    tmp_path = None
+    try:
+        os.makedirs(THUMB_FOLDER, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=THUMB_FOLDER, prefix='.', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, 'WEBP', quality=THUMB_QUALITY)
+        os.replace(tmp_path, target)
+        tmp_path = None
+        return True
+    except Exception as e:
+        print(f"Erro ao gerar miniatura de {filename}: {e}")
+        return False
+    finally:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+
+def generate_thumbnail(filename):
+    """Gera a miniatura de um upload. Retorna True se ela foi criada.
+
+    GIFs animados são ignorados: a miniatura mostraria só o primeiro quadro.
+    """
+    if Image is None or not _claim(filename):
+        return False
+    try:
+        return _generate(filename)
+    finally:
+        _release(filename)
+
+
+def _generate_claimed(filename):
+    try:
+        _generate(filename)
+    finally:
+        _release(filename)
+
+
+def schedule_thumbnail(filename):
+    """Agenda a geração da miniatura sem bloquear a requisição."""
+    if Image is None or filename in _skipped or os.path.exists(thumbnail_path(filename)):
+        return
+    if _claim(filename):
+        _executor.submit(_generate_claimed, filename)
+
+
+def shutdown():
+    """Espera as miniaturas agendadas terminarem."""
+    _executor.shutdown(wait=True)
+
+
+def remove_thumbnail(filename):
+    try:
+        os.remove(thumbnail_path(filename))
+    except FileNotFoundError:
+        pass
+
+
+def backfill():
+    """Gera as miniaturas que faltam para todos os uploads existentes.
+
+    Retorna o número de miniaturas criadas.
+    """
+    names = [
+        entry.name for entry in os.scandir(UPLOAD_FOLDER)
+        if entry.is_file() and not entry.name.startswith('.')
+    ]
+    return sum(_executor.map(generate_thumbnail, names))
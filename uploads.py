@@ -0,0 +1,240 @@
+"""Gravação de imagens enviadas para ``data/uploads``.
+
+O upload multipart é copiado para o disco em blocos, com o limite de
+tamanho verificado durante a leitura, sem montar o arquivo inteiro em
+memória. O formato real é detectado pelos magic bytes (e não pela extensão
+ou pelo tipo declarado pelo navegador), e o arquivo é salvo com a extensão
+correspondente.
+
+Os arquivos são endereçados pelo conteúdo: o nome é o SHA-256 da imagem,
+então o mesmo meme colado várias vezes é gravado uma única vez. Mensagens
+e entradas da galeria que apontam para um arquivo são contadas em
+``data/upload_refs.json`` (e descontadas quando a retenção apaga as
+mensagens), o que permite apagar arquivos órfãos sem reler os históricos.
+As contagens só valem depois da primeira varredura completa
+(``rebuild_references``): antes dela, e para arquivos sem contagem, a
+coleta não sabe quem referencia o arquivo e o mantém.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+
+from message_log import load_records, append_record, save_records, register_compactor
+
+# Configurações de upload
+UPLOAD_FOLDER = 'data/uploads'
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
+CHUNK_SIZE = 64 * 1024
+REFS_FILENAME = 'upload_refs.json'
+GC_GRACE_SECONDS = 3600  # Arquivos mais novos que isso nunca são coletados
+
+IMAGE_REFERENCE_RE = re.compile(r'^\[IMAGE:([^\]/\\]+)\]$')
+
+_ref_counts = {}  # filename -> número de mensagens/memes que apontam para ele
+_refs_state = {'loaded': False, 'built': False}
+_refs_lock = threading.RLock()
+
+
+class UploadError(ValueError):
+    """Upload inválido (formato não permitido, vazio, etc.)."""
+
+
+class UploadTooLarge(UploadError):
+    """Upload maior que MAX_FILE_SIZE."""
+
+
+def detect_image_format(header):
+    """Identifica o formato da imagem pelos primeiros bytes.
+
+    Retorna a extensão ('png', 'jpg', 'gif', 'webp') ou None.
+    """
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if header.startswith((b'GIF87a', b'GIF89a')):
+        return 'gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def _finish_upload(tmp_path, header, digest):
+    """Valida o formato e dá o nome definitivo (hash do conteúdo) ao arquivo.
+
+    Se o mesmo conteúdo já existe, o temporário é descartado.
+    """
+    ext = detect_image_format(header)
+    if ext is None or ext not in ALLOWED_EXTENSIONS:
+        raise UploadError('Formato de imagem não suportado')
+    filename = f"{digest}.{ext}"
+    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    if os.path.exists(filepath):
+        # Já existe: renova o mtime para o GC não coletá-lo agora
+        os.utime(filepath)
+    else:
+        os.replace(tmp_path, filepath)
+    return filename
+
+
+def save_upload_stream(stream):
+    """Copia o stream para o disco em blocos e retorna o nome do arquivo.
+
+    Levanta UploadTooLarge assim que o tamanho passa de MAX_FILE_SIZE.
+    """
+    tmp_path = os.path.join(UPLOAD_FOLDER, f'.{uuid.uuid4()}.part')
+    header = b''
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise UploadTooLarge('Imagem maior que o tamanho máximo')
+                if len(header) < 16:
+                    header += chunk[:16 - len(header)]
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise UploadError('Nenhuma imagem fornecida')
+        return _finish_upload(tmp_path, header, digest.hexdigest())
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_upload_bytes(image_bytes):
+    """Salva uma imagem já decodificada (caminho JSON/base64)."""
+    if len(image_bytes) > MAX_FILE_SIZE:
+        raise UploadTooLarge('Imagem maior que o tamanho máximo')
+    if not image_bytes:
+        raise UploadError('Nenhuma imagem fornecida')
+    tmp_path = os.path.join(UPLOAD_FOLDER, f'.{uuid.uuid4()}.part')
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(image_bytes)
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        return _finish_upload(tmp_path, image_bytes[:16], digest)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# ========== CONTAGEM DE REFERÊNCIAS ==========
+
+def image_reference(text):
+    """Retorna o arquivo referenciado por uma mensagem '[IMAGE:arquivo]', ou None."""
+    if not isinstance(text, str):
+        return None
+    match = IMAGE_REFERENCE_RE.match(text)
+    return match.group(1) if match else None
+
+
+def _compact_refs(deltas, extra):
+    """Na compactação, soma os incrementos no total por arquivo.
+
+    Contagens zeradas são mantidas: zero (sem referências) é diferente de
+    não ter contagem (desconhecido).
+    """
+    counts = dict(extra.get('counts', {}))
+    for delta in deltas:
+        counts[delta['filename']] = max(counts.get(delta['filename'], 0) + delta['delta'], 0)
+    return [], {'counts': counts, 'built': extra.get('built', False)}
+
+
+register_compactor(REFS_FILENAME, _compact_refs)
+
+
+def _ensure_refs_loaded():
+    if _refs_state['loaded']:
+        return
+    with _refs_lock:
+        if _refs_state['loaded']:
+            return
+        deltas, extra = load_records(REFS_FILENAME, key='deltas')
+        _, totals = _compact_refs(deltas, extra)
+        _ref_counts.clear()
+        _ref_counts.update(totals['counts'])
+        _refs_state['built'] = totals['built']
+        _refs_state['loaded'] = True
+
+
+def add_reference(filename, delta=1):
+    """Registra que mais uma mensagem/meme aponta para o arquivo."""
+    _ensure_refs_loaded()
+    with _refs_lock:
+        append_record({'filename': filename, 'delta': delta}, REFS_FILENAME, key='deltas')
+        _ref_counts[filename] = max(_ref_counts.get(filename, 0) + delta, 0)
+
+
+def release_reference(filename):
+    """Registra que uma referência ao arquivo deixou de existir."""
+    add_reference(filename, -1)
+
+
+def reference_count(filename):
+    """Referências ao arquivo, ou None se ele não tem contagem (desconhecido)."""
+    _ensure_refs_loaded()
+    return _ref_counts.get(filename)
+
+
+def references_built():
+    """True se as contagens já foram recalculadas por uma varredura completa."""
+    _ensure_refs_loaded()
+    return _refs_state['built']
+
+
+def rebuild_references(filenames, known=()):
+    """Recalcula as contagens a partir de uma varredura completa.
+
+    ``filenames`` é um iterável com um item por referência encontrada;
+    os arquivos de ``known`` sem nenhuma referência ficam com contagem zero.
+    """
+    counts = dict.fromkeys(known, 0)
+    for filename in filenames:
+        counts[filename] = counts.get(filename, 0) + 1
+    with _refs_lock:
+        save_records([], REFS_FILENAME, key='deltas', extra={'counts': counts, 'built': True})
+        _ref_counts.clear()
+        _ref_counts.update(counts)
+        _refs_state['built'] = True
+        _refs_state['loaded'] = True
+
+
+def stored_files():
+    """Nomes dos uploads gravados (sem os temporários)."""
+    return [entry.name for entry in os.scandir(UPLOAD_FOLDER)
+            if entry.is_file() and not entry.name.startswith('.')]
+
+
+def collect_garbage(grace_seconds=GC_GRACE_SECONDS, count_references=None):
+    """Apaga arquivos sem referências (e temporários abandonados).
+
+    Arquivos modificados há menos de ``grace_seconds`` são mantidos, para não
+    apagar um upload cuja mensagem ainda está sendo gravada. Só são apagados
+    arquivos com contagem zero: sem contagem (``None``, ex: anteriores à
+    contagem), o arquivo é mantido.
+    ``count_references`` permite usar outra fonte para as contagens (ex: o
+    banco SQLite); o padrão é ``reference_count``.
+    Retorna a lista de arquivos removidos.
+    """
+    if count_references is None:
+        count_references = reference_count
+    cutoff = time.time() - grace_seconds
+    removed = []
+    for entry in os.scandir(UPLOAD_FOLDER):
+        if not entry.is_file() or entry.stat().st_mtime > cutoff:
+            continue
+        is_tmp = entry.name.startswith('.') and entry.name.endswith('.part')
+        if is_tmp or count_references(entry.name) == 0:
+            os.remove(entry.path)
+            removed.append(entry.name)
+    return removed
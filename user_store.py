@@ -0,0 +1,103 @@
+"""Repositório de usuários com índices em memória.
+
+Os usuários são carregados uma única vez de ``data/users.json`` (mais o log
+de appends do ``message_log``) e indexados por username (case-insensitive)
+e por ID, então login e cadastro custam O(1) independente do número de
+usuários. Um cadastro grava apenas o usuário novo no log.
+
+Se os arquivos forem alterados por fora (ex: ``migrate_users.py``), a
+mudança é detectada pelo ``stat`` e os índices são recarregados.
+
+Cadastros e recargas são serializados por um lock; as buscas leem os
+índices sem lock (uma recarga monta índices novos e só então os publica).
+"""
+import os
+import threading
+
+from message_log import DATA_DIR, LOG_SUFFIX, load_records, append_record
+
+USERS_FILENAME = 'users.json'
+
+_users_by_name = {}  # username.casefold() -> usuário
+_users_by_id = {}  # id -> usuário
+_state = {'next_id': 1, 'signature': None}
+_lock = threading.RLock()
+
+
+def _file_signature():
+    """Identifica a versão atual dos arquivos de usuários em disco."""
+    signature = []
+    for path in (os.path.join(DATA_DIR, USERS_FILENAME),
+                 os.path.join(DATA_DIR, USERS_FILENAME + LOG_SUFFIX)):
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def _load():
+    """(Re)constrói os índices a partir do disco."""
+    global _users_by_name, _users_by_id
+    users, extra = load_records(USERS_FILENAME, key='users')
+    by_name = {}
+    by_id = {}
+    next_id = extra.get('next_id', 1)
+    for user in users:
+        by_name[user['username'].casefold()] = user
+        by_id[user['id']] = user
+        next_id = max(next_id, user['id'] + 1)
+    _users_by_name, _users_by_id = by_name, by_id
+    _state['next_id'] = next_id
+    _state['signature'] = _file_signature()
+
+
+def _ensure_loaded():
+    if _state['signature'] != _file_signature():
+        with _lock:
+            if _state['signature'] != _file_signature():
+                _load()
+
+
+def find_user(username):
+    """Busca um usuário pelo username (sem diferenciar maiúsculas)."""
+    _ensure_loaded()
+    return _users_by_name.get(username.casefold())
+
+
+def get_user(user_id):
+    """Busca um usuário pelo ID interno."""
+    _ensure_loaded()
+    return _users_by_id.get(user_id)
+
+
+def create_user(username, password_hash, created_at):
+    """Cria e persiste um novo usuário, retornando-o.
+
+    Retorna None se o username já existir.
+    """
+    with _lock:
+        _ensure_loaded()
+        key = username.casefold()
+        if key in _users_by_name:
+            return None
+
+        user = {
+            'id': _state['next_id'],
+            'username': username,
+            'password': password_hash,
+            'created_at': created_at
+        }
+        append_record(user, USERS_FILENAME, key='users')
+        _users_by_name[key] = user
+        _users_by_id[user['id']] = user
+        _state['next_id'] += 1
+        # A escrita foi nossa: os índices continuam válidos
+        _state['signature'] = _file_signature()
+        return user
+
+
+def user_count():
+    _ensure_loaded()
+    return len(_users_by_id)
@@ -0,0 +1,287 @@
+"""Escrita adiada (write-behind) das mensagens nos históricos JSON.
+
+Um envio não grava mais no histórico da sala ou conversa durante a
+requisição: a mensagem é anotada num journal único
+(``data/journal/journal-<n>.log``, uma linha JSON por mensagem, num arquivo
+já aberto) e fica numa fila em memória. Uma thread em segundo plano junta
+as mensagens pendentes de cada arquivo e as grava no log dele numa única
+escrita (``message_log.append_records``), a cada ``FLUSH_INTERVAL``
+segundos ou assim que houver ``FLUSH_BATCH`` mensagens pendentes.
+
+Durabilidade: a linha do journal vai para o sistema operacional antes de o
+envio ser confirmado, então sobrevive a uma queda do processo (com
+``CHAT_JOURNAL_FSYNC=1`` também a uma queda da máquina, ao custo de um
+fsync por mensagem; ``CHAT_JOURNAL_DIR`` pode apontar para um tmpfs como
+``/dev/shm``). Na inicialização o journal que sobrou é reaplicado: as
+mensagens com ID até o último do histórico (``message_log.read_header``)
+já tinham sido gravadas e são ignoradas. No encerramento normal
+(``atexit``) tudo é gravado.
+
+Um arquivo que não pode ser gravado (erro de disco, por exemplo) não
+trava os outros: as mensagens dele continuam na fila e são tentadas de
+novo a cada gravação, e só são apagados os segmentos do journal que não
+têm mais nenhuma mensagem pendente. O mesmo vale para a reaplicação: os
+segmentos com mensagens que não puderam ser gravadas ficam para a próxima
+inicialização.
+
+Antes de qualquer leitura ou regravação de um histórico pelo
+``message_log``, os pendentes daquele arquivo são gravados (veja
+``message_log.set_pending_flusher``), então carregar uma sala ou conversa
+do disco sempre traz tudo o que já foi confirmado.
+
+O journal só é ligado (``start``) no processo que atende requisições (veja
+``start_background_workers`` no app.py); quem apenas importa o app, como os
+comandos ``flask`` ou o processo pai do reloader, grava direto no
+histórico. Só um processo pode ser dono do journal (lock de arquivo com
+``fcntl``): um segundo servidor com a mesma pasta também grava direto.
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem lock entre processos
+    fcntl = None
+
+import message_log
+import metrics
+from message_log import DATA_DIR, file_lock, append_records, read_header
+
+WRITE_BEHIND_ENABLED = os.environ.get('CHAT_WRITE_BEHIND', '1') != '0'
+JOURNAL_DIR = os.environ.get('CHAT_JOURNAL_DIR', os.path.join(DATA_DIR, 'journal'))
+JOURNAL_FSYNC = os.environ.get('CHAT_JOURNAL_FSYNC', '0') == '1'
+FLUSH_INTERVAL = float(os.environ.get('CHAT_FLUSH_INTERVAL', 0.5))  # Segundos entre gravações
+FLUSH_BATCH = int(os.environ.get('CHAT_FLUSH_BATCH', 200))  # Pendentes que antecipam a gravação
+
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_pending = {}  # arquivo -> [mensagens ainda não gravadas no log]
+_state = {'started': False, 'active': False, 'count': 0, 'journal': None, 'segment': 0, 'lock_file': None}
+_retired = []  # segmentos do journal fechados, apagados depois de gravar tudo
+_segment_files = {}  # segmento -> arquivos com mensagens nele
+_failing = set()  # arquivos cuja última gravação falhou (o erro só é mostrado uma vez)
+_lock = threading.Condition()
+_flush_all_lock = threading.Lock()
+
+
+def _segment_path(number):
+    return os.path.join(JOURNAL_DIR, f'journal-{number}.log')
+
+
+def _segment_number(path):
+    return int(os.path.basename(path)[len('journal-'):-len('.log')])
+
+
+def _existing_segments():
+    paths = glob.glob(os.path.join(JOURNAL_DIR, 'journal-*.log'))
+    return sorted(paths, key=_segment_number)
+
+
+def _open_segment():
+    """Abre um segmento novo do journal (deve ser chamada com _lock)."""
+    _state['segment'] += 1
+    path = _segment_path(_state['segment'])
+    _state['journal'] = (open(path, 'a', encoding='utf-8'), path)
+    _segment_files[path] = set()
+
+
+def _acquire_owner_lock():
+    if fcntl is None:
+        return True
+    lock_file = open(os.path.join(JOURNAL_DIR, '.lock'), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _state['lock_file'] = lock_file  # Mantido aberto: o lock dura o processo
+    return True
+
+
+def owned_elsewhere():
+    """True se outro processo (o servidor) segura o lock do journal."""
+    if fcntl is None:
+        return False
+    try:
+        lock_file = open(os.path.join(JOURNAL_DIR, '.lock'), 'r')
+    except FileNotFoundError:
+        return False
+    with lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return False
+
+
+def replay():
+    """Reaplica os segmentos que sobraram de uma execução anterior.
+
+    Retorna o número de mensagens que ainda não estavam nos históricos.
+    Segmentos com mensagens de um arquivo que não pôde ser gravado são
+    mantidos (e reaplicados na próxima inicialização).
+    """
+    by_file = {}
+    files_by_segment = {}
+    segments = _existing_segments()
+    for path in segments:
+        files = files_by_segment[path] = set()
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Linha incompleta de uma queda no meio da escrita
+                by_file.setdefault(entry['file'], []).append(entry['record'])
+                files.add(entry['file'])
+
+    restored = 0
+    failed = set()
+    for filename, records in by_file.items():
+        try:
+            _, last_id = read_header(filename)
+            missing = [record for record in records if record['id'] > last_id]
+            if missing:
+                append_records(missing, filename)
+                restored += len(missing)
+        except Exception as e:
+            print(f"Erro ao reaplicar o journal de {filename}: {e}")
+            failed.add(filename)
+    for path in segments:
+        if not files_by_segment[path] & failed:
+            os.remove(path)
+    if segments:
+        _state['segment'] = _segment_number(segments[-1])
+    return restored
+
+
+def start():
+    """Reaplica o journal antigo e liga a escrita adiada (uma única vez).
+
+    Se outro processo já é dono do journal, este continua gravando direto.
+    """
+    with _lock:
+        if _state['started']:
+            return _state['active']
+        _state['started'] = True
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        # O lock também marca o processo servidor (mesmo sem escrita
+        # adiada): os comandos que regravam os históricos o consultam
+        if not _acquire_owner_lock():
+            if WRITE_BEHIND_ENABLED:
+                print("Journal de mensagens em uso por outro processo: gravando direto no histórico")
+            return False
+        if not WRITE_BEHIND_ENABLED:
+            return False
+
+        restored = replay()
+        if restored:
+            print(f"{restored} mensagem(ns) recuperada(s) do journal")
+        _open_segment()
+        message_log.set_pending_flusher(flush)
+        _state['active'] = True
+
+    threading.Thread(target=_flush_forever, name='write-behind', daemon=True).start()
+    atexit.register(flush_all)
+    return True
+
+
+def append_message(message, filename):
+    """Aceita a mensagem: journal + fila. Sem escrita adiada, grava direto."""
+    if not _state['active']:
+        message_log.append_message(message, filename)
+        return
+    line = json.dumps({'file': filename, 'record': message}, ensure_ascii=False) + '\n'
+    with _lock:
+        journal, path = _state['journal']
+        journal.write(line)
+        journal.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(journal.fileno())
+        _segment_files[path].add(filename)
+        _pending.setdefault(filename, []).append(message)
+        _state['count'] += 1
+        if _state['count'] >= FLUSH_BATCH:
+            _lock.notify()
+
+
+def flush(filename):
+    """Grava no log do arquivo as mensagens pendentes dele."""
+    # O lock do arquivo é segurado do momento em que os pendentes saem da
+    # fila até estarem no log: quem for ler o arquivo espera por eles
+    with file_lock(filename):
+        with _lock:
+            records = _pending.pop(filename, None)
+            if not records:
+                return 0
+            _state['count'] -= len(records)
+        try:
+            append_records(records, filename)
+        except Exception:
+            # Voltam para a fila, na frente dos que chegaram depois
+            with _lock:
+                _pending[filename] = records + _pending.get(filename, [])
+                _state['count'] += len(records)
+            raise
+    metrics.observe('chat_flush_batch_messages', len(records), buckets=BATCH_BUCKETS)
+    return len(records)
+
+
+def flush_all():
+    """Grava todos os pendentes e apaga os segmentos do journal já cobertos.
+
+    Um arquivo que falha não impede os outros: as mensagens dele ficam na
+    fila, e os segmentos que as contêm não são apagados.
+    """
+    if not _state['active']:
+        return 0
+    with _flush_all_lock:
+        with _lock:
+            # Mensagens novas vão para um segmento novo; o atual fica
+            # coberto quando todos os arquivos pendentes forem gravados
+            journal, path = _state['journal']
+            if _segment_files[path]:
+                journal.close()
+                _retired.append(path)
+                _open_segment()
+            filenames = list(_pending)
+        written = 0
+        failed = set()
+        for filename in filenames:
+            try:
+                written += flush(filename)
+                _failing.discard(filename)
+            except Exception as e:
+                if filename not in _failing:
+                    print(f"Erro ao gravar mensagens pendentes de {filename}: {e}")
+                    _failing.add(filename)
+                failed.add(filename)
+        for path in list(_retired):
+            if not _segment_files[path] & failed:
+                os.remove(path)
+                _retired.remove(path)
+                del _segment_files[path]
+        return written
+
+
+def pending_count():
+    return _state['count']
+
+
+def _flush_forever():
+    while True:
+        with _lock:
+            _lock.wait_for(lambda: _state['count'] >= FLUSH_BATCH, timeout=FLUSH_INTERVAL)
+        try:
+            flush_all()
+        except Exception as e:
+            print(f"Erro ao gravar mensagens pendentes: {e}")
+            time.sleep(FLUSH_INTERVAL)
+
+
+metrics.describe('chat_flush_batch_messages', 'histogram', 'Mensagens gravadas por escrita no log de um histórico')